@@ -1,12 +1,6 @@
 """本地回填 public 到 public_middle，输出 WebP 并保持目录结构。
-Algorithm steps:
-1) Read image, fix EXIF orientation.
-2) If original <= target size: try lossless WebP; keep if still <= target.
-3) If >25MB: resize to max_dim before lossy steps.
-4) Lossy WebP quality ladder (step/limit) until <= target or min_quality.
-5) If still > target: resize to max_dim (if larger), then repeat ladder.
-6) If resized result < target * min_target_ratio: raise quality back up.
-7) If already <= max_dim and still > target: continue down to fallback_min_quality.
+Encodes with compress_to_webp from ../shared/photo_pipeline.py, the same code and
+defaults as the new_webp_middle Lambda (photo_pipeline lists the algorithm steps).
 
 python backend/lambda/Lambda_Funcs/backfill_public_middle.py \
   --bucket marcus-photograph-garage \
@@ -20,17 +14,63 @@ python backend/lambda/Lambda_Funcs/backfill_public_middle.py \
   --min-target-ratio 0.6 \
   --large-image-mb 25 \
   --quality-step 8 \
-  --max-quality-steps 6
+  --max-quality-steps 6 \
+  --quality-search bisect \
+  --max-search-encodes 4 \
+  --predict-quality \
+  --workers 4
+
+With --workers N > 1, encoding runs in a pool of N processes while downloads and
+uploads run on I/O threads; at most --max-in-flight images (default 2N) are held
+in memory at once, and progress lines are still printed in listing order.
+
+The destination prefix is listed once up front and sources whose WebP is already
+newer than the original are skipped (--force re-encodes everything). Progress is
+checkpointed to --checkpoint every --checkpoint-every images; --resume continues
+after the last checkpointed key. The checkpoint is removed when the run completes.
+
+Originals of at least --download-parallel-mb are fetched as --download-part-mb byte
+ranges on --download-workers threads, written straight into one preallocated buffer
+(defaults from DOWNLOAD_PARALLEL_MB / DOWNLOAD_PART_MB / DOWNLOAD_WORKERS); the
+ranges share photo_pipeline.download_object with the Lambda, pinned to one version.
+
+--metrics prints a per-stage summary table (download, decode, transpose, encode,
+upload, encoder calls, chosen quality, bytes) when the run ends; --metrics-log
+writes one JSON line per image with the same fields as the Lambda's metric logs.
+
+--profile runs the whole backfill under cProfile and tracemalloc and writes the
+stats, the top allocation sites and peak RSS to --profile-dir (and to
+s3://BUCKET/--profile-s3-prefix/ when given). With --workers > 1 the encoding
+happens in child processes, so profile with --workers 1 to see encoder hot spots.
 """
 import argparse
-import io
+import contextlib
+import json
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import splitext
 
 import boto3
-from PIL import Image, ImageOps, ImageSequence
 
-IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff"}
+# The summary table and --metrics-log replace the Lambda's per-run EMF log lines.
+os.environ.setdefault("METRICS", "0")
+try:
+    import photo_pipeline
+except ImportError:  # run from the repo: the shared module is not packaged next to us
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+    import photo_pipeline
+from photo_pipeline import (
+    METRICS_SINKS,
+    MetricsAggregator,
+    compress_to_webp,
+    is_middle_image_key,
+    metrics_stage,
+    profile_run,
+    track_run,
+)
 
 
 def main():
@@ -49,6 +89,41 @@ def main():
     parser.add_argument("--large-image-mb", type=float, default=25)
     parser.add_argument("--quality-step", type=int, default=8)
     parser.add_argument("--max-quality-steps", type=int, default=6)
+    parser.add_argument(
+        "--quality-search", choices=("bisect", "ladder"), default="bisect"
+    )
+    parser.add_argument("--max-search-encodes", type=int, default=4)
+    parser.add_argument(
+        "--predict-quality", action=argparse.BooleanOptionalAction, default=True
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument(
+        "--checkpoint", default=".backfill_public_middle.checkpoint.json"
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=50)
+    parser.add_argument(
+        "--download-parallel-mb",
+        type=float,
+        default=float(os.environ.get("DOWNLOAD_PARALLEL_MB", "16")),
+    )
+    parser.add_argument(
+        "--download-part-mb",
+        type=float,
+        default=float(os.environ.get("DOWNLOAD_PART_MB", "8")),
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=int(os.environ.get("DOWNLOAD_WORKERS", "8")),
+    )
+    parser.add_argument("--metrics", action="store_true")
+    parser.add_argument("--metrics-log")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--profile-s3-prefix")
 
     args = parser.parse_args()
 
@@ -56,54 +131,283 @@ def main():
         raise SystemExit("Missing --bucket or BUCKET_NAME.")
 
     s3 = boto3.client("s3")
-    paginator = s3.get_paginator("list_objects_v2")
 
-    image_keys = []
-    for page in paginator.paginate(Bucket=args.bucket, Prefix=f"{args.source_prefix}/"):
-        for item in page.get("Contents", []):
-            key = item["Key"]
-            if is_image_key(key):
-                image_keys.append(key)
+    sizes = {}
+    sources = list_last_modified(s3, args.bucket, f"{args.source_prefix}/", sizes)
+    image_keys = [key for key in sources if is_middle_image_key(key)]
+    if not image_keys:
+        print("No images found under source prefix.")
+        return
 
+    checkpoint = Checkpoint(
+        args.checkpoint, args.source_prefix, args.dest_prefix, args.checkpoint_every
+    )
+    if args.resume:
+        checkpoint.load()
+
+    existing = {}
+    if not args.force:
+        existing = list_last_modified(s3, args.bucket, f"{args.dest_prefix}/")
+
+    image_keys = select_pending(image_keys, sources, existing, checkpoint, args)
     total = len(image_keys)
     if total == 0:
-        print("No images found under source prefix.")
+        print("All derivatives are up to date.")
+        checkpoint.remove()
         return
 
+    compress_options = {
+        "target_size_kb": args.target_size_kb,
+        "quality": args.quality,
+        "min_quality": args.min_quality,
+        "max_dim": args.max_dim,
+        "min_target_ratio": args.min_target_ratio,
+        "fallback_min_quality": args.fallback_min_quality,
+        "large_image_mb": args.large_image_mb,
+        "quality_step": args.quality_step,
+        "max_quality_steps": args.max_quality_steps,
+        "quality_search": args.quality_search,
+        "max_search_encodes": args.max_search_encodes,
+        "predict_quality": args.predict_quality,
+    }
+
+    aggregator = MetricsAggregator()
+    if args.metrics:
+        METRICS_SINKS.append(aggregator)
+    metrics_log = None
+    if args.metrics_log:
+        metrics_log = MetricsLog(args.metrics_log)
+        METRICS_SINKS.append(metrics_log)
+
+    profile = contextlib.nullcontext()
+    if args.profile:
+        profile = profile_run(
+            f"backfill_public_middle-{int(time.time())}",
+            args.bucket,
+            args.profile_dir,
+            args.profile_s3_prefix or "",
+        )
+
+    try:
+        with profile:
+            if args.workers > 1:
+                run_parallel(s3, args, image_keys, sizes, compress_options, checkpoint)
+            else:
+                run_serial(s3, args, image_keys, sizes, compress_options, checkpoint)
+    except BaseException:
+        checkpoint.save()
+        print(f"Stopped; checkpoint saved to {checkpoint.path} (use --resume).")
+        raise
+    finally:
+        if metrics_log is not None:
+            metrics_log.close()
+        if args.metrics:
+            aggregator.print_summary()
+    checkpoint.remove()
+
+
+def run_serial(s3, args, image_keys, sizes, compress_options, checkpoint):
+    total = len(image_keys)
     for index, key in enumerate(image_keys, start=1):
         destination_key = build_destination_key(
             key, args.source_prefix, args.dest_prefix
         )
 
-        response = s3.get_object(Bucket=args.bucket, Key=key)
-        image_content = response["Body"].read()
-
-        compressed_content = compress_to_webp(
-            image_content,
-            target_size_kb=args.target_size_kb,
-            quality=args.quality,
-            min_quality=args.min_quality,
-            max_dim=args.max_dim,
-            min_target_ratio=args.min_target_ratio,
-            fallback_min_quality=args.fallback_min_quality,
-            large_image_mb=args.large_image_mb,
-            quality_step=args.quality_step,
-            max_quality_steps=args.max_quality_steps,
-        )
+        with track_run("backfill", key) as run:
+            with run.stage("download"):
+                image_content = download_original(s3, args, key, sizes.get(key))
+            run.set(input_bytes=len(image_content))
 
-        s3.put_object(
-            Bucket=args.bucket,
-            Key=destination_key,
-            Body=compressed_content,
-            ContentType="image/webp",
-        )
+            compressed_content = compress_with_metrics(image_content, compress_options)
+            run.set(outcome="encoded", output_bytes=len(compressed_content))
+
+            with run.stage("upload"):
+                s3.put_object(
+                    Bucket=args.bucket,
+                    Key=destination_key,
+                    Body=compressed_content,
+                    ContentType="image/webp",
+                )
 
         print(f"[{index}/{total}] {key} -> {destination_key}")
+        checkpoint.mark_done(key)
+
 
+def list_last_modified(s3, bucket, prefix, sizes=None):
+    """List a prefix once into {key: LastModified} (and sizes[key] = Size if given)."""
+    paginator = s3.get_paginator("list_objects_v2")
+    objects = {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            objects[item["Key"]] = item["LastModified"]
+            if sizes is not None:
+                sizes[item["Key"]] = item["Size"]
+    return objects
+
+
+def download_original(s3, args, key, size=None):
+    """photo_pipeline.download_object with the --download-* settings."""
+    return photo_pipeline.download_object(
+        args.bucket,
+        key,
+        size,
+        parallel_bytes=int(args.download_parallel_mb * 1024 * 1024),
+        part_bytes=int(args.download_part_mb * 1024 * 1024),
+        workers=args.download_workers,
+        client=s3,
+    )
 
-def is_image_key(key):
-    _, ext = splitext(key)
-    return ext.lower() in IMAGE_EXTENSIONS
+
+def select_pending(image_keys, sources, existing, checkpoint, args):
+    pending = []
+    resumed = 0
+    up_to_date = 0
+    for key in image_keys:
+        if checkpoint.covers(key):
+            resumed += 1
+            continue
+        destination_key = build_destination_key(
+            key, args.source_prefix, args.dest_prefix
+        )
+        if destination_key in existing and existing[destination_key] >= sources[key]:
+            up_to_date += 1
+            continue
+        pending.append(key)
+    print(
+        f"{len(pending)} to process, {up_to_date} up to date, "
+        f"{resumed} done in checkpoint."
+    )
+    return pending
+
+
+class Checkpoint:
+    """Last key (in listing order) whose derivative has been written.
+
+    Progress is reported in listing order, so everything up to last_key is done.
+    The file is rewritten atomically every `every` keys.
+    """
+
+    def __init__(self, path, source_prefix, dest_prefix, every):
+        self.path = path
+        self.source_prefix = source_prefix
+        self.dest_prefix = dest_prefix
+        self.every = max(1, every)
+        self.last_key = None
+        self.unsaved = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            print(f"No checkpoint at {self.path}; starting from the beginning.")
+            return
+        with open(self.path, encoding="utf-8") as handle:
+            data = json.load(handle)
+        if (data.get("source_prefix"), data.get("dest_prefix")) != (
+            self.source_prefix,
+            self.dest_prefix,
+        ):
+            raise SystemExit(f"Checkpoint {self.path} is for different prefixes.")
+        self.last_key = data.get("last_key")
+        print(f"Resuming after {self.last_key}")
+
+    def covers(self, key):
+        return self.last_key is not None and key <= self.last_key
+
+    def mark_done(self, key):
+        self.last_key = key
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def save(self):
+        if self.last_key is None:
+            return
+        data = {
+            "source_prefix": self.source_prefix,
+            "dest_prefix": self.dest_prefix,
+            "last_key": self.last_key,
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as handle:
+            json.dump(data, handle)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_parallel(s3, args, image_keys, sizes, compress_options, checkpoint):
+    """Overlap S3 transfers (threads) with WebP encoding (processes).
+
+    Each key is owned by one I/O thread for GET -> encode in the process pool
+    -> PUT. A semaphore caps the number of keys in flight, which bounds both
+    queued work and the original/encoded bytes held in memory.
+    """
+    total = len(image_keys)
+    max_in_flight = args.max_in_flight or args.workers * 2
+    slots = threading.BoundedSemaphore(max_in_flight)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as encoders, ThreadPoolExecutor(
+        max_workers=max_in_flight
+    ) as transfers:
+
+        def transfer(key, destination_key):
+            try:
+                with track_run("backfill", key) as run:
+                    with run.stage("download"):
+                        image_content = download_original(s3, args, key, sizes.get(key))
+                    run.set(input_bytes=len(image_content))
+                    submitted = time.perf_counter()
+                    compressed_content, worker_run = encoders.submit(
+                        compress_in_worker, image_content, compress_options
+                    ).result()
+                    del image_content
+                    # Time spent queued for a free encoder process.
+                    run.stages["encode_queue"] = max(
+                        0.0,
+                        (time.perf_counter() - submitted) * 1000
+                        - worker_run["stages"].get("compress", 0.0),
+                    )
+                    run.merge(worker_run)
+                    run.set(outcome="encoded", output_bytes=len(compressed_content))
+                    with run.stage("upload"):
+                        s3.put_object(
+                            Bucket=args.bucket,
+                            Key=destination_key,
+                            Body=compressed_content,
+                            ContentType="image/webp",
+                        )
+            finally:
+                slots.release()
+
+        pending = []
+        reported = 0
+        for key in image_keys:
+            slots.acquire()
+            destination_key = build_destination_key(
+                key, args.source_prefix, args.dest_prefix
+            )
+            pending.append(
+                (key, destination_key, transfers.submit(transfer, key, destination_key))
+            )
+            reported = report_in_order(
+                pending, reported, total, checkpoint, wait=False
+            )
+        report_in_order(pending, reported, total, checkpoint, wait=True)
+
+
+def report_in_order(pending, reported, total, checkpoint, wait):
+    """Print progress for the finished prefix of pending; returns the new count."""
+    while reported < len(pending):
+        key, destination_key, future = pending[reported]
+        if not wait and not future.done():
+            break
+        future.result()
+        reported += 1
+        print(f"[{reported}/{total}] {key} -> {destination_key}")
+        checkpoint.mark_done(key)
+    return reported
 
 
 def build_destination_key(source_key, source_prefix, destination_prefix):
@@ -113,115 +417,32 @@ def build_destination_key(source_key, source_prefix, destination_prefix):
     return f"{base}.webp"
 
 
-def compress_to_webp(
-    image_content,
-    target_size_kb,
-    quality,
-    min_quality,
-    max_dim,
-    min_target_ratio,
-    fallback_min_quality,
-    large_image_mb,
-    quality_step,
-    max_quality_steps,
-):
-    image = Image.open(io.BytesIO(image_content))
-    image = ImageOps.exif_transpose(image)
-
-    if getattr(image, "is_animated", False):
-        image = ImageSequence.Iterator(image).__next__()
-
-    image = normalize_mode(image)
-    if len(image_content) > large_image_mb * 1024 * 1024:
-        image = ensure_max_dimension(image, max_dim)
-
-    if len(image_content) <= target_size_kb * 1024:
-        lossless = encode_webp(image, quality, lossless=True)
-        if len(lossless) <= target_size_kb * 1024:
-            return lossless
-
-    start_quality = quality
-    compressed = encode_webp(image, quality, lossless=False)
-    steps = 0
-    while (
-        len(compressed) > target_size_kb * 1024
-        and quality > min_quality
-        and steps < max_quality_steps
-    ):
-        quality = max(min_quality, quality - quality_step)
-        compressed = encode_webp(image, quality, lossless=False)
-        steps += 1
-
-    if len(compressed) > target_size_kb * 1024:
-        resized = ensure_max_dimension(image, max_dim)
-        if resized is not image:
-            quality = max(quality, min_quality)
-            compressed = encode_webp(resized, quality, lossless=False)
-            steps = 0
-            while (
-                len(compressed) > target_size_kb * 1024
-                and quality > min_quality
-                and steps < max_quality_steps
-            ):
-                quality = max(min_quality, quality - quality_step)
-                compressed = encode_webp(resized, quality, lossless=False)
-                steps += 1
-
-            min_target_bytes = int(target_size_kb * 1024 * min_target_ratio)
-            steps = 0
-            while len(compressed) < min_target_bytes and quality < start_quality:
-                quality = min(start_quality, quality + quality_step)
-                compressed = encode_webp(resized, quality, lossless=False)
-                steps += 1
-                if steps >= max_quality_steps:
-                    break
-        else:
-            steps = 0
-            while (
-                len(compressed) > target_size_kb * 1024
-                and quality > fallback_min_quality
-                and steps < max_quality_steps
-            ):
-                quality = max(fallback_min_quality, quality - quality_step)
-                compressed = encode_webp(image, quality, lossless=False)
-                steps += 1
-
-    return compressed
-
-
-def ensure_max_dimension(image, max_dim):
-    width, height = image.size
-    if max(width, height) <= max_dim:
-        return image
-
-    if width >= height:
-        new_width = max_dim
-        new_height = int(height * (max_dim / width))
-    else:
-        new_height = max_dim
-        new_width = int(width * (max_dim / height))
-
-    return image.resize((new_width, new_height), Image.LANCZOS)
-
-
-def normalize_mode(image):
-    if image.mode in {"RGBA", "LA"}:
-        return image.convert("RGBA")
-    if image.mode != "RGB":
-        return image.convert("RGB")
-    return image
-
-
-def encode_webp(image, quality, lossless):
-    output = io.BytesIO()
-    image.save(
-        output,
-        format="WEBP",
-        quality=quality,
-        method=6,
-        lossless=lossless,
-    )
-    return output.getvalue()
+def compress_with_metrics(image_content, compress_options):
+    """compress_to_webp, recording its stages into the current run."""
+    with metrics_stage("compress"):
+        return compress_to_webp(image_content, **compress_options)
+
+
+def compress_in_worker(image_content, compress_options):
+    """Pool entry point: (webp bytes, run dict of the encode) for the parent to merge."""
+    with track_run("compress", None, emit=False) as run:
+        compressed_content = compress_with_metrics(image_content, compress_options)
+    return compressed_content, run.as_dict()
+
+
+class MetricsLog:
+    """--metrics-log sink: one JSON line per run."""
+
+    def __init__(self, path):
+        self.handle = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def add(self, run):
+        with self.lock:
+            self.handle.write(json.dumps(run) + "\n")
+
+    def close(self):
+        self.handle.close()
 
 
 if __name__ == "__main__":
@@ -1,45 +1,147 @@
 """将 public 原图压缩为 public_middle 的 WebP，并保持目录结构。
-Algorithm steps:
-1) Read image, fix EXIF orientation.
-2) If original <= target size: try lossless WebP; keep if still <= target.
-3) If >25MB: resize to max_dim before lossy steps.
-4) Lossy WebP quality ladder (step/limit) until <= target or min_quality.
-5) If still > target: resize to max_dim (if larger), then repeat ladder.
-6) If resized result < target * min_target_ratio: raise quality back up.
-7) If already <= max_dim and still > target: continue down to fallback_min_quality.
+The WebP encoder (classifier, bounded quality search, two-tier effort), the run
+metrics, profiling, BatchDeleter and the derivative caches live in
+../shared/photo_pipeline.py; deploy that module with this function (in its zip or
+a layer). See its docstring for the algorithm steps.
+
+Originals of at least DOWNLOAD_PARALLEL_MB are fetched as DOWNLOAD_PART_MB byte
+ranges on DOWNLOAD_WORKERS threads, written straight into one preallocated buffer
+(photo_pipeline.download_object); all ranges are pinned to one version of the object.
+
+DERIVATIVE_CACHE=s3|local keeps every WebP under a key made of the source MD5 and
+the compression params, so moved or re-uploaded originals are copied, not re-encoded.
+
+Every process_object run logs one JSON line in CloudWatch embedded metric format
+(METRICS=0 turns it off): per-stage milliseconds, encoder calls, chosen quality,
+input/output bytes and resize decisions. Scripts importing this module can add a
+MetricsAggregator to METRICS_SINKS and print_summary() at the end.
+
+Single-object records go through ObjectPipeline: the next PIPELINE_PREFETCH
+originals are downloaded on threads while the handler thread encodes, and WebPs are
+uploaded on PIPELINE_UPLOAD_WORKERS threads. Originals waiting for the encoder and
+WebPs waiting for upload count against PIPELINE_BUDGET_MB; a batch of large photos
+waits for room instead of growing memory.
+
+Folder uploads fan out over FOLDER_WORKERS threads while the folder is listed page
+by page. When the Lambda has less than FOLDER_TIME_RESERVE_SECONDS left, no new
+keys are started; the function re-invokes itself asynchronously with the folder
+record and a startAfter cursor so the next invocation picks up the remaining keys
+(needs lambda:InvokeFunction on itself).
+
+Events from an SQS queue (an S3 notification or an SNS envelope per message body)
+share one ObjectPipeline, so one message's uploads overlap the next one's
+downloads; every failure is traced back to its message and the handler returns
+batchItemFailures with only those, so with ReportBatchItemFailures on the event
+source mapping a corrupt image is retried on its own instead of redelivering the batch.
+
+Before any S3 I/O the records of an invocation are coalesced to the final state per
+key (coalesce_records): the last create or remove of a key wins, and folder events
+drop the records they already cover, so an `aws s3 sync` burst of put/overwrite/
+delete events encodes each photo at most once. Queue batches are coalesced across
+messages; a message whose records are all superseded succeeds without any work.
+
+Removals go through BatchDeleter: delete_objects with up to 1000 keys per call and
+DELETE_WORKERS calls in flight; consecutive ObjectRemoved records share batches.
+
+PROFILE_EVERY=N runs 1 in N invocations under cProfile and tracemalloc and writes
+the stats, the top allocation sites and peak RSS to PROFILE_DIR, and to
+s3://BUCKET_NAME/PROFILE_S3_PREFIX/ when that is set (0, the default, is off).
 """
-import io
+import hashlib
 import json
 import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import splitext
 from urllib.parse import unquote_plus
 
 import boto3
-from PIL import Image, ImageOps, ImageSequence
 
-s3 = boto3.client("s3")
+try:
+    import photo_pipeline
+except ImportError:  # run from the repo: the shared module is not packaged next to us
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+    import photo_pipeline
+# METRICS_SINKS and MetricsAggregator are re-exported for scripts importing this module.
+from photo_pipeline import (
+    METRICS_SINKS,
+    BatchDeleter,
+    MetricsAggregator,
+    RunMetrics,
+    bind_run,
+    build_derivative_cache,
+    coalesce_queue_messages,
+    coalesce_records,
+    compress_to_webp,
+    derivative_cache_key,
+    download_object,
+    emit_metrics,
+    etag_content_hash,
+    fan_out,
+    is_middle_image_key,
+    is_queue_event,
+    iter_s3_records,
+    maybe_profile,
+)
 
-IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff"}
+s3 = boto3.client("s3")
 
+# Per-invocation pipeline for single-object records: objects downloaded ahead of
+# the encoder, concurrent uploads, and the bytes they may hold between them.
+PIPELINE_PREFETCH = int(os.environ.get("PIPELINE_PREFETCH", "2"))
+PIPELINE_UPLOAD_WORKERS = int(os.environ.get("PIPELINE_UPLOAD_WORKERS", "2"))
+PIPELINE_BUDGET_BYTES = int(float(os.environ.get("PIPELINE_BUDGET_MB", "256")) * 1024 * 1024)
 
-def iter_s3_records(event):
-    for record in event.get("Records", []):
-        if "s3" in record:
-            yield record
-            continue
-        sns = record.get("Sns")
-        if not sns:
-            continue
-        try:
-            message = json.loads(sns.get("Message", ""))
-        except json.JSONDecodeError:
-            continue
-        for inner in message.get("Records", []):
-            if "s3" in inner:
-                yield inner
+# Folder fan-out: images encoded at once (each holds a decoded original in memory)
+# and the time left for in-flight work before leftover keys are handed back.
+FOLDER_WORKERS = int(os.environ.get("FOLDER_WORKERS", "2"))
+FOLDER_TIME_RESERVE_SECONDS = float(os.environ.get("FOLDER_TIME_RESERVE_SECONDS", "120"))
 
 
 def lambda_handler(event, context):
+    label = f"new_webp_middle-{int(time.time() * 1000)}-{getattr(context, 'aws_request_id', 'local')}"
+    with maybe_profile(label, os.environ.get("BUCKET_NAME", "marcus-photograph-garage")):
+        if is_queue_event(event):
+            return handle_queue_batch(event, context)
+        return handle_event(event, context)
+
+
+def handle_queue_batch(event, context):
+    """Handle the messages of an SQS batch on one pipeline and report only the ones that failed."""
+    groups = [
+        (message["messageId"], coalesce_records(message_event["Records"]))
+        for message, message_event in coalesce_queue_messages(event["Records"])
+    ]
+    failures = []
+    for message_id, error in handle_record_groups(groups, context):
+        failure = {"itemIdentifier": message_id}
+        if failure not in failures:
+            print(f"Failed message {message_id}: {error}")
+            failures.append(failure)
+    return {"batchItemFailures": failures}
+
+
+def handle_event(event, context):
+    errors = handle_record_groups([(None, coalesce_records(iter_s3_records(event)))], context)
+    if errors:
+        raise errors[0][1]
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps("Event processed successfully."),
+    }
+
+
+def handle_record_groups(groups, context):
+    """Handle [(owner, records)] on one ObjectPipeline and BatchDeleter.
+
+    A failed group does not stop the next one, and a group's uploads may still be
+    running while the next group is fetched and encoded. Returns [(owner, error)]
+    for every failure once all of them are done.
+    """
     bucket_name = os.environ.get("BUCKET_NAME", "marcus-photograph-garage")
     source_prefix = os.environ.get("SOURCE_PREFIX", "public")
     destination_prefix = os.environ.get("DEST_PREFIX", "public_middle")
@@ -53,13 +155,82 @@ def lambda_handler(event, context):
     large_image_mb = float(os.environ.get("LARGE_IMAGE_MB", "25"))
     quality_step = int(os.environ.get("QUALITY_STEP", "8"))
     max_quality_steps = int(os.environ.get("MAX_QUALITY_STEPS", "6"))
-
-    for record in iter_s3_records(event):
+    quality_search = os.environ.get("QUALITY_SEARCH", "bisect")
+    max_search_encodes = int(os.environ.get("MAX_SEARCH_ENCODES", "4"))
+    predict_quality = os.environ.get("PREDICT_QUALITY", "1") == "1"
+    cache = build_derivative_cache(bucket_name)
+
+    errors = []
+    deleter = BatchDeleter(bucket_name)
+    with ObjectPipeline() as pipeline:
+        for owner, records in groups:
+            pipeline.owner = owner
+            try:
+                handle_records(
+                    records,
+                    bucket_name,
+                    source_prefix,
+                    destination_prefix,
+                    target_size_kb,
+                    quality,
+                    min_quality,
+                    max_dim,
+                    min_target_ratio,
+                    fallback_min_quality,
+                    large_image_mb,
+                    quality_step,
+                    max_quality_steps,
+                    quality_search,
+                    max_search_encodes,
+                    predict_quality,
+                    cache,
+                    deleter,
+                    pipeline,
+                    context,
+                )
+                # The group's deletes land before its message is acknowledged.
+                deleter.drain()
+            except Exception as e:
+                errors.append((owner, e))
+        pipeline.wait()
+        errors.extend(pipeline.take_errors())
+    deleter.close()
+    return errors
+
+
+def handle_records(
+    records,
+    bucket_name,
+    source_prefix,
+    destination_prefix,
+    target_size_kb,
+    quality,
+    min_quality,
+    max_dim,
+    min_target_ratio,
+    fallback_min_quality,
+    large_image_mb,
+    quality_step,
+    max_quality_steps,
+    quality_search,
+    max_search_encodes,
+    predict_quality,
+    cache,
+    deleter,
+    pipeline,
+    context,
+):
+    for record in records:
         event_name = unquote_plus(record["eventName"])
         object_key = unquote_plus(record["s3"]["object"]["key"])
 
         if event_name.startswith("ObjectCreated:"):
+            # A delete queued by an earlier record must land before this write,
+            # or a removed-then-reuploaded key would lose its new derivative.
+            deleter.drain()
             if object_key.endswith("/"):
+                # A folder fans out on its own threads; let the pipeline empty first.
+                pipeline.wait()
                 process_folder(
                     bucket_name,
                     object_key,
@@ -74,6 +245,12 @@ def lambda_handler(event, context):
                     large_image_mb,
                     quality_step,
                     max_quality_steps,
+                    quality_search,
+                    max_search_encodes,
+                    predict_quality,
+                    cache,
+                    context=context,
+                    start_after=record.get("startAfter"),
                 )
             else:
                 process_object(
@@ -90,14 +267,17 @@ def lambda_handler(event, context):
                     large_image_mb,
                     quality_step,
                     max_quality_steps,
+                    quality_search,
+                    max_search_encodes,
+                    predict_quality,
+                    cache,
+                    object_size=record["s3"]["object"].get("size"),
+                    pipeline=pipeline,
                 )
         elif event_name.startswith("ObjectRemoved:"):
-            delete_destination(bucket_name, object_key, source_prefix, destination_prefix)
-
-    return {
-        "statusCode": 200,
-        "body": json.dumps("Event processed successfully."),
-    }
+            delete_destination(
+                bucket_name, object_key, source_prefix, destination_prefix, deleter
+            )
 
 
 def process_folder(
@@ -114,25 +294,36 @@ def process_folder(
     large_image_mb,
     quality_step,
     max_quality_steps,
+    quality_search,
+    max_search_encodes,
+    predict_quality,
+    cache=None,
+    context=None,
+    start_after=None,
 ):
-    paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix=folder_key):
-        for item in page.get("Contents", []):
-            process_object(
-                bucket,
-                item["Key"],
-                source_prefix,
-                destination_prefix,
-                target_size_kb,
-                quality,
-                min_quality,
-                max_dim,
-                min_target_ratio,
-                fallback_min_quality,
-                large_image_mb,
-                quality_step,
-                max_quality_steps,
-            )
+    def convert(item):
+        process_object(
+            bucket,
+            item["Key"],
+            source_prefix,
+            destination_prefix,
+            target_size_kb,
+            quality,
+            min_quality,
+            max_dim,
+            min_target_ratio,
+            fallback_min_quality,
+            large_image_mb,
+            quality_step,
+            max_quality_steps,
+            quality_search,
+            max_search_encodes,
+            predict_quality,
+            cache,
+            object_size=item["Size"],
+        )
+
+    fan_out(bucket, folder_key, convert, context, start_after, FOLDER_WORKERS, FOLDER_TIME_RESERVE_SECONDS)
 
 
 def process_object(
@@ -149,52 +340,324 @@ def process_object(
     large_image_mb,
     quality_step,
     max_quality_steps,
+    quality_search,
+    max_search_encodes,
+    predict_quality,
+    cache=None,
+    object_size=None,
+    pipeline=None,
 ):
     if not object_key.startswith(f"{source_prefix}/"):
         return
 
-    if not is_image_key(object_key):
+    if not is_middle_image_key(object_key):
         return
 
     destination_key = build_destination_key(
         object_key, source_prefix, destination_prefix
     )
+    compress_options = {
+        "target_size_kb": target_size_kb,
+        "quality": quality,
+        "min_quality": min_quality,
+        "max_dim": max_dim,
+        "min_target_ratio": min_target_ratio,
+        "fallback_min_quality": fallback_min_quality,
+        "large_image_mb": large_image_mb,
+        "quality_step": quality_step,
+        "max_quality_steps": max_quality_steps,
+        "quality_search": quality_search,
+        "max_search_encodes": max_search_encodes,
+        "predict_quality": predict_quality,
+    }
 
-    response = s3.get_object(Bucket=bucket, Key=object_key)
-    image_content = response["Body"].read()
-
-    compressed_content = compress_to_webp(
-        image_content,
-        target_size_kb=target_size_kb,
-        quality=quality,
-        min_quality=min_quality,
-        max_dim=max_dim,
-        min_target_ratio=min_target_ratio,
-        fallback_min_quality=fallback_min_quality,
-        large_image_mb=large_image_mb,
-        quality_step=quality_step,
-        max_quality_steps=max_quality_steps,
-    )
+    job = ObjectJob(bucket, object_key, destination_key, compress_options, cache, object_size)
+    if pipeline is not None:
+        pipeline.submit(job)
+        return
+    try:
+        job.fetch()
+        if not job.done:
+            job.encode()
+            job.upload()
+    except BaseException:
+        job.finish(failed=True)
+        raise
+    job.finish()
+
+
+class ObjectJob:
+    """One process_object run, split into fetch (HEAD, cache, GET), encode and
+    upload so ObjectPipeline can run the steps of different objects at once.
+    """
+
+    def __init__(self, bucket, object_key, destination_key, compress_options, cache=None, object_size=None):
+        self.bucket = bucket
+        self.object_key = object_key
+        self.destination_key = destination_key
+        self.compress_options = compress_options
+        self.cache = cache
+        self.object_size = object_size
+        self.cache_key = None
+        # The original once fetched, then the WebP once encoded.
+        self.content = None
+        self.done = False
+        # Set by ObjectPipeline.submit(): whose failure this job is, e.g. an SQS message.
+        self.owner = None
+        self.run = RunMetrics("process_object", object_key)
+
+    def fetch(self):
+        run = self.run
+        with bind_run(run):
+            # Moved/re-uploaded originals keep their bytes: a HEAD is enough to find the
+            # cached WebP for single-part uploads, before paying for the GET and encode.
+            etag = etag_hash = None
+            if self.cache is not None:
+                with run.stage("head"):
+                    head = s3.head_object(Bucket=self.bucket, Key=self.object_key)
+                etag = head["ETag"]
+                etag_hash = etag_content_hash(etag)
+                self.object_size = head["ContentLength"]
+                with run.stage("cache_restore"):
+                    restored = etag_hash and self.cache.restore(
+                        derivative_cache_key(etag_hash, self.compress_options, ".webp"),
+                        self.bucket,
+                        self.destination_key,
+                        "image/webp",
+                    )
+                if restored:
+                    run.set(outcome="cache_hit", input_bytes=self.object_size)
+                    self.done = True
+                    return
+
+            with run.stage("download"):
+                self.content = download_object(self.bucket, self.object_key, self.object_size, etag)
+            run.set(input_bytes=len(self.content))
+
+            if self.cache is not None:
+                with run.stage("cache_restore"):
+                    source_hash = hashlib.md5(self.content).hexdigest()
+                    self.cache_key = derivative_cache_key(source_hash, self.compress_options, ".webp")
+                    restored = source_hash != etag_hash and self.cache.restore(
+                        self.cache_key, self.bucket, self.destination_key, "image/webp"
+                    )
+                if restored:
+                    run.set(outcome="cache_hit")
+                    self.content = None
+                    self.done = True
+
+    def encode(self):
+        with bind_run(self.run), self.run.stage("compress"):
+            self.content = compress_to_webp(self.content, **self.compress_options)
+        self.run.set(outcome="encoded", output_bytes=len(self.content))
+
+    def upload(self):
+        run = self.run
+        with bind_run(run):
+            with run.stage("upload"):
+                s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.destination_key,
+                    Body=self.content,
+                    ContentType="image/webp",
+                )
 
-    s3.put_object(
-        Bucket=bucket,
-        Key=destination_key,
-        Body=compressed_content,
-        ContentType="image/webp",
-    )
+            if self.cache_key is not None:
+                with run.stage("cache_store"):
+                    self.cache.store(self.cache_key, self.content, "image/webp")
+        self.content = None
+
+    def finish(self, failed=False):
+        if failed:
+            self.run.set(outcome="error")
+        self.run.finish()
+        emit_metrics(self.run)
+
+
+class ObjectPipeline:
+    """Overlap the GETs, encodes and PUTs of consecutive ObjectJobs.
+
+    submit() starts fetching a job on one of `prefetch` threads and encodes the
+    oldest fetched jobs on the calling thread once more than `prefetch` are queued,
+    so downloads run while the CPU encodes; each WebP is uploaded on one of
+    `upload_workers` threads. Bytes held by fetched originals and pending WebPs are
+    reserved from a ByteBudget: when it is full, submit() encodes queued jobs (or
+    waits for uploads) before fetching more. A failed job does not stop the others;
+    its error is kept with the `owner` the pipeline had when the job was submitted,
+    so the messages of an SQS batch can share one pipeline. wait() waits for
+    everything submitted, take_errors() returns [(owner, error)] so far and flush()
+    waits and re-raises the first error.
+    """
+
+    def __init__(self, prefetch=None, upload_workers=None, budget_bytes=None):
+        self.prefetch = max(0, PIPELINE_PREFETCH if prefetch is None else prefetch)
+        self.upload_workers = max(1, PIPELINE_UPLOAD_WORKERS if upload_workers is None else upload_workers)
+        self.budget = ByteBudget(PIPELINE_BUDGET_BYTES if budget_bytes is None else budget_bytes)
+        self.fetch_executor = None
+        self.upload_executor = None
+        self.fetching = deque()
+        self.uploads = []
+        self.errors = []
+        self.owner = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.shutdown()
 
+    def submit(self, job):
+        reserved = job.object_size or 0
+        while not self.budget.try_acquire(reserved):
+            if self.fetching:
+                self.encode_next()
+            else:
+                # Only uploads hold bytes now, and they free them on their own.
+                self.budget.acquire(reserved)
+                break
+        if self.fetch_executor is None:
+            self.fetch_executor = ThreadPoolExecutor(max_workers=max(1, self.prefetch))
+        job.owner = self.owner
+        future = self.fetch_executor.submit(self.fetch, job, reserved)
+        self.fetching.append((job, future))
+        while len(self.fetching) > self.prefetch:
+            self.encode_next()
+
+    def fetch(self, job, reserved):
+        """Fetch on a prefetch thread; returns the bytes the job now holds."""
+        try:
+            job.fetch()
+        except BaseException:
+            self.budget.release(reserved)
+            raise
+        held = len(job.content) if job.content is not None else 0
+        self.budget.resize(reserved, held)
+        return held
+
+    def encode_next(self):
+        job, future = self.fetching.popleft()
+        try:
+            held = future.result()
+        except Exception as e:
+            self.fail(job, e)
+            return
+        if job.done:
+            job.finish()
+            return
+        try:
+            job.encode()
+        except Exception as e:
+            self.budget.release(held)
+            self.fail(job, e)
+            return
+        encoded = len(job.content)
+        self.budget.resize(held, encoded)
+        if self.upload_executor is None:
+            self.upload_executor = ThreadPoolExecutor(max_workers=self.upload_workers)
+        self.uploads.append((job, self.upload_executor.submit(self.upload, job, encoded)))
+
+    def upload(self, job, held):
+        try:
+            job.upload()
+        except BaseException:
+            job.finish(failed=True)
+            raise
+        finally:
+            self.budget.release(held)
+        job.finish()
+
+    def fail(self, job, error):
+        print(f"Failed to process {job.object_key}: {error}")
+        job.finish(failed=True)
+        self.errors.append((job.owner, error))
+
+    def wait(self):
+        while self.fetching:
+            self.encode_next()
+        uploads, self.uploads = self.uploads, []
+        for job, future in uploads:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to upload {job.destination_key}: {e}")
+                self.errors.append((job.owner, e))
+
+    def take_errors(self):
+        errors, self.errors = self.errors, []
+        return errors
+
+    def flush(self):
+        self.wait()
+        errors = self.take_errors()
+        if errors:
+            raise errors[0][1]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for executor in (self.fetch_executor, self.upload_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.fetch_executor = None
+        self.upload_executor = None
+
+
+class ByteBudget:
+    """Bytes reserved by in-flight work, capped at limit. One reservation is always
+    admitted when nothing else is held, so an object larger than the limit still runs.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self, size):
+        with self.condition:
+            if self.used and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.used or self.used + size <= self.limit)
+            self.used += size
+
+    def resize(self, old, new):
+        """Change a reservation without waiting (the bytes already exist)."""
+        with self.condition:
+            self.used += new - old
+            self.condition.notify_all()
+
+    def release(self, size):
+        self.resize(size, 0)
+
+
+def delete_destination(bucket, source_key, source_prefix, destination_prefix, deleter=None):
+    """Queue the WebP (or, for a folder, everything under its destination prefix)
+    on deleter; without one, delete right away.
+    """
+    if deleter is None:
+        with BatchDeleter(bucket) as own_deleter:
+            return delete_destination(
+                bucket, source_key, source_prefix, destination_prefix, own_deleter
+            )
 
-def delete_destination(bucket, source_key, source_prefix, destination_prefix):
-    destination_key = build_destination_key(source_key, source_prefix, destination_prefix)
     if source_key.endswith("/"):
-        paginator = s3.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=bucket, Prefix=destination_key):
-            for item in page.get("Contents", []):
-                s3.delete_object(Bucket=bucket, Key=item["Key"])
+        # Folders map prefix to prefix; build_destination_key would add ".webp".
+        deleter.add_prefix(f"{destination_prefix}{source_key[len(source_prefix):]}")
         return
 
-    if is_image_key(source_key):
-        s3.delete_object(Bucket=bucket, Key=destination_key)
+    if is_middle_image_key(source_key):
+        deleter.add(build_destination_key(source_key, source_prefix, destination_prefix))
 
 
 def build_destination_key(source_key, source_prefix, destination_prefix):
@@ -202,119 +665,3 @@ def build_destination_key(source_key, source_prefix, destination_prefix):
     destination_key = f"{destination_prefix}{relative_key}"
     base, _ = splitext(destination_key)
     return f"{base}.webp"
-
-
-def is_image_key(key):
-    _, ext = splitext(key)
-    return ext.lower() in IMAGE_EXTENSIONS
-
-
-def compress_to_webp(
-    image_content,
-    target_size_kb,
-    quality,
-    min_quality,
-    max_dim,
-    min_target_ratio,
-    fallback_min_quality,
-    large_image_mb,
-    quality_step,
-    max_quality_steps,
-):
-    image = Image.open(io.BytesIO(image_content))
-    image = ImageOps.exif_transpose(image)
-
-    if getattr(image, "is_animated", False):
-        image = ImageSequence.Iterator(image).__next__()
-
-    image = normalize_mode(image)
-    if len(image_content) > large_image_mb * 1024 * 1024:
-        image = ensure_max_dimension(image, max_dim)
-
-    if len(image_content) <= target_size_kb * 1024:
-        lossless = encode_webp(image, quality, lossless=True)
-        if len(lossless) <= target_size_kb * 1024:
-            return lossless
-
-    start_quality = quality
-    compressed = encode_webp(image, quality, lossless=False)
-    steps = 0
-    while (
-        len(compressed) > target_size_kb * 1024
-        and quality > min_quality
-        and steps < max_quality_steps
-    ):
-        quality = max(min_quality, quality - quality_step)
-        compressed = encode_webp(image, quality, lossless=False)
-        steps += 1
-
-    if len(compressed) > target_size_kb * 1024:
-        resized = ensure_max_dimension(image, max_dim)
-        if resized is not image:
-            quality = max(quality, min_quality)
-            compressed = encode_webp(resized, quality, lossless=False)
-            steps = 0
-            while (
-                len(compressed) > target_size_kb * 1024
-                and quality > min_quality
-                and steps < max_quality_steps
-            ):
-                quality = max(min_quality, quality - quality_step)
-                compressed = encode_webp(resized, quality, lossless=False)
-                steps += 1
-
-            min_target_bytes = int(target_size_kb * 1024 * min_target_ratio)
-            steps = 0
-            while len(compressed) < min_target_bytes and quality < start_quality:
-                quality = min(start_quality, quality + quality_step)
-                compressed = encode_webp(resized, quality, lossless=False)
-                steps += 1
-                if steps >= max_quality_steps:
-                    break
-        else:
-            steps = 0
-            while (
-                len(compressed) > target_size_kb * 1024
-                and quality > fallback_min_quality
-                and steps < max_quality_steps
-            ):
-                quality = max(fallback_min_quality, quality - quality_step)
-                compressed = encode_webp(image, quality, lossless=False)
-                steps += 1
-
-    return compressed
-
-
-def ensure_max_dimension(image, max_dim):
-    width, height = image.size
-    if max(width, height) <= max_dim:
-        return image
-
-    if width >= height:
-        new_width = max_dim
-        new_height = int(height * (max_dim / width))
-    else:
-        new_height = max_dim
-        new_width = int(width * (max_dim / height))
-
-    return image.resize((new_width, new_height), Image.LANCZOS)
-
-
-def normalize_mode(image):
-    if image.mode in {"RGBA", "LA"}:
-        return image.convert("RGBA")
-    if image.mode != "RGB":
-        return image.convert("RGB")
-    return image
-
-
-def encode_webp(image, quality, lossless):
-    output = io.BytesIO()
-    image.save(
-        output,
-        format="WEBP",
-        quality=quality,
-        method=6,
-        lossless=lossless,
-    )
-    return output.getvalue()
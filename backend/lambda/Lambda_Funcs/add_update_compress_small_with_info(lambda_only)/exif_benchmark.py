@@ -0,0 +1,159 @@
+# usage: python exif_benchmark.py [--corpus DIR] [--repeat 5]
+# micro-benchmark of the EXIF readers behind _info.json:
+#   fast   - new_piexifV3.find_exif_segment + parse_exif_segment
+#   piexif - piexif.load + get_exif_data_from_dict (the previous path)
+#   pillow - Image.open(...).getexif() + the Exif IFD (old_pillow.py)
+# --corpus reads every .jpg/.jpeg under DIR (camera files); without it a
+# deterministic synthetic corpus with camera-like EXIF (MakerNote, thumbnail,
+# GPS) is generated in memory.
+
+import argparse
+import io
+import os
+import random
+import time
+
+import piexif
+from PIL import Image
+
+from new_piexifV3 import (
+    find_exif_segment,
+    get_exif_data_from_dict,
+    parse_exif_segment,
+)
+
+
+FIELDS = (
+    "Exposure Time", "F Number", "ISO Speed", "Focal Length", "Flash",
+    "Date Taken", "Camera Make", "Camera Model", "Lens",
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EXIF extraction.")
+    parser.add_argument("--corpus")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.count)
+    if not corpus:
+        raise SystemExit("No JPEG files found.")
+    print(f"{len(corpus)} files, {sum(map(len, corpus)) / len(corpus) / 1024:.0f} KB average")
+
+    mismatches = 0
+    for data in corpus:
+        fast = read_fast(data)
+        reference = read_piexif(data)
+        if {k: fast.get(k) for k in FIELDS} != {k: reference.get(k) for k in FIELDS}:
+            mismatches += 1
+    print(f"fast vs piexif mismatches: {mismatches}")
+
+    results = {}
+    for name, reader in (("fast", read_fast), ("piexif", read_piexif), ("pillow", read_pillow)):
+        best = min(time_pass(reader, corpus) for _ in range(args.repeat))
+        results[name] = best
+    baseline = results["piexif"]
+    print(f"{'reader':<8} {'us/file':>10} {'files/s':>10} {'vs piexif':>10}")
+    for name, seconds in results.items():
+        per_file = seconds / len(corpus)
+        print(
+            f"{name:<8} {per_file * 1e6:>10.1f} {1 / per_file:>10.0f} "
+            f"{baseline / seconds:>9.1f}x"
+        )
+
+
+def time_pass(reader, corpus):
+    start = time.perf_counter()
+    for data in corpus:
+        reader(data)
+    return time.perf_counter() - start
+
+
+def read_fast(data):
+    segment, _ = find_exif_segment(data)
+    return parse_exif_segment(segment) if segment is not None else {}
+
+
+def read_piexif(data):
+    exif_dict = piexif.load(data)
+    return get_exif_data_from_dict(exif_dict) if "Exif" in exif_dict else {}
+
+
+def read_pillow(data):
+    exif = Image.open(io.BytesIO(data)).getexif()
+    return dict(exif.get_ifd(0x8769))
+
+
+def load_corpus(directory):
+    corpus = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg"):
+                with open(os.path.join(root, name), "rb") as handle:
+                    corpus.append(handle.read())
+    return corpus
+
+
+def synthetic_corpus(count):
+    """Small images carrying the EXIF layout of a typical camera file."""
+    rng = random.Random(0)
+    thumbnail = io.BytesIO()
+    Image.new("RGB", (160, 120), (90, 120, 150)).save(thumbnail, "JPEG", quality=75)
+    corpus = []
+    for index in range(count):
+        exif_dict = {
+            "0th": {
+                piexif.ImageIFD.Make: b"Canon",
+                piexif.ImageIFD.Model: b"Canon EOS R5",
+                piexif.ImageIFD.Orientation: rng.choice((1, 6, 8)),
+                piexif.ImageIFD.XResolution: (72, 1),
+                piexif.ImageIFD.YResolution: (72, 1),
+                piexif.ImageIFD.DateTime: b"2024:04:01 10:00:00",
+                piexif.ImageIFD.Artist: b"",
+                piexif.ImageIFD.Copyright: b"",
+            },
+            "Exif": {
+                piexif.ExifIFD.ExposureTime: (1, rng.choice((60, 125, 250, 1000))),
+                piexif.ExifIFD.FNumber: (rng.choice((14, 28, 40, 80)), 10),
+                piexif.ExifIFD.ISOSpeedRatings: rng.choice((100, 400, 3200)),
+                piexif.ExifIFD.DateTimeOriginal: b"2024:04:01 10:00:00",
+                piexif.ExifIFD.DateTimeDigitized: b"2024:04:01 10:00:00",
+                piexif.ExifIFD.ShutterSpeedValue: (6965784, 1000000),
+                piexif.ExifIFD.ApertureValue: (2970854, 1000000),
+                piexif.ExifIFD.ExposureBiasValue: (0, 1),
+                piexif.ExifIFD.MeteringMode: 5,
+                piexif.ExifIFD.Flash: rng.choice((0, 1, 16)),
+                piexif.ExifIFD.FocalLength: (rng.choice((24, 50, 85)), 1),
+                piexif.ExifIFD.MakerNote: bytes(rng.getrandbits(8) for _ in range(8192)),
+                piexif.ExifIFD.UserComment: b"\x00" * 264,
+                piexif.ExifIFD.ColorSpace: 1,
+                piexif.ExifIFD.PixelXDimension: 8192,
+                piexif.ExifIFD.PixelYDimension: 5464,
+                piexif.ExifIFD.FocalPlaneXResolution: (8192000, 1419),
+                piexif.ExifIFD.FocalPlaneYResolution: (5464000, 947),
+                piexif.ExifIFD.LensModel: b"RF24-70mm F2.8 L IS USM",
+                piexif.ExifIFD.LensSerialNumber: b"0000000000",
+            },
+            "GPS": {
+                piexif.GPSIFD.GPSLatitudeRef: b"N",
+                piexif.GPSIFD.GPSLatitude: ((47, 1), (36, 1), (index, 100)),
+                piexif.GPSIFD.GPSLongitudeRef: b"W",
+                piexif.GPSIFD.GPSLongitude: ((122, 1), (19, 1), (index, 100)),
+            },
+            "1st": {
+                piexif.ImageIFD.JPEGInterchangeFormat: 0,
+                piexif.ImageIFD.JPEGInterchangeFormatLength: 0,
+            },
+            "thumbnail": thumbnail.getvalue(),
+        }
+        output = io.BytesIO()
+        Image.new("RGB", (64, 48), (index % 256, 80, 160)).save(
+            output, "JPEG", exif=piexif.dump(exif_dict)
+        )
+        corpus.append(output.getvalue())
+    return corpus
+
+
+if __name__ == "__main__":
+    main()
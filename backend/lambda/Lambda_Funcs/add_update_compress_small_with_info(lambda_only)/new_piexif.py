@@ -1,8 +1,17 @@
 import json
+import os
+import sys
 import boto3
 import piexif
 import io
 
+# 读取 APP1 段的代码与其他处理函数共用 ../shared/exif_segment.py, 部署时一起打包 (或放进层)
+try:
+    from exif_segment import read_exif_segment
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+    from exif_segment import read_exif_segment
+
 # 初始化 S3 客户端
 s3 = boto3.client('s3')
 
@@ -23,12 +32,11 @@ def lambda_handler(event, context):
     bucket_name = 'marcus-photograph-garage'  # 更改为你的S3桶名
 
     try:
-        # 从S3获取图片
-        response = s3.get_object(Bucket=bucket_name, Key=photo_key)
-        image_content = response['Body'].read()
+        # 只读取图片开头的 APP1 段, 不下载整张原图
+        segment = read_exif_segment(s3, bucket_name, photo_key)
 
         # 使用piexif读取EXIF信息
-        exif_dict = piexif.load(image_content)
+        exif_dict = piexif.load(segment) if segment is not None else {'Exif': {}}
 
         # 提取和转换EXIF信息
         exif_data = get_exif_data_from_dict(exif_dict)
@@ -1,121 +1,497 @@
 import json
+import hashlib
 import boto3
 import piexif
 import io
-import tempfile
+import math
 import os
+import random
+import struct
+import sys
+import threading
+import time
 from os.path import splitext
 from urllib.parse import unquote_plus
-from PIL import Image
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
+
+# public_middle 的 WebP 压缩、指标、性能分析、批量删除和派生缓存与 new_webp_middle 共用 ../shared/photo_pipeline.py,
+# APP1 段的查找与 new_piexif 共用 ../shared/exif_segment.py, 紧凑索引与回填脚本共用 ../shared/compact_index.py;
+# 部署时把它们和本文件一起打包 (或放进层); 在仓库里直接运行时从 ../shared 导入
+try:
+    import photo_pipeline
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+    import photo_pipeline
+from compact_index import COMPACT_INDEX_KEY, build_compact_index, write_compact_index
+from exif_segment import find_exif_segment
+# METRICS_SINKS 供导入本模块的脚本添加 MetricsAggregator
+from photo_pipeline import (
+    METRICS_SINKS,
+    BatchDeleter,
+    build_derivative_cache,
+    build_proxy_mosaic,
+    coalesce_queue_messages,
+    coalesce_records,
+    compress_image_to_webp,
+    compress_to_webp,
+    derivative_cache_key,
+    etag_content_hash,
+    fan_out,
+    is_middle_image_key,
+    is_queue_event,
+    iter_s3_records,
+    maybe_profile,
+    metrics_count,
+    metrics_prefix,
+    metrics_set,
+    metrics_stage,
+    scaled_size,
+    solve_quality_curve,
+    track_run,
+)
 
 s3 = boto3.client('s3')
 INDEX_KEY = "public_small/photo_list_tracker.json"
+# public_small 缩略图、_info.json 和索引只处理这些格式; public_middle WebP 的格式见 photo_pipeline.MIDDLE_IMAGE_EXTENSIONS
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
 
+# 索引布局: legacy 只写整库的 photo_list_tracker.json; sharded 按文件夹分片,
+# 每个事件只改动对应文件夹的分片和很小的 manifest; both 两者都写 (迁移期间使用)
+INDEX_LAYOUT = os.environ.get('INDEX_LAYOUT', 'legacy')
+INDEX_SHARD_PREFIX = "public_small/photo_index"
+INDEX_MANIFEST_KEY = f"{INDEX_SHARD_PREFIX}/manifest.json"
+# 索引写入冲突 (并发调用) 时的最大重试次数和退避基数
+INDEX_MAX_RETRIES = 8
+INDEX_RETRY_BASE_SECONDS = 0.05
+# 紧凑索引: 公共 base_url + 按文件夹嵌套的相对路径, 另写 .gz/.br 预压缩变体 (需要 legacy 或 both 布局)
+INDEX_COMPACT = os.environ.get('INDEX_COMPACT', '0') == '1'
+# 索引文件写入时附带的内容哈希 (用户元数据 x-amz-meta-content-sha256)
+INDEX_HASH_METADATA = 'content-sha256'
 
-def iter_s3_records(event):
-    for record in event.get('Records', []):
-        if 's3' in record:
-            yield record
-            continue
-        sns = record.get('Sns')
-        if not sns:
-            continue
-        try:
-            message = json.loads(sns.get('Message', ''))
-        except json.JSONDecodeError:
-            continue
-        for inner in message.get('Records', []):
-            if 's3' in inner:
-                yield inner
+# 每个文件夹一个元数据包 public_small/<文件夹>/_metadata.json (EXIF、像素尺寸、各派生文件字节数),
+# 前端打开相册只需一次请求, 不必逐张读取 _info.json
+METADATA_BUNDLES = os.environ.get('METADATA_BUNDLES', '0') == '1'
+METADATA_BUNDLE_NAME = "_metadata.json"
+# 缓存命中时只读取原图开头这么多字节来获取尺寸
+METADATA_HEADER_BYTES = 64 * 1024
+# _info.json 由 parse_exif_segment 直接读取需要的标签; 设为 0 时退回 piexif.load 全量解析
+FAST_EXIF = os.environ.get('FAST_EXIF', '1') == '1'
+# GPS 会暴露拍摄地点, 默认不写入公开的 _info.json
+EXIF_INCLUDE_GPS = os.environ.get('EXIF_INCLUDE_GPS', '0') == '1'
+
+# 质量预测: 从缩略图上取 PROXY_GRID x PROXY_GRID 个小块拼成代理图,
+# 用几个质量编码代理图来拟合 bytes-per-pixel 曲线, 预测值预留 PROXY_MARGIN 余量;
+# 小块边长低于 PROXY_MIN_TILE 时 (JPEG 头部开销占比过大) 不做预测
+PROXY_GRID = 4
+PROXY_MIN_TILE = 64
+PROXY_MARGIN = 0.95
+PROXY_ACCEPT_RATIO = 0.85
+
+# 缩放: 非 JPEG 用 Image.reduce 预缩小的余量; 缩略图 JPEG 草稿解码保留的倍数
+RESIZE_REDUCING_GAP = 3.0
+THUMB_DRAFT_GAP = 2
+
+# 两档编码强度 (WebP 见 photo_pipeline): JPEG 质量搜索用基线编码, 只对选定的质量做一次
+# optimize + progressive 最终编码; 搜索目标按 "最终/搜索" 体积比换算, 比值从初始值开始, 跟随最近图片的实测值
+JPEG_EFFORT_RATIO = float(os.environ.get('JPEG_EFFORT_RATIO', '0.85'))
+EFFORT_RATIO_SMOOTHING = 0.2
+
+_jpeg_effort_ratio = JPEG_EFFORT_RATIO
+# 文件夹并发处理时多个线程同时更新比值
+_jpeg_effort_lock = threading.Lock()
+
+# 统一派生流水线: 原图只下载和解码一次, 同时生成 public_small、public_middle 与 _info.json
+# 开启后应关闭 new_webp_middle 的 S3 触发器
+UNIFIED_PIPELINE = os.environ.get('UNIFIED_PIPELINE', '0') == '1'
+MIDDLE_PREFIX = os.environ.get('MIDDLE_PREFIX', 'public_middle')
+MIDDLE_SETTINGS = {
+    'target_size_kb': int(os.environ.get('MIDDLE_TARGET_SIZE_KB', '1024')),
+    'quality': int(os.environ.get('MIDDLE_WEBP_QUALITY', '86')),
+    'min_quality': int(os.environ.get('MIDDLE_MIN_QUALITY', '60')),
+    'max_dim': int(os.environ.get('MIDDLE_MAX_DIM', '3000')),
+    'min_target_ratio': float(os.environ.get('MIDDLE_MIN_TARGET_RATIO', '0.6')),
+    'fallback_min_quality': int(os.environ.get('MIDDLE_FALLBACK_MIN_QUALITY', '40')),
+    'large_image_mb': float(os.environ.get('MIDDLE_LARGE_IMAGE_MB', '25')),
+    'quality_step': int(os.environ.get('MIDDLE_QUALITY_STEP', '8')),
+    'max_quality_steps': int(os.environ.get('MIDDLE_MAX_QUALITY_STEPS', '6')),
+    'quality_search': os.environ.get('MIDDLE_QUALITY_SEARCH', 'bisect'),
+    'max_search_encodes': int(os.environ.get('MIDDLE_MAX_SEARCH_ENCODES', '4')),
+    'predict_quality': os.environ.get('MIDDLE_PREDICT_QUALITY', '1') == '1',
+}
+
+# 派生文件缓存: 以原图内容哈希和压缩参数为键, 相同字节的移动/重复上传直接复制已有结果
+# 修改压缩算法后递增 photo_pipeline.DERIVATIVE_CACHE_VERSION 使旧缓存失效
+# FAST_EXIF 的两条路径输出相同, 不计入缓存参数
+INFO_CACHE_PARAMS = {'derivative': 'info', 'gps': EXIF_INCLUDE_GPS}
+SMALL_CACHE_PARAMS = {'derivative': 'public_small', 'target_size_kb': 100, 'max_iterations': 10,
+                      'predict_quality': True}
+# 统一流水线的缩略图经过 exif_transpose, 与 create_info_file 的结果不同, 需分开缓存
+UNIFIED_SMALL_CACHE_PARAMS = dict(SMALL_CACHE_PARAMS, exif_transpose=True)
+MIDDLE_CACHE_PARAMS = dict(MIDDLE_SETTINGS, derivative='public_middle')
+
+# 文件夹上传并发处理: 边分页列举边在 FOLDER_WORKERS 个线程上处理;
+# Lambda 剩余时间少于 FOLDER_TIME_RESERVE_SECONDS 时不再开始新的键, 带 startAfter 游标异步重新调用自身处理剩余部分
+# (需要对自身的 lambda:InvokeFunction 权限)
+FOLDER_WORKERS = int(os.environ.get('FOLDER_WORKERS', '4'))
+FOLDER_TIME_RESERVE_SECONDS = float(os.environ.get('FOLDER_TIME_RESERVE_SECONDS', '60'))
 
 
 def lambda_handler(event, context):
+    label = f"new_piexifV3-{int(time.time() * 1000)}-{getattr(context, 'aws_request_id', 'local')}"
+    with maybe_profile(label, 'marcus-photograph-garage'):
+        if is_queue_event(event):
+            return handle_queue_batch(event, context)
+        return handle_event(event, context)
+
+
+def handle_event(event, context):
     bucket_name = 'marcus-photograph-garage'  # 您的S3桶名
+    cache = build_derivative_cache(bucket_name)
+    # 本次调用的所有索引和元数据包变更先收集起来, 最后一次性写入
+    index_changes = []
+    metadata_changes = {}
+    # 连续的删除事件共用批次; 处理上传前先等已排队的删除完成, 以免删掉刚重新生成的派生文件
+    deleter = BatchDeleter(bucket_name)
+
+    # 先把整批事件归并到每个键的最终状态, 再做任何 S3 读写。
+    # 某条记录失败时, 之前的记录已写好派生文件: 照样完成删除并写入它们的索引变更, 再抛出异常让整批重试
+    try:
+        process_records(coalesce_records(iter_s3_records(event)), bucket_name, cache, deleter, context,
+                        index_changes, metadata_changes)
+    finally:
+        try:
+            deleter.close()
+        finally:
+            apply_index_changes(bucket_name, index_changes)
+            if METADATA_BUNDLES:
+                apply_metadata_changes(bucket_name, metadata_changes)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Event processed successfully.')
+    }
+
+
+def handle_queue_batch(event, context):
+    """
+    SQS 批次: 每条消息单独处理, 只把失败的消息 ID 放进 batchItemFailures,
+    事件源映射开启 ReportBatchItemFailures 后 SQS 只重投这些消息, 重试只花一张图片的代价。
+    成功消息的索引和元数据包变更仍合并到最后一次性写入; 这一步失败时整批重投 (派生文件已在缓存中)。
+    """
+    bucket_name = 'marcus-photograph-garage'
+    cache = build_derivative_cache(bucket_name)
+    index_changes = []
+    metadata_changes = {}
+    deleter = BatchDeleter(bucket_name)
+    failures = []
+
+    # 跨消息归并; 记录全被其他消息取代的消息不做任何工作直接成功
+    for message, message_event in coalesce_queue_messages(event['Records']):
+        message_index_changes = []
+        message_metadata_changes = {}
+        try:
+            process_records(coalesce_records(message_event['Records']), bucket_name, cache, deleter,
+                            context, message_index_changes, message_metadata_changes)
+            # 删除要在确认消息成功之前完成
+            deleter.drain()
+        except Exception as e:
+            print(f"Failed message {message.get('messageId')}: {e}")
+            failures.append({'itemIdentifier': message['messageId']})
+            continue
+        index_changes.extend(message_index_changes)
+        metadata_changes.update(message_metadata_changes)
 
-    for record in iter_s3_records(event):
+    deleter.close()
+    apply_index_changes(bucket_name, index_changes)
+    if METADATA_BUNDLES:
+        apply_metadata_changes(bucket_name, metadata_changes)
+
+    return {'batchItemFailures': failures}
+
+
+def process_records(records, bucket_name, cache, deleter, context, index_changes, metadata_changes):
+    """处理 S3 记录, 把索引变更追加到 index_changes, 元数据包变更写入 metadata_changes"""
+    for record in records:
         eventName = unquote_plus(record['eventName'])
         photo_key = unquote_plus(record['s3']['object']['key'])  # 获取触发事件的图片路径
         if not photo_key.startswith('public/'):
             continue
         
         if eventName.startswith('ObjectCreated:'):
+            deleter.drain()
             if photo_key.endswith('/'):  # 上传的是文件夹
                 # 创建对应的文件夹在public_small中
-                copy_folder_contents(bucket_name, photo_key, 'public', 'public_small')
-                update_index_for_prefix(bucket_name, photo_key)
+                metadata_changes.update(
+                    copy_folder_contents(bucket_name, photo_key, 'public', 'public_small', cache,
+                                         context=context, start_after=record.get('startAfter')))
+                index_changes.extend(index_changes_for_prefix(bucket_name, photo_key))
             else:
                 # 处理单个文件
                 photo_name, photo_extension = splitext(photo_key.split('/')[-1])
                 if photo_extension.lower() in IMAGE_EXTENSIONS:
-                    print("creating info file for:", photo_key)
-                    create_info_file(bucket_name, photo_key, photo_key.replace('public', 'public_small'))
-                    update_index_for_key(bucket_name, photo_key)
+                    if UNIFIED_PIPELINE:
+                        print("processing derivatives for:", photo_key)
+                        metadata_changes[photo_key] = process_upload(bucket_name, photo_key, cache)
+                    else:
+                        print("creating info file for:", photo_key)
+                        metadata_changes[photo_key] = create_info_file(
+                            bucket_name, photo_key, photo_key.replace('public', 'public_small'), cache)
+                    index_changes.extend(index_changes_for_key(photo_key))
+                elif UNIFIED_PIPELINE and is_middle_image_key(photo_key):
+                    # 缩略图路径不处理的格式 (如 TIFF) 仍要生成 public_middle, 与 new_webp_middle 一致
+                    print("creating middle file for:", photo_key)
+                    create_middle_file(bucket_name, photo_key, cache)
         elif eventName.startswith('ObjectRemoved:'):
             # 处理文件或文件夹的删除
-            delete_folder_contents(bucket_name, photo_key)
+            delete_folder_contents(bucket_name, photo_key, deleter)
+            if UNIFIED_PIPELINE:
+                delete_middle_contents(bucket_name, photo_key, deleter)
             if photo_key.endswith('/'):
-                update_index_for_prefix(bucket_name, photo_key, remove=True)
+                index_changes.extend(index_changes_for_prefix(bucket_name, photo_key, remove=True))
             else:
-                update_index_for_key(bucket_name, photo_key, remove=True)
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Event processed successfully.')
-    }
+                index_changes.extend(index_changes_for_key(photo_key, remove=True))
+                if is_image_key(photo_key):
+                    metadata_changes[photo_key] = None
 
 
-def copy_folder_contents(bucket, folder_key, source_prefix, destination_prefix):
-    """复制文件夹内容到新的目标文件夹"""
-    # 列出文件夹内容
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=folder_key)
-    for item in response.get('Contents', []):
+def copy_folder_contents(bucket, folder_key, source_prefix, destination_prefix, cache=None,
+                         context=None, start_after=None):
+    """
+    为文件夹内容生成目标文件夹中的派生文件, 返回 {原图键名: 元数据条目}。
+    图片直接由 create_info_file 写入压缩图 (不再先整张复制原图再覆盖), 其他对象照旧复制;
+    context / start_after 见 fan_out。
+    """
+    def handle(item):
+        if is_image_key(item['Key']):
+            if UNIFIED_PIPELINE:
+                # 统一流水线直接生成所有派生文件
+                return process_upload(bucket, item['Key'], cache)
+            # 创建新键名以符合目标文件夹结构
+            new_key = item['Key'].replace(source_prefix, destination_prefix)
+            return create_info_file(bucket, item['Key'], new_key, cache)
+        if UNIFIED_PIPELINE:
+            # 缩略图路径不处理的格式 (如 TIFF) 只生成 public_middle
+            if is_middle_image_key(item['Key']):
+                create_middle_file(bucket, item['Key'], cache)
+            return None
         copy_source = {
             'Bucket': bucket,
             'Key': item['Key']
         }
-        # 创建新键名以符合目标文件夹结构
         new_key = item['Key'].replace(source_prefix, destination_prefix)
         s3.copy_object(Bucket=bucket, CopySource=copy_source, Key=new_key)
+        return None
 
-        # 如果是图片，则需要额外处理（例如创建信息文件）
-        if new_key.lower().endswith(tuple(IMAGE_EXTENSIONS)):
-            create_info_file(bucket, item['Key'], new_key)
+    results = fan_out(bucket, folder_key, handle, context, start_after, FOLDER_WORKERS, FOLDER_TIME_RESERVE_SECONDS)
+    return {key: entry for key, entry in results.items() if is_image_key(key)}
 
 
 def update_index_for_prefix(bucket, prefix, remove=False):
-    if remove:
-        existing = load_index(bucket)
-        base_url = f"https://{bucket}.s3.amazonaws.com/"
-        prefix_url = f"{base_url}{prefix}"
-        updated = [url for url in existing if not url.startswith(prefix_url)]
-        save_index(bucket, updated)
-        return
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    keys = [item['Key'] for item in response.get('Contents', [])]
-    image_keys = [key for key in keys if is_image_key(key)]
-    if image_keys:
-        update_index(bucket, image_keys, remove=remove)
+    apply_index_changes(bucket, index_changes_for_prefix(bucket, prefix, remove=remove))
 
 
 def update_index_for_key(bucket, key, remove=False):
-    if not is_image_key(key):
-        return
-    update_index(bucket, [key], remove=remove)
+    apply_index_changes(bucket, index_changes_for_key(key, remove=remove))
 
 
 def update_index(bucket, keys, remove=False):
-    existing = load_index(bucket)
-    updated = set(existing)
-    base_url = f"https://{bucket}.s3.amazonaws.com/"
-    urls = [f"{base_url}{key}" for key in keys]
+    apply_index_changes(bucket, [('remove' if remove else 'add', list(keys))])
+
+
+def index_changes_for_prefix(bucket, prefix, remove=False):
+    """文件夹事件对应的索引变更 (不做任何写入)"""
     if remove:
-        for url in urls:
-            updated.discard(url)
-    else:
-        for url in urls:
-            updated.add(url)
-    save_index(bucket, sorted(updated))
+        return [('remove_prefix', prefix)]
+    image_keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        image_keys.extend(item['Key'] for item in page.get('Contents', []) if is_image_key(item['Key']))
+    return [('add', image_keys)] if image_keys else []
+
+
+def index_changes_for_key(key, remove=False):
+    """单个文件事件对应的索引变更 (不做任何写入)"""
+    if not is_image_key(key):
+        return []
+    return [('remove' if remove else 'add', [key])]
+
+
+def apply_index_changes(bucket, changes):
+    """
+    一次性应用本次调用收集到的全部索引变更。
+    每个索引文件都用 ETag 做 compare-and-swap: 写入冲突时重新读取最新内容,
+    在其上重放同样的变更后重试, 这样并发调用不会互相覆盖。
+    """
+    if not changes:
+        return
+    base_url = f"https://{bucket}.s3.amazonaws.com/"
+    if INDEX_LAYOUT in ('legacy', 'both'):
+        urls = update_json_cas(
+            bucket,
+            INDEX_KEY,
+            lambda data: sorted(apply_url_changes(data if isinstance(data, list) else [], changes, base_url)),
+        )
+        if INDEX_COMPACT and urls is not None:
+            publish_compact_index(bucket, urls, base_url)
+    if INDEX_LAYOUT in ('sharded', 'both'):
+        apply_shard_changes(bucket, changes, base_url)
+
+
+def apply_url_changes(urls, changes, base_url):
+    """按顺序重放变更: add / remove 为键列表, remove_prefix 为文件夹前缀"""
+    updated = set(urls)
+    for op, value in changes:
+        if op == 'add':
+            updated.update(f"{base_url}{key}" for key in value)
+        elif op == 'remove':
+            updated.difference_update(f"{base_url}{key}" for key in value)
+        elif op == 'remove_prefix':
+            prefix_url = f"{base_url}{value}"
+            updated = {url for url in updated if not url.startswith(prefix_url)}
+    return updated
+
+
+def index_folder(key):
+    """图片所在的文件夹 (带结尾的 /), 即分片的单位"""
+    return key.rsplit('/', 1)[0] + '/'
+
+
+def index_shard_key(folder):
+    return f"{INDEX_SHARD_PREFIX}/{folder}_index.json"
+
+
+def apply_shard_changes(bucket, changes, base_url):
+    """
+    只读写受影响文件夹的分片, 最后合并一次 manifest。
+    分片: {"folder", "version", "urls"}; manifest: {"version", "folders": {folder: {"key", "count", "version"}}}
+    清空的文件夹保留 count 为 0 的条目, 保证 manifest 中的版本号单调, 迟到的旧写入不会把它复活。
+    """
+    folders = set()
+    for op, value in changes:
+        if op in ('add', 'remove'):
+            folders.update(index_folder(key) for key in value)
+    if any(op == 'remove_prefix' for op, _ in changes):
+        manifest = load_index_manifest(bucket)
+        for op, prefix in changes:
+            if op == 'remove_prefix':
+                folders.update(folder for folder in manifest['folders'] if folder.startswith(prefix))
+
+    written = {}
+    for folder in sorted(folders):
+        folder_changes = changes_for_folder(changes, folder)
+        if not folder_changes:
+            continue
+        shard = update_json_cas(
+            bucket,
+            index_shard_key(folder),
+            lambda data, folder=folder, folder_changes=folder_changes: next_shard(
+                data, folder, folder_changes, base_url),
+        )
+        if shard is not None:
+            written[folder] = {'key': index_shard_key(folder), 'count': len(shard['urls']),
+                               'version': shard['version']}
+
+    if written:
+        update_json_cas(bucket, INDEX_MANIFEST_KEY, lambda data: merge_manifest(data, written))
+
+
+def changes_for_folder(changes, folder):
+    selected = []
+    for op, value in changes:
+        if op == 'remove_prefix':
+            if folder.startswith(value):
+                selected.append((op, value))
+            continue
+        keys = [key for key in value if index_folder(key) == folder]
+        if keys:
+            selected.append((op, keys))
+    return selected
+
+
+def next_shard(data, folder, changes, base_url):
+    """返回新的分片内容; 内容没有变化时返回 None (不写入)"""
+    if not isinstance(data, dict) or not isinstance(data.get('urls'), list):
+        data = {'folder': folder, 'version': 0, 'urls': []}
+    updated = apply_url_changes(data['urls'], changes, base_url)
+    if updated == set(data['urls']):
+        return None
+    return {'folder': folder, 'version': data.get('version', 0) + 1, 'urls': sorted(updated)}
+
+
+def merge_manifest(data, written):
+    if not isinstance(data, dict) or not isinstance(data.get('folders'), dict):
+        data = {'version': 0, 'folders': {}}
+    for folder, entry in written.items():
+        current = data['folders'].get(folder)
+        if current is None or current.get('version', 0) < entry['version']:
+            data['folders'][folder] = entry
+    data['version'] = data.get('version', 0) + 1
+    return data
+
+
+def load_index_manifest(bucket):
+    data, _ = load_json_with_etag(bucket, INDEX_MANIFEST_KEY)
+    if not isinstance(data, dict) or not isinstance(data.get('folders'), dict):
+        return {'version': 0, 'folders': {}}
+    return data
+
+
+def update_json_cas(bucket, key, mutate):
+    """
+    读取 JSON 及其 ETag, 调用 mutate 得到新内容, 再用 If-Match (对象不存在时用 If-None-Match)
+    条件写入; 冲突 (412/409) 时退避后重新读取重试。mutate 返回 None 表示无需写入。
+    """
+    for attempt in range(INDEX_MAX_RETRIES):
+        data, etag = load_json_with_etag(bucket, key)
+        updated = mutate(data)
+        if updated is None:
+            return None
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        body = json.dumps(updated)
+        try:
+            s3.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body,
+                ContentType='application/json',
+                Metadata={INDEX_HASH_METADATA: content_sha256(body)},
+                **condition
+            )
+            return updated
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            print(f"Index write conflict on {key} (attempt {attempt + 1}), retrying")
+            time.sleep(random.uniform(0, INDEX_RETRY_BASE_SECONDS * 2 ** attempt))
+    raise RuntimeError(f"Gave up updating {key} after {INDEX_MAX_RETRIES} conflicting writes")
+
+
+def load_json_with_etag(bucket, key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+        return json.loads(response['Body'].read()), response['ETag']
+    except s3.exceptions.NoSuchKey:
+        return None, None
+
+
+def publish_compact_index(bucket, urls, base_url):
+    """
+    由刚写入的完整列表生成紧凑索引。若列表已被更新的调用改写, 跳过 (由那次调用负责发布),
+    避免旧内容覆盖新内容。比较的是写入时放进对象元数据的内容哈希:
+    SSE-KMS 加密或分段上传的对象 ETag 不是内容的 MD5, 不能拿来比较。
+    """
+    metadata = s3.head_object(Bucket=bucket, Key=INDEX_KEY).get('Metadata', {})
+    if metadata.get(INDEX_HASH_METADATA) != content_sha256(json.dumps(urls)):
+        print("Index changed since our write, leaving compact index to the newer writer")
+        return
+    keys = [url[len(base_url):] for url in urls if url.startswith(base_url)]
+    write_compact_index(s3, bucket, COMPACT_INDEX_KEY, build_compact_index(keys, base_url))
+
+
+def content_sha256(body):
+    return hashlib.sha256(body.encode()).hexdigest()
 
 
 def load_index(bucket):
@@ -144,57 +520,101 @@ def is_image_key(key):
     return ext.lower() in IMAGE_EXTENSIONS
 
 
-def compress_image_to_target(image_content, target_size_kb=100, max_iterations=10):
+def compress_image_to_target(image_content, target_size_kb=100, max_iterations=10, predict_quality=True):
     """
     Compress an image to a target size using binary search for quality.
+    If predict_quality is set, the first probe uses the quality predicted from a
+    small tile mosaic, and any result within PROXY_ACCEPT_RATIO of the target is kept.
     """
     # Load the image
     image = Image.open(io.BytesIO(image_content))
     print("Image loaded, initial format and mode: {}, {}".format(image.format, image.mode))
 
-    # Convert RGBA to RGB if necessary
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-        print("Converted RGBA to RGB.")
+    return compress_loaded_image_to_target(image, len(image_content), target_size_kb, max_iterations, predict_quality)
+
 
+def compress_loaded_image_to_target(image, source_size, target_size_kb=100, max_iterations=10, predict_quality=True,
+                                    decode_scale=1.0):
+    """
+    Same as compress_image_to_target, for an image that may already be decoded.
+    source_size is the byte size of the original object and drives the scale factor;
+    decode_scale is original width / current width when the caller already drafted
+    the image down, so the thumbnail keeps the size it would have had.
+    """
     # Estimate the initial scale factor based on current size and target size
-    initial_size_kb = len(image_content) / 1024
+    initial_size_kb = source_size / 1024
     scale_factor = (target_size_kb / initial_size_kb) ** 0.5  # Square root to adjust both dimensions
 
     # Use a continuous function to ensure scale factor is sensible
     scale_factor = max(0.1, min(scale_factor, 1))  # No enlarging, and minimum reduction to 10%
+    # 调用方已缩小解码时换算到当前图片尺寸 (仍不放大)
+    scale_factor = min(scale_factor * decode_scale, 1)
 
-    # Apply scaling
     new_width = int(image.width * scale_factor)
     new_height = int(image.height * scale_factor)
-    image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+    # JPEG 尚未解码时, 让解码器直接做 DCT 缩放 (1/2, 1/4, 1/8), 保留 THUMB_DRAFT_GAP 倍余量给 LANCZOS;
+    # 已解码或非 JPEG 时为空操作
+    with metrics_stage('small_decode'):
+        image.draft(None, (new_width * THUMB_DRAFT_GAP, new_height * THUMB_DRAFT_GAP))
+        image.load()
+
+    # Convert RGBA to RGB if necessary
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+        print("Converted RGBA to RGB.")
+    elif image.mode not in ('RGB', 'L'):
+        print("Converting {} to RGB.".format(image.mode))
+        image = image.convert('RGB')
+
+    # Apply scaling (非 JPEG 先用 Image.reduce 整数倍缩小, 再做 LANCZOS)
+    metrics_set(small_decoded_size=list(image.size))
+    with metrics_stage('small_resize'):
+        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    metrics_set(small_size=list(image.size))
     print("Resized image size (width x height):", image.size)
 
     # Initialize binary search parameters
     low, high = 10, 50  # Range of quality
     best_bytes = None
+    best_quality = None
+    # 搜索用基线编码, 目标换算成基线编码下的体积; tried 记录每个质量的搜索编码结果
+    search_target_kb = target_size_kb / _jpeg_effort_ratio
+    tried = {}
+
+    predicted = None
+    if predict_quality:
+        predicted = predict_jpeg_quality(image, search_target_kb * 1024, low, high)
+        print("Predicted quality from proxy tiles:", predicted)
+        if predicted is None:
+            # 缩略图太小无法采样, 完整编码本身就很便宜, 先试最高质量
+            predicted = high
 
     # Start binary search
     iteration = 0
     while low <= high and iteration < max_iterations:
-        mid = (low + high) // 2
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=mid)
-        size_kb = len(img_byte_arr.getvalue()) / 1024
+        mid = predicted if iteration == 0 and predicted is not None else (low + high) // 2
+        tried[mid] = encode_jpeg(image, mid)
+        size_kb = len(tried[mid]) / 1024
 
         # Logging the current state
         print("Iteration {}: Quality set to {}, resulting size: {:.2f} KB".format(iteration, mid, size_kb))
 
-        if size_kb < target_size_kb:
+        if predicted is not None and search_target_kb * PROXY_ACCEPT_RATIO <= size_kb <= search_target_kb:
+            print("Size within accepted band of target.")
+            return finalize_jpeg(image, mid, tried, target_size_kb * 1024)
+
+        if size_kb < search_target_kb:
             low = mid + 1
-            best_bytes = img_byte_arr.getvalue()
+            best_bytes = tried[mid]
+            best_quality = mid
             print("Size under target, adjusting quality up.")
-        elif size_kb > target_size_kb:
+        elif size_kb > search_target_kb:
             high = mid - 1
             print("Size over target, adjusting quality down.")
         else:
             print("Target size achieved exactly.")
-            return img_byte_arr.getvalue()
+            return finalize_jpeg(image, mid, tried, target_size_kb * 1024)
 
         iteration += 1
 
@@ -202,7 +622,93 @@ def compress_image_to_target(image_content, target_size_kb=100, max_iterations=1
         print("Returning best attempt under target size.")
     else:
         print("No valid compression found, returning last attempt.")
-    return best_bytes if best_bytes else img_byte_arr.getvalue()
+    return finalize_jpeg(image, best_quality if best_bytes else mid, tried, target_size_kb * 1024)
+
+
+def encode_jpeg(image, quality, final=False):
+    """搜索时用基线编码; final 时加 optimize + progressive, 像素相同, 只是熵编码更紧凑"""
+    stage = 'small_final_encode' if final else 'small_encode'
+    output = io.BytesIO()
+    with metrics_stage(stage):
+        if final:
+            image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        else:
+            image.save(output, format='JPEG', quality=quality)
+    metrics_count(f'{stage}s')
+    return output.getvalue()
+
+
+def finalize_jpeg(image, quality, tried, target_bytes, low=10):
+    """
+    对搜索选出的质量做一次最终编码 (optimize + progressive)。
+    tried 为 {质量: 基线编码结果}; 实测的 "最终/搜索" 体积比更新运行中的估计值。
+    最终编码超出 target_bytes 时修正一次: 用这张图自己的比值换算目标, 在 [low, quality - 1] 内
+    重新用基线编码二分查找, 再对结果做最终编码; 仍超标时退回不超标的最佳基线编码,
+    都超标时返回最小的一次编码。
+    """
+    global _jpeg_effort_ratio
+    final = encode_jpeg(image, quality, final=True)
+    ratio = len(final) / len(tried[quality])
+    with _jpeg_effort_lock:
+        _jpeg_effort_ratio += EFFORT_RATIO_SMOOTHING * (ratio - _jpeg_effort_ratio)
+    metrics_set(small_effort_ratio=round(ratio, 4))
+    finals = {quality: final}
+    if len(final) > target_bytes and quality > low:
+        corrected_bytes = target_bytes / ratio
+        fits = [q for q, data in tried.items() if q < quality and len(data) <= corrected_bytes]
+        best = max(fits) if fits else None
+        low, high = (best + 1 if fits else low), quality - 1
+        while low <= high:
+            mid = (low + high) // 2
+            if mid not in tried:
+                tried[mid] = encode_jpeg(image, mid)
+            if len(tried[mid]) <= corrected_bytes:
+                best, low = mid, mid + 1
+            else:
+                high = mid - 1
+        quality = best if best is not None else min(q for q in tried if q < quality)
+        final = encode_jpeg(image, quality, final=True)
+        finals[quality] = final
+
+    if len(final) > target_bytes:
+        fits = [q for q, data in tried.items() if len(data) <= target_bytes]
+        if fits:
+            quality = max(fits)
+            final = tried[quality]
+        else:
+            quality, final = min(
+                list(finals.items()) + list(tried.items()), key=lambda item: len(item[1])
+            )
+    metrics_set(small_quality=quality)
+    return final
+
+
+def predict_jpeg_quality(image, target_bytes, low, high):
+    """
+    用代理图预测使完整编码刚好低于 target_bytes 的 JPEG 质量。
+    代理图太小无法采样时返回 None, 交给常规二分查找。
+    """
+    tile_size = min(image.width, image.height) // (PROXY_GRID * 2) // 8 * 8
+    if tile_size < PROXY_MIN_TILE:
+        return None
+    # 小块按 8 像素对齐以保持 JPEG 分块
+    proxy = build_proxy_mosaic(image, tile_size, PROXY_GRID, align=8)
+    if proxy is None:
+        return None
+    proxy_pixels = proxy.width * proxy.height
+
+    samples = []
+    for quality in sorted({low, (low + high) // 2, high}):
+        proxy_bytes = io.BytesIO()
+        with metrics_stage('small_proxy_encode'):
+            proxy.save(proxy_bytes, format='JPEG', quality=quality)
+        metrics_count('small_proxy_encodes')
+        samples.append((quality, math.log(proxy_bytes.tell() / proxy_pixels)))
+
+    target_bpp = target_bytes * PROXY_MARGIN / (image.width * image.height)
+    return solve_quality_curve(samples, target_bpp, low, high)
+
+
 #legacy    
 def compress_image(image_content, target_size_kb=100, initial_quality=30):
     """
@@ -276,79 +782,474 @@ def compress_image_old(image_content, target_size_kb=100, quality=80, min_qualit
     print("Compression complete.")
     return img_byte_arr.getvalue()
     
-def create_info_file(bucket, source_key, destination_key):
+def create_info_file(bucket, source_key, destination_key, cache=None):
     """
     为图片创建信息文件。
     :param bucket: S3桶的名称
     :param source_key: 图片在S3上的键值 键名
     :param destination_key: 信息文件在S3上的键值
+    :param cache: 可选的派生文件缓存, 命中时直接复制已有的信息文件和压缩图
+    :return: 元数据包条目 (见 build_metadata_entry); 缓存命中且未开启元数据包时为 None
     """
     # 提取文件名，不包括扩展名
     photo_name, photo_extension = splitext(destination_key.split('/')[-1])
     info_file_key = destination_key.replace(photo_extension, '_info.json')  # 信息文件的完整键名 使用.json扩展名
+    outputs = [
+        (INFO_CACHE_PARAMS, '.json', info_file_key, 'application/json'),
+        (SMALL_CACHE_PARAMS, '.jpg', destination_key, 'image/jpeg'),
+    ]
 
-    # 获取源图片
-    response = s3.get_object(Bucket=bucket, Key=source_key)
-    image_content = response['Body'].read()
-        
-    # 将图像内容保存到临时文件
-    with tempfile.NamedTemporaryFile(delete=False) as temp_image:
-        temp_image.write(image_content)
-        temp_image_path = temp_image.name
-        
-    #=========================EXIF info===========================
-    # 初始化为空的EXIF数据字典
+    with track_run('create_info_file', source_key) as run:
+        etag_hash = None
+        if cache is not None:
+            with run.stage('head'):
+                etag_hash = head_content_hash(bucket, source_key)
+            with run.stage('cache_restore'):
+                restored = etag_hash and restore_cached(cache, etag_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached derivatives for: {source_key}")
+                run.set(outcome='cache_hit')
+                return describe_restored_photo(bucket, source_key, outputs)
+
+        # 获取源图片
+        with run.stage('download'):
+            response = s3.get_object(Bucket=bucket, Key=source_key)
+            image_content = response['Body'].read()
+        run.set(input_bytes=len(image_content))
+
+        source_hash = None
+        if cache is not None:
+            with run.stage('cache_restore'):
+                source_hash = hashlib.md5(image_content).hexdigest()
+                restored = source_hash != etag_hash and restore_cached(cache, source_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached derivatives for: {source_key}")
+                run.set(outcome='cache_hit')
+                return describe_restored_photo(bucket, source_key, outputs)
+
+        #=========================EXIF info===========================
+        # 初始化为空的EXIF数据字典
+        exif_data = {}
+        # 只有当文件是JPEG格式时，才尝试读取EXIF信息; 直接在内存中定位 APP1 段, 不再写临时文件
+        with run.stage('exif'):
+            if photo_extension.lower() in ['.jpg', '.jpeg']:
+                exif_data = exif_data_from_segment(find_exif_segment(image_content)[0])
+
+            # 序列化为JSON
+            info_content = json.dumps(exif_data, indent=4)
+        print(f"FIRST INFO path: {info_file_key}")
+        # 将信息文件上传到S3
+        with run.stage('info_upload'):
+            s3.put_object(Bucket=bucket, Key=info_file_key,
+                          Body=info_content, ContentType='application/json')
+
+        #=========================Image compression===========================
+
+        # 尝试压缩图片
+        with run.stage('small_compress'):
+            compressed_content = compress_image_to_target(image_content)
+        print(f"SECOND COMPRESSION path: {destination_key}")
+        # 将压缩后的图片上传到S3
+        with run.stage('small_upload'):
+            s3.put_object(Bucket=bucket, Key=destination_key, Body=compressed_content, ContentType='image/jpeg')
+        run.set(outcome='encoded', info_bytes=len(info_content), small_bytes=len(compressed_content))
+
+        if source_hash is not None:
+            with run.stage('cache_store'):
+                store_cached(cache, source_hash, outputs, [info_content, compressed_content])
+
+        return build_metadata_entry(
+            exif_data, Image.open(io.BytesIO(image_content)), len(image_content),
+            derivative_sizes(outputs, [info_content, compressed_content]))
+
+
+
+def process_upload(bucket, source_key, cache=None):
+    """
+    统一派生流水线: 原图只下载、解码、exif_transpose 各一次,
+    由同一张内存图片生成 public_small JPEG、public_middle WebP 和 _info.json。
+    键名布局与 create_info_file / build_destination_key 保持一致。
+    :param bucket: S3桶的名称
+    :param source_key: 原图在S3上的键名 (public/...)
+    :param cache: 可选的派生文件缓存, 三个派生文件都命中时不再下载原图
+    :return: 元数据包条目 (见 build_metadata_entry)
+    """
+    small_key = source_key.replace('public', 'public_small')
+    photo_name, photo_extension = splitext(small_key.split('/')[-1])
+    info_file_key = small_key.replace(photo_extension, '_info.json')
+    middle_key = build_destination_key(source_key, 'public', MIDDLE_PREFIX)
+    outputs = [
+        (INFO_CACHE_PARAMS, '.json', info_file_key, 'application/json'),
+        (UNIFIED_SMALL_CACHE_PARAMS, '.jpg', small_key, 'image/jpeg'),
+        (MIDDLE_CACHE_PARAMS, '.webp', middle_key, 'image/webp'),
+    ]
+
+    with track_run('process_upload', source_key) as run:
+        etag_hash = None
+        if cache is not None:
+            with run.stage('head'):
+                etag_hash = head_content_hash(bucket, source_key)
+            with run.stage('cache_restore'):
+                restored = etag_hash and restore_cached(cache, etag_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached derivatives for: {source_key}")
+                run.set(outcome='cache_hit')
+                return describe_restored_photo(bucket, source_key, outputs)
+
+        # 只下载一次原图
+        with run.stage('download'):
+            response = s3.get_object(Bucket=bucket, Key=source_key)
+            image_content = response['Body'].read()
+        run.set(input_bytes=len(image_content))
+
+        source_hash = None
+        if cache is not None:
+            with run.stage('cache_restore'):
+                source_hash = hashlib.md5(image_content).hexdigest()
+                restored = source_hash != etag_hash and restore_cached(cache, source_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached derivatives for: {source_key}")
+                run.set(outcome='cache_hit')
+                return describe_restored_photo(bucket, source_key, outputs)
+
+        #=========================EXIF info===========================
+        # 直接在内存中定位 APP1 段, 不再写临时文件
+        exif_data = {}
+        with run.stage('exif'):
+            if photo_extension.lower() in ['.jpg', '.jpeg']:
+                exif_data = exif_data_from_segment(find_exif_segment(image_content)[0])
+
+            info_content = json.dumps(exif_data, indent=4)
+        with run.stage('info_upload'):
+            s3.put_object(Bucket=bucket, Key=info_file_key,
+                          Body=info_content, ContentType='application/json')
+
+        #=========================Derivatives===========================
+        # 只解码并校正方向一次, 两个派生图共用同一张图片
+        with run.stage('decode'):
+            image = Image.open(io.BytesIO(image_content))
+            # 草稿解码会改变 image.size, 先记录原图尺寸
+            entry = build_metadata_entry(exif_data, image, len(image_content), {})
+            run.set(source_size=list(image.size))
+            decode_scale = 1.0
+            if len(image_content) > MIDDLE_SETTINGS['large_image_mb'] * 1024 * 1024:
+                # public_middle 反正会缩到 max_dim, 缩略图更小: 让 JPEG 解码器直接按 DCT 缩放解码
+                full_width = image.width
+                image.draft(None, scaled_size(image.size, MIDDLE_SETTINGS['max_dim']))
+                decode_scale = full_width / image.width
+                run.set(draft_size=list(image.size))
+            image.load()
+        with run.stage('transpose'):
+            image = ImageOps.exif_transpose(image)
+
+        with run.stage('small_compress'):
+            small_content = compress_loaded_image_to_target(image, len(image_content), decode_scale=decode_scale)
+        print(f"SMALL path: {small_key}")
+        with run.stage('small_upload'):
+            s3.put_object(Bucket=bucket, Key=small_key, Body=small_content, ContentType='image/jpeg')
+
+        with run.stage('middle_compress'), metrics_prefix('middle_'):
+            middle_content = compress_image_to_webp(image, len(image_content), **MIDDLE_SETTINGS)
+        print(f"MIDDLE path: {middle_key}")
+        with run.stage('middle_upload'):
+            s3.put_object(Bucket=bucket, Key=middle_key, Body=middle_content, ContentType='image/webp')
+        run.set(outcome='encoded', info_bytes=len(info_content), small_bytes=len(small_content),
+                middle_bytes=len(middle_content))
+
+        if source_hash is not None:
+            with run.stage('cache_store'):
+                store_cached(cache, source_hash, outputs, [info_content, small_content, middle_content])
+
+        entry['bytes'].update(derivative_sizes(outputs, [info_content, small_content, middle_content]))
+        return entry
+
+
+def create_middle_file(bucket, source_key, cache=None):
+    """
+    只生成 public_middle WebP, 用于缩略图路径不处理的格式 (如 TIFF); 输出与 new_webp_middle 相同。
+    """
+    middle_key = build_destination_key(source_key, 'public', MIDDLE_PREFIX)
+    outputs = [(MIDDLE_CACHE_PARAMS, '.webp', middle_key, 'image/webp')]
+
+    with track_run('create_middle_file', source_key) as run:
+        etag_hash = None
+        if cache is not None:
+            with run.stage('head'):
+                etag_hash = head_content_hash(bucket, source_key)
+            with run.stage('cache_restore'):
+                restored = etag_hash and restore_cached(cache, etag_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached middle file for: {source_key}")
+                run.set(outcome='cache_hit')
+                return
+
+        with run.stage('download'):
+            image_content = s3.get_object(Bucket=bucket, Key=source_key)['Body'].read()
+        run.set(input_bytes=len(image_content))
+
+        source_hash = None
+        if cache is not None:
+            with run.stage('cache_restore'):
+                source_hash = hashlib.md5(image_content).hexdigest()
+                restored = source_hash != etag_hash and restore_cached(cache, source_hash, bucket, outputs)
+            if restored:
+                print(f"Restored cached middle file for: {source_key}")
+                run.set(outcome='cache_hit')
+                return
+
+        with run.stage('middle_compress'), metrics_prefix('middle_'):
+            middle_content = compress_to_webp(image_content, **MIDDLE_SETTINGS)
+        print(f"MIDDLE path: {middle_key}")
+        with run.stage('middle_upload'):
+            s3.put_object(Bucket=bucket, Key=middle_key, Body=middle_content, ContentType='image/webp')
+        run.set(outcome='encoded', middle_bytes=len(middle_content))
+
+        if source_hash is not None:
+            with run.stage('cache_store'):
+                store_cached(cache, source_hash, outputs, [middle_content])
+
+
+#=========================Metadata bundles===========================
+def build_metadata_entry(exif_data, image, original_size, sizes):
+    """
+    元数据包中一张照片的条目。image 只需打开 (不必解码), 尺寸按 EXIF 方向换算成显示尺寸。
+    :param sizes: {派生类型: 字节数}, 派生类型取缓存参数中的 derivative 名称
+    """
+    width, height = image.size
+    if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        width, height = height, width
+    return {
+        'exif': exif_data,
+        'width': width,
+        'height': height,
+        'bytes': dict(sizes, original=original_size),
+    }
+
+
+def derivative_sizes(outputs, contents):
+    sizes = {}
+    for (params, _, _, _), content in zip(outputs, contents):
+        sizes[params['derivative']] = len(content.encode('utf-8') if isinstance(content, str) else content)
+    return sizes
+
+
+def describe_restored_photo(bucket, source_key, outputs):
+    """
+    缓存命中时没有原图字节: 只读原图开头 METADATA_HEADER_BYTES 取尺寸,
+    EXIF 取自刚复制的 _info.json, 派生文件大小来自 HEAD。未开启元数据包时不做这些请求。
+    """
+    if not METADATA_BUNDLES:
+        return None
+    response = s3.get_object(Bucket=bucket, Key=source_key, Range=f"bytes=0-{METADATA_HEADER_BYTES - 1}")
+    header = response['Body'].read()
+    original_size = int(response.get('ContentRange', '').rsplit('/', 1)[-1] or len(header))
+    sizes = {}
     exif_data = {}
-    # 只有当文件是JPEG格式时，才尝试读取EXIF信息
-    if photo_extension.lower() in ['.jpg', '.jpeg']:
-        try:
-            print("image path for exif: ", temp_image_path)
-            exif_dict = piexif.load(temp_image_path)
-            if exif_dict and 'Exif' in exif_dict:
-                exif_data = get_exif_data_from_dict(exif_dict)
-        except ValueError as e:
-            # 处理特定的错误，例如"embedded null byte"
-            print(f"Error reading EXIF data: {e}")
-    
-    # 删除临时文件
-    os.unlink(temp_image_path)
-    
-    # 序列化为JSON
-    info_content = json.dumps(exif_data, indent=4)
-    print(f"FIRST INFO path: {info_file_key}")
-    # 将信息文件上传到S3
-    s3.put_object(Bucket=bucket, Key=info_file_key,
-                  Body=info_content, ContentType='application/json')
-                  
-    #=========================Image compression===========================
-    
-    # 尝试压缩图片
-    compressed_content = compress_image_to_target(image_content)
-    print(f"SECOND COMPRESSION path: {destination_key}")
-    # 将压缩后的图片上传到S3
-    s3.put_object(Bucket=bucket, Key=destination_key, Body=compressed_content, ContentType='image/jpeg')
+    for params, _, destination_key, _ in outputs:
+        if params['derivative'] == 'info':
+            exif_data = load_json_with_etag(bucket, destination_key)[0] or {}
+        sizes[params['derivative']] = s3.head_object(Bucket=bucket, Key=destination_key)['ContentLength']
+    try:
+        image = Image.open(io.BytesIO(header))
+    except (OSError, SyntaxError) as e:
+        # 头部超过 METADATA_HEADER_BYTES (例如巨大的 APP1), 尺寸留空
+        print(f"Could not read dimensions of {source_key}: {e}")
+        return {'exif': exif_data, 'width': None, 'height': None, 'bytes': dict(sizes, original=original_size)}
+    return build_metadata_entry(exif_data, image, original_size, sizes)
+
+
+def metadata_bundle_key(folder):
+    """public/a/b/ -> public_small/a/b/_metadata.json"""
+    return f"public_small{folder[len('public'):]}{METADATA_BUNDLE_NAME}"
+
+
+def apply_metadata_changes(bucket, changes):
+    """
+    按文件夹合并本次调用的条目变更 ({原图键名: 条目, None 表示删除}),
+    每个元数据包只做一次 compare-and-swap 写入。
+    文件夹删除时 delete_folder_contents 已经删掉了其中的元数据包, 这里无需处理。
+    """
+    by_folder = {}
+    for key, entry in changes.items():
+        by_folder.setdefault(index_folder(key), {})[key.rsplit('/', 1)[-1]] = entry
+    for folder, folder_changes in sorted(by_folder.items()):
+        update_json_cas(
+            bucket,
+            metadata_bundle_key(folder),
+            lambda data, folder=folder, folder_changes=folder_changes: next_bundle(data, folder, folder_changes),
+        )
+
+
+def next_bundle(data, folder, changes):
+    """bundle: {"folder", "version", "photos": {文件名: 条目}}; 内容没有变化时返回 None"""
+    if not isinstance(data, dict) or not isinstance(data.get('photos'), dict):
+        data = {'folder': folder, 'version': 0, 'photos': {}}
+    photos = dict(data['photos'])
+    for name, entry in changes.items():
+        if entry is None:
+            photos.pop(name, None)
+        else:
+            photos[name] = entry
+    if photos == data['photos']:
+        return None
+    return {'folder': folder, 'version': data.get('version', 0) + 1, 'photos': photos}
+
+
+def build_destination_key(source_key, source_prefix, destination_prefix):
+    relative_key = source_key[len(source_prefix):]
+    destination_key = f"{destination_prefix}{relative_key}"
+    base, _ = splitext(destination_key)
+    return f"{base}.webp"
+
+
+def delete_middle_contents(bucket, source_key, deleter=None):
+    """删除原图或文件夹对应的 public_middle WebP; 传入 deleter 时只排队, 由调用方 close()"""
+    if deleter is None:
+        with BatchDeleter(bucket) as own_deleter:
+            return delete_middle_contents(bucket, source_key, own_deleter)
+
+    if source_key.endswith('/'):
+        deleter.add_prefix(f"{MIDDLE_PREFIX}{source_key[len('public'):]}")
+        return
+
+    if is_middle_image_key(source_key):
+        deleter.add(build_destination_key(source_key, 'public', MIDDLE_PREFIX))
+
+
+def head_content_hash(bucket, source_key):
+    """只发 HEAD 请求: 单段上传的原图可直接用 ETag 作为内容哈希去查缓存"""
+    head = s3.head_object(Bucket=bucket, Key=source_key)
+    return etag_content_hash(head['ETag'])
+
 
+def restore_cached(cache, source_hash, bucket, outputs):
+    """所有派生文件都命中缓存并复制成功时返回 True"""
+    for params, extension, destination_key, content_type in outputs:
+        cache_key = derivative_cache_key(source_hash, params, extension)
+        if not cache.restore(cache_key, bucket, destination_key, content_type):
+            return False
+    return True
 
 
-def delete_folder_contents(bucket, folder_key):
-    """删除目标文件夹或文件内容及其对应的压缩图和信息文件"""
+def store_cached(cache, source_hash, outputs, contents):
+    for (params, extension, _, content_type), content in zip(outputs, contents):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        cache.store(derivative_cache_key(source_hash, params, extension), content, content_type)
+
+
+def delete_folder_contents(bucket, folder_key, deleter=None):
+    """删除目标文件夹或文件内容及其对应的压缩图和信息文件; 传入 deleter 时只排队, 由调用方 close()"""
+    if deleter is None:
+        with BatchDeleter(bucket) as own_deleter:
+            return delete_folder_contents(bucket, folder_key, own_deleter)
+
     # 将源路径转换为目标路径 (从public到public_small)
     destination_key = folder_key.replace('public', 'public_small')
 
     # 检查是单个文件还是文件夹
     if folder_key.endswith('/'):  
-        # 如果是文件夹, 列出并删除目标文件夹内容
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=destination_key)
-        for item in response.get('Contents', []):
-            s3.delete_object(Bucket=bucket, Key=item['Key'])
+        # 如果是文件夹, 分页列出目标文件夹全部内容 (超过 1000 个也不会遗漏)
+        deleter.add_prefix(destination_key)
     else:  
-        # 如果是单个文件, 删除对应的压缩图和信息文件
-        # 删除压缩图
-        s3.delete_object(Bucket=bucket, Key=destination_key)
-        # 构建信息文件的键名并删除
+        # 如果是单个文件, 压缩图和信息文件放在同一批里删除
+        deleter.add(destination_key)
+        # 构建信息文件的键名
         photo_name, _ = splitext(destination_key.split('/')[-1])
         info_file_key = f"{'/'.join(destination_key.split('/')[:-1])}/{photo_name}_info.json"
-        s3.delete_object(Bucket=bucket, Key=info_file_key)
+        deleter.add(info_file_key)
+
+
+def exif_data_from_segment(segment):
+    """由 APP1 段得到 _info.json 的内容 (格式同 get_exif_data_from_dict)"""
+    if segment is None:
+        return {}
+    if FAST_EXIF:
+        try:
+            return parse_exif_segment(segment, include_gps=EXIF_INCLUDE_GPS)
+        except (struct.error, ValueError, IndexError) as e:
+            # 结构异常的 EXIF 交给 piexif 处理
+            print(f"Fast EXIF parser failed, falling back to piexif: {e}")
+    try:
+        exif_dict = piexif.load(segment)
+    except ValueError as e:
+        # 处理特定的错误，例如"embedded null byte"
+        print(f"Error reading EXIF data: {e}")
+        return {}
+    if exif_dict and 'Exif' in exif_dict:
+        return get_exif_data_from_dict(exif_dict)
+    return {}
+
+
+# TIFF 字段类型 -> 单个值的字节数
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+IFD0_TAGS = {271: 'Make', 272: 'Model', 0x8769: 'ExifIFD', 0x8825: 'GPSIFD'}
+EXIF_IFD_TAGS = {
+    33434: 'ExposureTime', 33437: 'FNumber', 34855: 'ISOSpeedRatings', 36867: 'DateTimeOriginal',
+    37385: 'Flash', 37386: 'FocalLength', 42035: 'LensMake', 42036: 'LensModel',
+}
+GPS_IFD_TAGS = {1: 'GPSLatitudeRef', 2: 'GPSLatitude', 3: 'GPSLongitudeRef', 4: 'GPSLongitude'}
+
+
+def parse_exif_segment(segment, include_gps=False):
+    """
+    只读取 _info.json 用到的标签: 直接按 IFD 表项用 struct 解码, 跳过缩略图、MakerNote 等其余内容。
+    输出与 piexif.load + get_exif_data_from_dict 完全相同 (曝光字段、拍摄时间、机身、镜头), 另可附 GPS。
+    """
+    tiff = memoryview(segment)[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if endian is None or struct.unpack_from(endian + 'H', tiff, 2)[0] != 42:
+        raise ValueError("not a TIFF header")
+    ifd0 = read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian, IFD0_TAGS)
+    exif = read_ifd(tiff, ifd0['ExifIFD'], endian, EXIF_IFD_TAGS) if 'ExifIFD' in ifd0 else {}
+
+    # 按 piexif 的字典形状交给 get_exif_data_from_dict 格式化, 保证与 piexif 路径的字符串一致
+    exif_data = get_exif_data_from_dict({
+        '0th': {getattr(piexif.ImageIFD, name): ifd0[name] for name in ('Make', 'Model') if name in ifd0},
+        'Exif': {getattr(piexif.ExifIFD, name): value for name, value in exif.items()},
+    })
+    if include_gps and 'GPSIFD' in ifd0:
+        gps = read_ifd(tiff, ifd0['GPSIFD'], endian, GPS_IFD_TAGS)
+        if 'GPSLatitude' in gps and 'GPSLongitude' in gps:
+            latitude = gps_degrees(gps['GPSLatitude'], gps.get('GPSLatitudeRef'), 'S')
+            longitude = gps_degrees(gps['GPSLongitude'], gps.get('GPSLongitudeRef'), 'W')
+            exif_data['GPS'] = f"{latitude:.6f}, {longitude:.6f}"
+    return exif_data
+
+
+def read_ifd(tiff, offset, endian, wanted):
+    """读取一个 IFD 中 wanted 里的标签 ({tag: 名称}), 返回 {名称: 值}; 值的形状与 piexif 相同"""
+    values = {}
+    count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    # 规范要求表项按标签升序, 但有的相机/软件写出乱序的 IFD, 所以不能在超过最大标签时提前结束
+    for entry in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, field_type, value_count = struct.unpack_from(endian + 'HHI', tiff, entry)
+        if tag not in wanted or field_type not in TIFF_TYPE_SIZES:
+            continue
+        size = TIFF_TYPE_SIZES[field_type] * value_count
+        data_offset = entry + 8 if size <= 4 else struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+        values[wanted[tag]] = decode_tiff_value(tiff, data_offset, field_type, value_count, endian)
+    return values
+
+
+def decode_tiff_value(tiff, offset, field_type, count, endian):
+    if field_type == 2:
+        return bytes(tiff[offset:offset + count]).split(b'\x00', 1)[0].decode('utf-8', 'replace').strip()
+    if field_type in (1, 7):
+        return bytes(tiff[offset:offset + count])
+    if field_type in (5, 10):
+        code = 'I' if field_type == 5 else 'i'
+        numbers = struct.unpack_from(f"{endian}{2 * count}{code}", tiff, offset)
+        pairs = tuple(zip(numbers[::2], numbers[1::2]))
+        return pairs[0] if count == 1 else pairs
+    code = {3: 'H', 4: 'I', 9: 'i'}[field_type]
+    numbers = struct.unpack_from(f"{endian}{count}{code}", tiff, offset)
+    return numbers[0] if count == 1 else numbers
+
+
+def gps_degrees(value, ref, negative_ref):
+    degrees = sum(n / d / 60 ** i for i, (n, d) in enumerate(value) if d)
+    return -degrees if ref == negative_ref else degrees
 
 
 def get_exif_data_from_dict(exif_dict):
@@ -389,4 +1290,26 @@ def get_exif_data_from_dict(exif_dict):
 
             exif_data[readable_name] = value
 
+    # 文本字段: 拍摄时间、机身、镜头; piexif 给出的是 bytes, parse_exif_segment 给出的是 str
+    text_fields = (
+        ('Exif', piexif.ExifIFD.DateTimeOriginal, 'Date Taken'),
+        ('0th', piexif.ImageIFD.Make, 'Camera Make'),
+        ('0th', piexif.ImageIFD.Model, 'Camera Model'),
+        ('Exif', piexif.ExifIFD.LensModel, 'Lens'),
+    )
+    for ifd_name, tag, readable_name in text_fields:
+        value = exif_dict.get(ifd_name, {}).get(tag)
+        if isinstance(value, bytes):
+            value = value.split(b'\x00', 1)[0].decode('utf-8', 'replace').strip()
+        if isinstance(value, str) and value:
+            exif_data[readable_name] = value
+
     return exif_data
+
+
+#=========================Metrics===========================
+class MetricsAggregator(photo_pipeline.MetricsAggregator):
+    """统一流水线一次运行产出多个派生文件, 汇总表分别列出缩略图和 public_middle 的数值"""
+
+    SUMMARY_VALUES = ('small_quality', 'middle_quality', 'input_bytes', 'info_bytes', 'small_bytes', 'middle_bytes')
+    RESIZED_VALUE = 'middle_resized_size'
@@ -0,0 +1,132 @@
+# usage: python rebuild_metadata_bundles.py --bucket marcus-photograph-garage
+# this is a back fill for local aws cli usage
+# for rebuilding the per-folder public_small/<folder>/_metadata.json bundles
+# (same format as new_piexifV3.build_metadata_entry / next_bundle) from the
+# existing _info.json files, derivative sizes and the originals' headers
+
+import argparse
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext
+
+import boto3
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
+METADATA_BUNDLE_NAME = "_metadata.json"
+# Only the leading bytes of each original are read to get its dimensions.
+DEFAULT_HEADER_BYTES = 64 * 1024
+
+
+def is_image_key(key):
+    _, ext = splitext(key)
+    return ext.lower() in IMAGE_EXTENSIONS
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild per-folder _metadata.json bundles under public_small/."
+    )
+    parser.add_argument("--bucket", default=os.environ.get("BUCKET_NAME"))
+    parser.add_argument("--source-prefix", default="public")
+    parser.add_argument("--small-prefix", default="public_small")
+    parser.add_argument("--middle-prefix", default="public_middle")
+    parser.add_argument("--header-bytes", type=int, default=DEFAULT_HEADER_BYTES)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    if not args.bucket:
+        raise SystemExit("Missing --bucket or BUCKET_NAME.")
+
+    s3 = boto3.client("s3")
+    originals = list_sizes(s3, args.bucket, f"{args.source_prefix}/")
+    smalls = list_sizes(s3, args.bucket, f"{args.small_prefix}/")
+    middles = list_sizes(s3, args.bucket, f"{args.middle_prefix}/")
+    image_keys = sorted(key for key in originals if is_image_key(key))
+
+    def describe(key):
+        relative = key[len(args.source_prefix):]
+        small_key = f"{args.small_prefix}{relative}"
+        info_key = f"{splitext(small_key)[0]}_info.json"
+        middle_key = f"{args.middle_prefix}{splitext(relative)[0]}.webp"
+        sizes = {"original": originals[key]}
+        for name, derivative_key, listing in (
+            ("info", info_key, smalls),
+            ("public_small", small_key, smalls),
+            ("public_middle", middle_key, middles),
+        ):
+            if derivative_key in listing:
+                sizes[name] = listing[derivative_key]
+        exif = load_json(s3, args.bucket, info_key) if info_key in smalls else {}
+        width, height = read_dimensions(s3, args.bucket, key, args.header_bytes)
+        return key, {"exif": exif, "width": width, "height": height, "bytes": sizes}
+
+    bundles = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for key, entry in executor.map(describe, image_keys):
+            folder = key.rsplit("/", 1)[0] + "/"
+            bundles.setdefault(folder, {})[key.rsplit("/", 1)[-1]] = entry
+
+    live_keys = set()
+    for folder, photos in sorted(bundles.items()):
+        bundle_key = f"{args.small_prefix}{folder[len(args.source_prefix):]}{METADATA_BUNDLE_NAME}"
+        live_keys.add(bundle_key)
+        previous = load_json(s3, args.bucket, bundle_key) if bundle_key in smalls else None
+        version = previous.get("version", 0) + 1 if isinstance(previous, dict) else 1
+        s3.put_object(
+            Bucket=args.bucket,
+            Key=bundle_key,
+            Body=json.dumps({"folder": folder, "version": version, "photos": photos}),
+            ContentType="application/json",
+        )
+
+    # Drop bundles of folders that no longer hold any image.
+    stale = [
+        key
+        for key in smalls
+        if key.endswith(f"/{METADATA_BUNDLE_NAME}") and key not in live_keys
+    ]
+    for key in stale:
+        s3.delete_object(Bucket=args.bucket, Key=key)
+
+    print(
+        f"Wrote {len(bundles)} bundles for {len(image_keys)} images "
+        f"({len(stale)} stale bundles removed)"
+    )
+
+
+def list_sizes(s3, bucket, prefix):
+    sizes = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            sizes[item["Key"]] = item["Size"]
+    return sizes
+
+
+def load_json(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except (s3.exceptions.NoSuchKey, ValueError):
+        return {}
+
+
+def read_dimensions(s3, bucket, key, header_bytes):
+    """Display size of an original from its leading bytes; (None, None) if the header is longer."""
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{header_bytes - 1}")
+    try:
+        image = Image.open(io.BytesIO(response["Body"].read()))
+    except (OSError, SyntaxError) as e:
+        print(f"Could not read dimensions of {key}: {e}")
+        return None, None
+    width, height = image.size
+    if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        width, height = height, width
+    return width, height
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,29 @@
 # usage: python rebuild_photo_list_tracker.py --bucket marcus-photograph-garage
 # this is a back fill for local aws cli usage
 # for rebuilding public_small/photo_list_tracker.json from public/ images
+# --layout sharded|both also (re)writes the per-folder shards and manifest under
+# public_small/photo_index/ (same format as new_piexifV3.apply_shard_changes /
+# apply_index_changes); versions continue from the existing manifest
+# --compact also writes public_small/photo_index_compact.json plus .gz/.br
+# precompressed variants (shared/compact_index.py, the same writer as new_piexifV3)
 
 import argparse
+import hashlib
 import json
 import os
+import sys
 from os.path import splitext
 
 import boto3
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from compact_index import COMPACT_INDEX_KEY, build_compact_index, write_compact_index
+
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
 DEFAULT_INDEX_KEY = "public_small/photo_list_tracker.json"
+DEFAULT_SHARD_PREFIX = "public_small/photo_index"
+DEFAULT_COMPACT_KEY = COMPACT_INDEX_KEY
 
 
 def is_image_key(key):
@@ -26,6 +38,12 @@ def main():
     parser.add_argument("--bucket", default=os.environ.get("BUCKET_NAME"))
     parser.add_argument("--source-prefix", default="public")
     parser.add_argument("--index-key", default=DEFAULT_INDEX_KEY)
+    parser.add_argument("--shard-prefix", default=DEFAULT_SHARD_PREFIX)
+    parser.add_argument(
+        "--layout", choices=("legacy", "sharded", "both"), default="legacy"
+    )
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--compact-key", default=DEFAULT_COMPACT_KEY)
     args = parser.parse_args()
 
     if not args.bucket:
@@ -45,14 +63,96 @@ def main():
     base_url = f"https://{args.bucket}.s3.amazonaws.com/"
     urls = [f"{base_url}{key}" for key in keys]
 
+    if args.layout in ("legacy", "both"):
+        # the Lambda checks this hash before publishing its compact index
+        body = json.dumps(sorted(urls))
+        s3.put_object(
+            Bucket=args.bucket,
+            Key=args.index_key,
+            Body=body,
+            ContentType="application/json",
+            Metadata={"content-sha256": hashlib.sha256(body.encode()).hexdigest()},
+        )
+        print(f"Wrote {len(urls)} URLs to s3://{args.bucket}/{args.index_key}")
+
+    if args.layout in ("sharded", "both"):
+        write_shards(s3, args.bucket, args.shard_prefix, keys, base_url)
+
+    if args.compact:
+        write_compact_index(
+            s3, args.bucket, args.compact_key, build_compact_index(keys, base_url)
+        )
+
+
+def shard_key(shard_prefix, folder):
+    return f"{shard_prefix}/{folder}_index.json"
+
+
+def load_manifest(s3, bucket, manifest_key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=manifest_key)
+        data = json.loads(response["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("folders"), dict):
+        return {"version": 0, "folders": {}}
+    return data
+
+
+def write_shards(s3, bucket, shard_prefix, keys, base_url):
+    urls_by_folder = {}
+    for key in keys:
+        folder = key.rsplit("/", 1)[0] + "/"
+        urls_by_folder.setdefault(folder, []).append(f"{base_url}{key}")
+
+    # Versions only ever go up: clients and the Lambda's compare-and-swap
+    # merge ignore entries whose version is not newer than what they have.
+    manifest_key = f"{shard_prefix}/manifest.json"
+    old_manifest = load_manifest(s3, bucket, manifest_key)
+    old_folders = old_manifest["folders"]
+    folders = {}
+    for folder, urls in sorted(urls_by_folder.items()):
+        key = shard_key(shard_prefix, folder)
+        version = old_folders.get(folder, {}).get("version", 0) + 1
+        s3.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps({"folder": folder, "version": version, "urls": sorted(urls)}),
+            ContentType="application/json",
+        )
+        folders[folder] = {"key": key, "count": len(urls), "version": version}
+
+    # Drop shards of folders that no longer exist; like the Lambda, keep their
+    # manifest entries with a count of 0 so a late stale write cannot revive them.
+    live_keys = {entry["key"] for entry in folders.values()}
+    for folder, entry in old_folders.items():
+        if folder not in folders:
+            folders[folder] = {
+                "key": shard_key(shard_prefix, folder),
+                "count": 0,
+                "version": entry.get("version", 0) + 1,
+            }
+    stale = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{shard_prefix}/"):
+        for item in page.get("Contents", []):
+            key = item["Key"]
+            if key.endswith("/_index.json") and key not in live_keys:
+                s3.delete_object(Bucket=bucket, Key=key)
+                stale += 1
+
     s3.put_object(
-        Bucket=args.bucket,
-        Key=args.index_key,
-        Body=json.dumps(sorted(urls)),
+        Bucket=bucket,
+        Key=manifest_key,
+        Body=json.dumps(
+            {"version": old_manifest.get("version", 0) + 1, "folders": folders}
+        ),
         ContentType="application/json",
     )
-
-    print(f"Wrote {len(urls)} URLs to s3://{args.bucket}/{args.index_key}")
+    print(
+        f"Wrote {len(live_keys)} shards and s3://{bucket}/{manifest_key} "
+        f"({stale} stale shards removed)"
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,15 @@
-"""一次性生成 public_index.json（public 下图片列表）"""
+"""一次性生成 public_index.json（public 下图片列表）; --compact 另写紧凑索引及 .gz/.br 预压缩变体"""
 import argparse
 import json
+import os
+import sys
 
 import boto3
 
+# 紧凑索引的格式与写入和 new_piexifV3 共用 ../shared/compact_index.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from compact_index import COMPACT_INDEX_KEY, build_compact_index, write_compact_index
+
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
 INDEX_KEY = "public_small/photo_list_tracker.json"
 
@@ -12,19 +18,21 @@ def main():
   parser = argparse.ArgumentParser(description="Backfill public_index.json from S3.")
   parser.add_argument("--bucket", required=True)
   parser.add_argument("--prefix", default="public/")
+  parser.add_argument("--compact", action="store_true")
   args = parser.parse_args()
 
   s3 = boto3.client("s3")
   paginator = s3.get_paginator("list_objects_v2")
-  urls = []
+  base_url = f"https://{args.bucket}.s3.amazonaws.com/"
+  keys = []
 
   for page in paginator.paginate(Bucket=args.bucket, Prefix=args.prefix):
     for item in page.get("Contents", []):
       key = item["Key"]
       if is_image_key(key):
-        urls.append(f"https://{args.bucket}.s3.amazonaws.com/{key}")
+        keys.append(key)
 
-  urls.sort()
+  urls = sorted(f"{base_url}{key}" for key in keys)
   s3.put_object(
     Bucket=args.bucket,
     Key=INDEX_KEY,
@@ -33,6 +41,9 @@ def main():
   )
   print(f"Wrote {len(urls)} items to s3://{args.bucket}/{INDEX_KEY}")
 
+  if args.compact:
+    write_compact_index(s3, args.bucket, COMPACT_INDEX_KEY, build_compact_index(keys, base_url))
+
 
 def is_image_key(key):
   _, ext = key.rsplit(".", 1) if "." in key else ("", "")
@@ -0,0 +1,257 @@
+"""Micro-benchmarks for the image pipeline hot paths, runnable without deploying.
+
+python backend/lambda/Lambda_Funcs/benchmarks/bench_pipeline.py \
+  --size quick \
+  --repeat 3 \
+  --save-baseline bench_baseline.json
+
+python backend/lambda/Lambda_Funcs/benchmarks/bench_pipeline.py \
+  --set quality_step=4 --set max_dim=2500 \
+  --baseline bench_baseline.json
+
+Cases (one per function x corpus image, see corpus.py):
+  compress_to_webp          photo_pipeline, new_webp_middle's default options (--set overrides)
+  compress_image_to_target  new_piexifV3 public_small thumbnail
+  ensure_max_dimension      photo_pipeline, on the decoded image
+  normalize_mode            photo_pipeline, on the decoded image
+  get_exif_data_from_dict   new_piexifV3, EXIF_CALLS calls on a loaded piexif dict
+
+For each case: best wall time over --repeat runs, encoder calls (Image.save) and
+output bytes of the first run, and peak RSS growth. Every case runs in its own
+forked process so the RSS high-water mark (which covers Pillow's native buffers,
+unlike tracemalloc) belongs to that case alone. --baseline prints the change of
+every number against a file written earlier by --save-baseline.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import piexif
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "add_update_compress_middle"))
+sys.path.insert(0, os.path.join(HERE, "..", "add_update_compress_small_with_info(lambda_only)"))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+
+import new_piexifV3  # noqa: E402
+import photo_pipeline  # noqa: E402
+from corpus import build_corpus  # noqa: E402
+
+# Same defaults as new_webp_middle.lambda_handler.
+WEBP_OPTIONS = {
+    "target_size_kb": 1024,
+    "quality": 86,
+    "min_quality": 60,
+    "max_dim": 3000,
+    "min_target_ratio": 0.6,
+    "fallback_min_quality": 40,
+    "large_image_mb": 25.0,
+    "quality_step": 8,
+    "max_quality_steps": 6,
+    "quality_search": "bisect",
+    "max_search_encodes": 4,
+    "predict_quality": True,
+}
+EXIF_CALLS = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline hot paths.")
+    parser.add_argument("--size", choices=("quick", "full"), default="quick")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE",
+                        help="override a compress_to_webp option, e.g. quality_step=4")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own prints")
+    args = parser.parse_args()
+
+    options = dict(WEBP_OPTIONS)
+    for item in args.set:
+        name, _, value = item.partition("=")
+        if name not in options:
+            raise SystemExit(f"Unknown option {name}; choose from {', '.join(options)}")
+        default = options[name]
+        options[name] = value.lower() in ("1", "true", "yes") if isinstance(default, bool) else type(default)(value)
+
+    corpus = build_corpus(args.size)
+    cases = [case for case in build_cases(corpus, options) if not args.only or args.only in case[0]]
+    print(f"{len(corpus)} images, {len(cases)} cases, repeat {args.repeat}")
+
+    results = {}
+    for name, setup, run in cases:
+        results[name] = measure(setup, run, args.repeat, args.verbose)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        if baseline.get("options") != options:
+            print(f"note: baseline options differ: {baseline.get('options')}")
+    print_table(results, baseline["cases"] if baseline else None)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as handle:
+            json.dump({"size": args.size, "options": options, "cases": results}, handle, indent=2)
+        print(f"Saved results to {args.save_baseline}")
+
+
+def build_cases(corpus, options):
+    """[(name, setup, run)]: setup prepares the input outside the timed region."""
+    cases = []
+    for file_name, data in corpus:
+        cases.append((f"compress_to_webp/{file_name}", lambda data=data: data,
+                      lambda data: photo_pipeline.compress_to_webp(data, **options)))
+    for file_name, data in corpus:
+        cases.append((f"compress_image_to_target/{file_name}", lambda data=data: data,
+                      new_piexifV3.compress_image_to_target))
+    for file_name, data in corpus:
+        cases.append((f"ensure_max_dimension/{file_name}", lambda data=data: decode(data),
+                      lambda image: photo_pipeline.ensure_max_dimension(image, options["max_dim"])))
+        cases.append((f"normalize_mode/{file_name}", lambda data=data: decode(data),
+                      photo_pipeline.normalize_mode))
+    for file_name, data in corpus:
+        if file_name.startswith("exif_"):
+            cases.append((f"get_exif_data_from_dict/{file_name}", lambda data=data: piexif.load(data),
+                          lambda exif_dict: [new_piexifV3.get_exif_data_from_dict(exif_dict)
+                                             for _ in range(EXIF_CALLS)][-1]))
+    return cases
+
+
+def decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def measure(setup, run, repeat, verbose=False):
+    """Run one case, in a forked child when the platform allows it."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return run_case(setup, run, repeat, verbose)
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=lambda: sender.send(run_case(setup, run, repeat, verbose)))
+    child.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"benchmark case crashed (exit code {child.exitcode})") from None
+    finally:
+        child.join()
+    return result
+
+
+def run_case(setup, run, repeat, verbose=False):
+    if not verbose:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run_case(setup, run, repeat, verbose=True)
+    value = setup()
+    gc.collect()
+    baseline_kb = current_rss_kb()
+    best = None
+    output = None
+    encodes = None
+    with count_encoder_calls() as calls:
+        for attempt in range(max(1, repeat)):
+            calls["count"] = 0
+            start = time.perf_counter()
+            result = run(value)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            if attempt == 0:
+                output = output_bytes(result)
+                encodes = calls["count"]
+    peak_kb = peak_rss_kb()
+    return {
+        "wall_ms": round(best * 1000, 2),
+        "encodes": encodes,
+        "peak_kb": max(0, peak_kb - baseline_kb) if peak_kb is not None and baseline_kb is not None else None,
+        "bytes": output,
+    }
+
+
+@contextlib.contextmanager
+def count_encoder_calls():
+    """Patch Image.Image.save to count encoder invocations while the block runs."""
+    calls = {"count": 0}
+    original = Image.Image.save
+
+    def counting_save(self, *args, **kwargs):
+        calls["count"] += 1
+        return original(self, *args, **kwargs)
+
+    Image.Image.save = counting_save
+    try:
+        yield calls
+    finally:
+        Image.Image.save = original
+
+
+def output_bytes(result):
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, Image.Image):
+        return result.width * result.height * len(result.getbands())
+    return len(json.dumps(result))
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm", encoding="ascii") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return None
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def print_table(results, baseline):
+    header = f"{'case':<52} {'wall ms':>9} {'encodes':>7} {'peak KB':>9} {'bytes':>10}"
+    if baseline:
+        header += f" {'d wall':>8} {'d enc':>6} {'d peak':>8} {'d bytes':>8}"
+    print(header)
+    for name, result in results.items():
+        line = (
+            f"{name:<52} {result['wall_ms']:>9.1f} {result['encodes']:>7} "
+            f"{format_optional(result['peak_kb']):>9} {result['bytes']:>10}"
+        )
+        previous = baseline.get(name) if baseline else None
+        if previous:
+            line += (
+                f" {percent(result['wall_ms'], previous['wall_ms']):>8}"
+                f" {result['encodes'] - previous['encodes']:>+6}"
+                f" {percent(result['peak_kb'], previous['peak_kb']):>8}"
+                f" {percent(result['bytes'], previous['bytes']):>8}"
+            )
+        elif baseline is not None:
+            line += "      new"
+        print(line)
+    total = sum(result["wall_ms"] for result in results.values())
+    print(f"{'total':<52} {total:>9.1f}")
+
+
+def format_optional(value):
+    return "-" if value is None else str(value)
+
+
+def percent(value, previous):
+    if value is None or not previous:
+        return "-"
+    return f"{(value - previous) / previous * 100:+.1f}%"
+
+
+if __name__ == "__main__":
+    main()
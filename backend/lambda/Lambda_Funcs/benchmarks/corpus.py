@@ -0,0 +1,118 @@
+"""Deterministic synthetic image corpus for the benchmark and load-test scripts.
+
+Every image is generated from a fixed seed, so two runs (or two machines) see the
+same bytes: photo-like RGB JPEGs at several sizes, grayscale, CMYK, 16-bit and
+palette images, RGBA PNGs with real alpha, an animated GIF, a screenshot-like
+graphic (flat panels, text, buttons) and JPEGs carrying camera-like EXIF with each
+common orientation.
+"""
+import io
+
+import numpy as np
+import piexif
+from PIL import Image, ImageDraw
+
+# name -> (width, height) of the photo-like JPEGs per --size preset
+PHOTO_SIZES = {
+    "quick": {"photo_s": (640, 480), "photo_m": (1600, 1200), "pano": (3600, 1200)},
+    "full": {
+        "photo_s": (640, 480),
+        "photo_m": (1600, 1200),
+        "pano": (3600, 1200),
+        "photo_l": (4000, 3000),
+        "photo_xl": (6000, 4000),
+    },
+}
+
+
+def photo_array(width, height, seed, noise=18):
+    """Smooth gradients plus sensor-like noise: compresses like a real photo."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 6 + seed % 3, width, dtype=np.float32)
+    y = np.linspace(0, 4 + seed % 2, height, dtype=np.float32)
+    channels = []
+    for phase in range(3):
+        base = np.sin(x + phase)[None, :] * np.cos(y * (1 + phase / 3))[:, None] * 70 + 128
+        channels.append(base + rng.normal(0, noise, (height, width)).astype(np.float32))
+    return np.stack(channels, -1).clip(0, 255).astype(np.uint8)
+
+
+def screenshot_image(width, height, seed):
+    """Flat UI panels, lines of text and a few coloured buttons: compresses like a screenshot."""
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGB", (width, height), (245, 246, 248))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 56), fill=(36, 41, 47))
+    draw.rectangle((0, 56, width // 6, height), fill=(230, 232, 236))
+    for line in range((height - 300) // 15):
+        draw.text((width // 6 + 20, 80 + line * 15), "The quick brown fox jumps over the lazy dog 0123456789 " * 2,
+                  fill=(20, 20, 20))
+    for item in range((height - 100) // 30):
+        draw.text((12, 70 + item * 30), f"Menu item {item}", fill=(60, 60, 60))
+    for button in range(6):
+        left = width // 6 + 20 + button * 210
+        color = tuple(int(value) for value in rng.integers(60, 220, 3))
+        draw.rounded_rectangle((left, height - 220, left + 190, height - 40), radius=12, fill=color, outline=(0, 0, 0))
+    return image
+
+
+def encode(image, fmt, **params):
+    output = io.BytesIO()
+    image.save(output, fmt, **params)
+    return output.getvalue()
+
+
+def camera_exif(orientation, seed):
+    exif_dict = {
+        "0th": {
+            piexif.ImageIFD.Make: b"Canon",
+            piexif.ImageIFD.Model: b"Canon EOS R5",
+            piexif.ImageIFD.Orientation: orientation,
+            piexif.ImageIFD.DateTime: b"2024:04:01 10:00:00",
+        },
+        "Exif": {
+            piexif.ExifIFD.ExposureTime: (1, (60, 125, 250, 1000)[seed % 4]),
+            piexif.ExifIFD.FNumber: ((14, 28, 40, 80)[seed % 4], 10),
+            piexif.ExifIFD.ISOSpeedRatings: (100, 400, 3200)[seed % 3],
+            piexif.ExifIFD.DateTimeOriginal: b"2024:04:01 10:00:00",
+            piexif.ExifIFD.Flash: (0, 1, 16)[seed % 3],
+            piexif.ExifIFD.FocalLength: ((24, 50, 85)[seed % 3], 1),
+            piexif.ExifIFD.MakerNote: bytes(np.random.default_rng(seed).integers(0, 256, 4096, dtype=np.uint8)),
+            piexif.ExifIFD.LensModel: b"RF24-70mm F2.8 L IS USM",
+        },
+    }
+    return piexif.dump(exif_dict)
+
+
+def build_corpus(size="quick"):
+    """Return [(name, file_bytes)] for the given size preset ("quick" or "full")."""
+    corpus = []
+    for seed, (name, (width, height)) in enumerate(PHOTO_SIZES[size].items()):
+        corpus.append((f"{name}.jpg", encode(Image.fromarray(photo_array(width, height, seed)), "JPEG", quality=92)))
+
+    base = Image.fromarray(photo_array(1200, 900, 7))
+    corpus.append(("gray.jpg", encode(base.convert("L"), "JPEG", quality=92)))
+    corpus.append(("cmyk.jpg", encode(base.convert("CMYK"), "JPEG", quality=92)))
+    corpus.append(("deep16.png", encode(Image.fromarray((np.asarray(base.convert("L"), dtype=np.uint16) * 257)), "PNG")))
+    corpus.append(("palette.png", encode(base.convert("P", palette=Image.ADAPTIVE, colors=64), "PNG")))
+
+    rgba = base.convert("RGBA")
+    alpha = np.zeros((900, 1200), dtype=np.uint8)
+    alpha[100:800, 150:1050] = 255
+    alpha[300:600, 400:800] = 128
+    rgba.putalpha(Image.fromarray(alpha))
+    corpus.append(("alpha.png", encode(rgba, "PNG")))
+
+    frames = [Image.fromarray(photo_array(480, 360, 20 + i)).convert("P", palette=Image.ADAPTIVE) for i in range(4)]
+    gif = io.BytesIO()
+    frames[0].save(gif, "GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+    corpus.append(("animated.gif", gif.getvalue()))
+    corpus.append(("screenshot.png", encode(screenshot_image(1600, 1000, 40), "PNG")))
+
+    for seed, orientation in enumerate((1, 3, 6, 8)):
+        image = Image.fromarray(photo_array(1600, 1200, 30 + seed))
+        corpus.append((
+            f"exif_orient{orientation}.jpg",
+            encode(image, "JPEG", quality=90, exif=camera_exif(orientation, seed)),
+        ))
+    return corpus
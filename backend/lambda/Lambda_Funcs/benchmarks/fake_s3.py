@@ -0,0 +1,240 @@
+"""Local stand-in for the boto3 S3 client used by the Lambda handlers.
+
+Implements the calls the pipeline makes (get/put/head/copy/delete object,
+delete_objects, list_objects_v2 with pagination, conditional puts, ranged GETs,
+user metadata) over an in-memory dict or a directory (one file per key), counts
+every call and the bytes moved, and can add a fixed per-call latency to mimic
+the network.
+Buckets are ignored: every bucket shares one keyspace.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+from botocore.exceptions import ClientError
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, key, operation="GetObject"):
+        super().__init__({"Error": {"Code": "NoSuchKey", "Key": key}}, operation)
+
+
+class FakeExceptions:
+    NoSuchKey = NoSuchKey
+
+
+class MemoryStore:
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    def put(self, key, obj):
+        self.objects[key] = obj
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+    def keys(self):
+        return list(self.objects)
+
+
+class DirectoryStore:
+    """One file per key (the key URL-quoted as the file name) plus a metadata sidecar."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, quote(key, safe=""))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as handle:
+                body = handle.read()
+            with open(f"{self.path(key)}.meta", encoding="utf-8") as handle:
+                content_type, content_encoding, modified, *metadata = handle.read().split("\n")
+        except FileNotFoundError:
+            return None
+        metadata = json.loads(metadata[0]) if metadata else {}
+        return StoredObject(body, content_type, content_encoding or None, float(modified), metadata)
+
+    def put(self, key, obj):
+        with open(self.path(key), "wb") as handle:
+            handle.write(obj.body)
+        with open(f"{self.path(key)}.meta", "w", encoding="utf-8") as handle:
+            handle.write(f"{obj.content_type}\n{obj.content_encoding or ''}\n{obj.modified}\n"
+                         f"{json.dumps(obj.metadata)}")
+
+    def delete(self, key):
+        for path in (self.path(key), f"{self.path(key)}.meta"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def keys(self):
+        return [unquote(name) for name in os.listdir(self.root) if not name.endswith(".meta")]
+
+
+class StoredObject:
+    def __init__(self, body, content_type="binary/octet-stream", content_encoding=None, modified=None,
+                 metadata=None):
+        self.body = body
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.modified = time.time() if modified is None else modified
+        self.metadata = dict(metadata or {})
+
+    @property
+    def etag(self):
+        return f'"{hashlib.md5(self.body).hexdigest()}"'
+
+
+class FakeS3:
+    def __init__(self, root=None, latency_ms=0):
+        self.store = DirectoryStore(root) if root else MemoryStore()
+        self.latency = latency_ms / 1000
+        self.exceptions = FakeExceptions
+        self.calls = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def record(self, operation, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def seed(self, key, body, content_type="binary/octet-stream"):
+        """Put an object without counting it as a call."""
+        self.store.put(key, StoredObject(bytes(body), content_type))
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        obj = self.store.get(Key)
+        if obj is None:
+            self.record("get_object")
+            raise NoSuchKey(Key)
+        if IfMatch is not None and obj.etag != IfMatch:
+            self.record("get_object")
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+        body = obj.body
+        response = {"ETag": obj.etag, "ContentType": obj.content_type, "Metadata": dict(obj.metadata)}
+        if Range:
+            start, _, end = Range.split("=", 1)[1].partition("-")
+            start = int(start)
+            end = min(int(end) if end else len(body) - 1, len(body) - 1)
+            if start >= len(body):
+                self.record("get_object")
+                raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+            body = body[start:end + 1]
+            response["ContentRange"] = f"bytes {start}-{end}/{len(obj.body)}"
+        self.record("get_object", bytes_out=len(body))
+        response.update(Body=io.BytesIO(body), ContentLength=len(body))
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.record("head_object")
+        obj = self.store.get(Key)
+        if obj is None:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ETag": obj.etag, "ContentLength": len(obj.body), "ContentType": obj.content_type,
+                "Metadata": dict(obj.metadata)}
+
+    def put_object(self, Bucket, Key, Body=b"", ContentType="binary/octet-stream",
+                   ContentEncoding=None, Metadata=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        body = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        self.record("put_object", bytes_in=len(body))
+        with self.lock:
+            current = self.store.get(Key)
+            if IfMatch is not None and (current is None or current.etag != IfMatch):
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            if IfNoneMatch == "*" and current is not None:
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            obj = StoredObject(body, ContentType, ContentEncoding, metadata=Metadata)
+            self.store.put(Key, obj)
+        return {"ETag": obj.etag}
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None, Metadata=None,
+                    MetadataDirective="COPY", **kwargs):
+        self.record("copy_object")
+        source = self.store.get(CopySource["Key"])
+        if source is None:
+            raise NoSuchKey(CopySource["Key"], "CopyObject")
+        metadata = Metadata if MetadataDirective == "REPLACE" else source.metadata
+        self.store.put(Key, StoredObject(source.body, ContentType or source.content_type,
+                                         source.content_encoding, metadata=metadata))
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.record("delete_object")
+        self.store.delete(Key)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.record("delete_objects")
+        objects = Delete["Objects"]
+        if len(objects) > 1000:
+            raise ClientError({"Error": {"Code": "MalformedXML"}}, "DeleteObjects")
+        for item in objects:
+            self.store.delete(item["Key"])
+        return {"Deleted": [{"Key": item["Key"]} for item in objects]}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, StartAfter=None,
+                        MaxKeys=1000, **kwargs):
+        self.record("list_objects_v2")
+        keys = sorted(key for key in self.store.keys() if key.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [key for key in keys if key > after]
+        page = keys[:MaxKeys]
+        contents = []
+        for key in page:
+            obj = self.store.get(key)
+            contents.append({
+                "Key": key,
+                "Size": len(obj.body),
+                "ETag": obj.etag,
+                "LastModified": datetime.fromtimestamp(obj.modified, timezone.utc),
+            })
+        response = {"KeyCount": len(page), "IsTruncated": len(keys) > MaxKeys}
+        if contents:
+            response["Contents"] = contents
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise NotImplementedError(operation)
+        return ListPaginator(self)
+
+
+class ListPaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            response = self.client.list_objects_v2(ContinuationToken=token, **kwargs)
+            yield response
+            if not response.get("IsTruncated"):
+                return
+            token = response["NextContinuationToken"]
@@ -0,0 +1,72 @@
+"""Local stand-in for an SQS queue feeding a Lambda through an event source mapping.
+
+send() enqueues a message body; receive_event() hands out up to batch_size
+visible messages as the Lambda SQS event; settle() applies the handler's
+response the way ReportBatchItemFailures does: messages listed in
+batchItemFailures become visible again, everything else in the batch is
+deleted, and a message received max_receives times moves to dead_letters.
+A handler that raises instead fails the whole batch.
+"""
+import itertools
+import json
+from collections import deque
+
+
+class FakeQueue:
+    def __init__(self, max_receives=3, arn="arn:aws:sqs:us-east-1:000000000000:load-test"):
+        self.max_receives = max_receives
+        self.arn = arn
+        self.visible = deque()
+        self.in_flight = {}
+        self.dead_letters = []
+        self.receives = 0
+        self.redeliveries = 0
+        self.ids = itertools.count()
+
+    def __len__(self):
+        return len(self.visible) + len(self.in_flight)
+
+    def send(self, body):
+        body = body if isinstance(body, str) else json.dumps(body)
+        self.visible.append({"messageId": f"msg-{next(self.ids):06d}", "body": body, "receiveCount": 0})
+
+    def send_s3_event(self, event):
+        """One message per S3 record, as an S3 notification to SQS delivers them."""
+        for record in event.get("Records", []):
+            self.send({"Records": [record]})
+
+    def receive_event(self, batch_size=10):
+        records = []
+        while self.visible and len(records) < batch_size:
+            message = self.visible.popleft()
+            message["receiveCount"] += 1
+            self.receives += 1
+            if message["receiveCount"] > 1:
+                self.redeliveries += 1
+            self.in_flight[message["messageId"]] = message
+            records.append({
+                "messageId": message["messageId"],
+                "receiptHandle": f"{message['messageId']}-{message['receiveCount']}",
+                "body": message["body"],
+                "attributes": {"ApproximateReceiveCount": str(message["receiveCount"])},
+                "eventSource": "aws:sqs",
+                "eventSourceARN": self.arn,
+            })
+        return {"Records": records}
+
+    def settle(self, event, response=None, error=None):
+        """Delete or requeue the messages of event given the handler's response or exception."""
+        ids = [record["messageId"] for record in event["Records"]]
+        if error is not None or not isinstance(response, dict) or "batchItemFailures" not in response:
+            failed = set(ids) if error is not None else set()
+        else:
+            failed = {item["itemIdentifier"] for item in response["batchItemFailures"]}
+        for message_id in ids:
+            message = self.in_flight.pop(message_id)
+            if message_id not in failed:
+                continue
+            if message["receiveCount"] >= self.max_receives:
+                self.dead_letters.append(message)
+            else:
+                self.visible.append(message)
+        return failed
@@ -0,0 +1,311 @@
+"""End-to-end load test: replay S3 event batches through the Lambda handlers locally.
+
+python backend/lambda/Lambda_Funcs/benchmarks/load_test.py \
+  --handlers middle,small \
+  --uploads 40 --batch-size 10 --folders 2 --folder-size 10 --deletes 20 \
+  --sns \
+  --latency-ms 20 \
+  --env INDEX_LAYOUT=both --env UNIFIED_PIPELINE=0
+
+python backend/lambda/Lambda_Funcs/benchmarks/load_test.py --queue --corrupt 2
+
+Both handlers run in-process against fake_s3.FakeS3 (in memory, or one file per
+key under --store-dir) instead of boto3. The synthetic stream is: single-image
+uploads in batches of --batch-size records, folder uploads (folder marker record
+for a prefix already holding --folder-size images), then bulk deletes of earlier
+uploads; --sns wraps every other batch in an SNS envelope, as iter_s3_records
+sees it from the fan-out topic. --events replays recorded Lambda events instead
+(a JSON list or JSON lines); their keys are seeded with synthetic images.
+
+--queue delivers the same records through fake_sqs.FakeQueue instead (one message
+per S3 record, SNS-wrapped batches as SNS notifications), in SQS batches of
+--batch-size, settling each batch from the handler's batchItemFailures;
+--corrupt N seeds the first N uploads with bytes that are not an image, so the
+report shows how many receives the failures cost.
+
+--duplicates N repeats every upload record N more times in its batch (the put/
+overwrite churn of `aws s3 sync`), which the handlers' coalescing should absorb.
+
+Reported per handler: records/sec, p50/p99 per-record latency (time between
+coalesce_records yields, so it covers the work done for that record), p50/p99
+per-invocation latency and the S3 calls and bytes it made; --stages adds the
+per-stage summary of the handlers' own run metrics (MetricsAggregator).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HANDLER_PATHS = {
+    "middle": (os.path.join(HERE, "..", "add_update_compress_middle"), "new_webp_middle"),
+    "small": (os.path.join(HERE, "..", "add_update_compress_small_with_info(lambda_only)"), "new_piexifV3"),
+}
+
+from corpus import encode, photo_array  # noqa: E402
+from fake_s3 import FakeS3  # noqa: E402
+from fake_sqs import FakeQueue  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+class FakeContext:
+    """The bits of the Lambda context object the handlers may use."""
+
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+        self.function_name = "load-test"
+        self.aws_request_id = "load-test"
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay S3 events through the handlers.")
+    parser.add_argument("--handlers", default="middle,small")
+    parser.add_argument("--events", help="recorded events (JSON list or JSON lines)")
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--folders", type=int, default=1)
+    parser.add_argument("--folder-size", type=int, default=5)
+    parser.add_argument("--deletes", type=int, default=10)
+    parser.add_argument("--duplicates", type=int, default=0, help="extra copies of each upload record")
+    parser.add_argument("--sns", action="store_true", help="wrap every other batch in SNS")
+    parser.add_argument("--queue", action="store_true", help="deliver through an in-memory SQS queue")
+    parser.add_argument("--max-receives", type=int, default=3, help="queue receives before dead-lettering")
+    parser.add_argument("--corrupt", type=int, default=0, help="uploads seeded with non-image bytes")
+    parser.add_argument("--image-width", type=int, default=800)
+    parser.add_argument("--image-height", type=int, default=600)
+    parser.add_argument("--distinct-images", type=int, default=8)
+    parser.add_argument("--store-dir", help="filesystem-backed store instead of memory")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--timeout-ms", type=int, default=900000)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="set before the handler modules are imported")
+    parser.add_argument("--stages", action="store_true", help="print the per-stage metrics summary")
+    parser.add_argument("--verbose", action="store_true", help="keep the handlers' own prints")
+    args = parser.parse_args()
+
+    for item in args.env:
+        name, _, value = item.partition("=")
+        os.environ[name] = value
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    images = [
+        encode(Image.fromarray(photo_array(args.image_width, args.image_height, seed)), "JPEG", quality=92)
+        for seed in range(args.distinct_images)
+    ]
+    if args.events:
+        events = load_events(args.events)
+    else:
+        events = synthetic_events(args)
+
+    s3 = FakeS3(root=args.store_dir, latency_ms=args.latency_ms)
+    seed_objects(s3, events, images)
+    for key in events.get("uploads", [])[:args.corrupt]:
+        s3.seed(key, b"not an image", "image/jpeg")
+
+    for name in args.handlers.split(","):
+        module = load_handler(name, s3)
+        aggregator = module.MetricsAggregator()
+        module.METRICS_SINKS.append(aggregator)
+        stats = replay(module, events, s3, args)
+        report(name, stats, s3)
+        if args.stages:
+            aggregator.print_summary()
+        # Both handlers share photo_pipeline.METRICS_SINKS.
+        module.METRICS_SINKS.remove(aggregator)
+
+
+def load_handler(name, s3):
+    path, module_name = HANDLER_PATHS[name]
+    sys.path.insert(0, path)
+    module = __import__(module_name)
+    module.s3 = s3
+    # The deleter, caches and profile upload use the shared module's client.
+    module.photo_pipeline.s3 = s3
+    return module
+
+
+def synthetic_events(args):
+    """{"events": [event], "folders": {prefix: [image keys]}} for uploads, folder uploads and deletes."""
+    uploads = [f"public/load/upload_{index:05d}.jpg" for index in range(args.uploads)]
+    batches = []
+    for start in range(0, len(uploads), args.batch_size):
+        keys = uploads[start:start + args.batch_size]
+        batches.append(("ObjectCreated:Put", keys * (1 + args.duplicates)))
+    for folder in range(args.folders):
+        prefix = f"public/load/folder_{folder:03d}/"
+        batches.append(("ObjectCreated:Put", [prefix]))
+    deleted = uploads[:args.deletes]
+    for start in range(0, len(deleted), args.batch_size):
+        batches.append(("ObjectRemoved:Delete", deleted[start:start + args.batch_size]))
+
+    events = []
+    for index, (event_name, keys) in enumerate(batches):
+        event = {"Records": [s3_record(event_name, key) for key in keys]}
+        if args.sns and index % 2 == 1:
+            event = {"Records": [{"EventSource": "aws:sns", "Sns": {"Message": json.dumps(event)}}]}
+        events.append(event)
+    folder_keys = {
+        f"public/load/folder_{folder:03d}/": [
+            f"public/load/folder_{folder:03d}/image_{index:04d}.jpg" for index in range(args.folder_size)
+        ]
+        for folder in range(args.folders)
+    }
+    return {"events": events, "folders": folder_keys, "uploads": uploads}
+
+
+def s3_record(event_name, key, size=None):
+    obj = {"key": key.replace(" ", "+")}
+    if size is not None:
+        obj["size"] = size
+    return {"eventSource": "aws:s3", "eventName": event_name, "s3": {"object": obj}}
+
+
+def load_events(path):
+    with open(path, encoding="utf-8") as handle:
+        text = handle.read().strip()
+    events = json.loads(text) if text.startswith("[") else [json.loads(line) for line in text.splitlines() if line]
+    return {"events": events, "folders": {}}
+
+
+def iter_records(event):
+    for record in event.get("Records", []):
+        if "s3" in record:
+            yield record
+        elif "Sns" in record:
+            yield from iter_records(json.loads(record["Sns"]["Message"]))
+
+
+def seed_objects(s3, stream, images):
+    """Every key an ObjectCreated record names (and every folder's images) gets an image."""
+    counter = 0
+    for event in stream["events"]:
+        for record in iter_records(event):
+            key = record["s3"]["object"]["key"].replace("+", " ")
+            if not record["eventName"].startswith("ObjectCreated:"):
+                continue
+            if key.endswith("/"):
+                s3.seed(key, b"")
+                for image_key in stream["folders"].get(key, []):
+                    s3.seed(image_key, images[counter % len(images)], "image/jpeg")
+                    counter += 1
+            else:
+                body = images[counter % len(images)]
+                counter += 1
+                s3.seed(key, body, "image/jpeg")
+                record["s3"]["object"]["size"] = len(body)
+    # SNS envelopes carry a serialized copy; refresh it with the sizes just added.
+    for event in stream["events"]:
+        for record in event.get("Records", []):
+            if "Sns" in record:
+                inner = json.loads(record["Sns"]["Message"])
+                for inner_record in inner["Records"]:
+                    key = inner_record["s3"]["object"]["key"].replace("+", " ")
+                    obj = s3.store.get(key)
+                    if obj is not None and not key.endswith("/"):
+                        inner_record["s3"]["object"]["size"] = len(obj.body)
+                record["Sns"]["Message"] = json.dumps(inner)
+
+
+def replay(module, stream, s3, args):
+    record_latencies = []
+    invocation_latencies = []
+    original_coalesce = module.coalesce_records
+
+    def timed_coalesce(records):
+        last = time.perf_counter()
+        for record in original_coalesce(records):
+            yield record
+            now = time.perf_counter()
+            record_latencies.append(now - last)
+            last = now
+
+    module.coalesce_records = timed_coalesce
+    queue = fill_queue(stream, args) if args.queue else None
+    s3.reset_counters()
+    start = time.perf_counter()
+    try:
+        for event in iter_invocations(stream, queue, args):
+            began = time.perf_counter()
+            response = error = None
+            try:
+                response = invoke(module, event, args)
+            except Exception as e:
+                if queue is None:
+                    raise
+                error = e
+            invocation_latencies.append(time.perf_counter() - began)
+            if queue is not None:
+                queue.settle(event, response, error)
+    finally:
+        module.coalesce_records = original_coalesce
+    return {
+        "wall": time.perf_counter() - start,
+        "records": record_latencies,
+        "invocations": invocation_latencies,
+        "queue": queue,
+    }
+
+
+def invoke(module, event, args):
+    if args.verbose:
+        return module.lambda_handler(event, FakeContext(args.timeout_ms))
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            return module.lambda_handler(event, FakeContext(args.timeout_ms))
+        finally:
+            sys.stdout = stdout
+
+
+def fill_queue(stream, args):
+    queue = FakeQueue(max_receives=args.max_receives)
+    for event in stream["events"]:
+        for record in event.get("Records", []):
+            if "Sns" in record:
+                queue.send({"Type": "Notification", "Message": record["Sns"]["Message"]})
+            else:
+                queue.send({"Records": [record]})
+    return queue
+
+
+def iter_invocations(stream, queue, args):
+    if queue is None:
+        yield from stream["events"]
+        return
+    while queue.visible:
+        yield queue.receive_event(args.batch_size)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(name, stats, s3):
+    records = stats["records"]
+    invocations = stats["invocations"]
+    print(f"== {name}: {len(invocations)} invocations, {len(records)} records in {stats['wall']:.2f}s")
+    print(f"   records/sec       {len(records) / stats['wall'] if stats['wall'] else 0:.2f}")
+    print(f"   per record  ms    p50 {percentile(records, 0.5) * 1000:.1f}  "
+          f"p99 {percentile(records, 0.99) * 1000:.1f}  "
+          f"mean {statistics.mean(records) * 1000 if records else 0:.1f}")
+    print(f"   per invoke  ms    p50 {percentile(invocations, 0.5) * 1000:.1f}  "
+          f"p99 {percentile(invocations, 0.99) * 1000:.1f}")
+    calls = ", ".join(f"{operation} {count}" for operation, count in sorted(s3.calls.items()))
+    print(f"   S3 calls          {calls}")
+    print(f"   S3 bytes          read {s3.bytes_out / 1024:.0f} KB, written {s3.bytes_in / 1024:.0f} KB")
+    queue = stats["queue"]
+    if queue is not None:
+        print(f"   queue             receives {queue.receives}, redeliveries {queue.redeliveries}, "
+              f"dead letters {len(queue.dead_letters)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 import json
+import os
+import sys
 import boto3
 import urllib.parse
 from PIL import Image
 import io
+from os.path import splitext
+
+# 读取 APP1 段的代码与其他处理函数共用 ../shared/exif_segment.py, 部署时一起打包 (或放进层)
+try:
+    from exif_segment import read_exif_segment
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+    from exif_segment import read_exif_segment
 
 # 初始化 S3 客户端
 s3 = boto3.client('s3')
@@ -25,15 +35,22 @@ def lambda_handler(event, context):
     bucket_name = 'marcus-photograph-garage'
 
     try:
-        # 获取图片对象
-        response = s3.get_object(Bucket=bucket_name, Key=photo_key)
-        image_content = response['Body'].read()
+        if splitext(photo_key)[1].lower() in ('.jpg', '.jpeg'):
+            # JPEG 只读取开头的 APP1 段, 不下载整张原图
+            exif_data = Image.Exif()
+            segment = read_exif_segment(s3, bucket_name, photo_key)
+            if segment is not None:
+                exif_data.load(segment)
+        else:
+            # 获取图片对象
+            response = s3.get_object(Bucket=bucket_name, Key=photo_key)
+            image_content = response['Body'].read()
 
-        # 使用Pillow读取图片
-        image = Image.open(io.BytesIO(image_content))
+            # 使用Pillow读取图片
+            image = Image.open(io.BytesIO(image_content))
 
-        # 获取EXIF信息
-        exif_data = image.getexif()
+            # 获取EXIF信息
+            exif_data = image.getexif()
         if not exif_data:
             print("No EXIF data found")
             return {
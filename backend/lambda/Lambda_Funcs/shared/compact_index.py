@@ -0,0 +1,43 @@
+"""紧凑索引: 公共 base_url + 按文件夹嵌套的相对路径, 另写 gzip / brotli 预压缩变体。
+new_piexifV3、rebuild_photo_list_tracker 与 backfill_public_index 共用; 部署时与处理函数一起打包 (或放进层)。
+"""
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:  # 层中 (或本地) 没有 brotli 时只写 gzip 变体
+    brotli = None
+
+COMPACT_INDEX_KEY = "public_small/photo_index_compact.json"
+COMPACT_INDEX_FORMAT = "compact-v1"
+
+
+def build_compact_index(keys, base_url):
+    """{"format", "base_url", "count", "tree"}; tree 节点: {"d": {子文件夹: 节点}, "f": [文件名]}"""
+    tree = {}
+    for key in sorted(keys):
+        *folders, name = key.split('/')
+        node = tree
+        for folder in folders:
+            node = node.setdefault('d', {}).setdefault(folder, {})
+        node.setdefault('f', []).append(name)
+    return {'format': COMPACT_INDEX_FORMAT, 'base_url': base_url, 'count': len(keys), 'tree': tree}
+
+
+def write_compact_index(s3, bucket, key, index):
+    """写入原始 JSON 以及 gzip / brotli 预压缩变体, 变体带 Content-Encoding 由浏览器直接解压"""
+    body = json.dumps(index, separators=(',', ':')).encode()
+    variants = [(key, body, None), (f"{key}.gz", gzip.compress(body, compresslevel=9, mtime=0), 'gzip')]
+    if brotli is not None:
+        variants.append((f"{key}.br", brotli.compress(body, quality=11), 'br'))
+    for variant_key, variant_body, encoding in variants:
+        extra = {'ContentEncoding': encoding} if encoding else {}
+        s3.put_object(
+            Bucket=bucket,
+            Key=variant_key,
+            Body=variant_body,
+            ContentType='application/json',
+            **extra
+        )
+        print(f"Wrote {len(variant_body)} bytes to s3://{bucket}/{variant_key}")
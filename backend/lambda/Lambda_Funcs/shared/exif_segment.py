@@ -0,0 +1,63 @@
+"""JPEG 的 APP1 Exif 段: 只用 Range 请求读取原图开头, 不下载整张原图。
+new_piexif、new_piexifV3 与 pic_info_get_test/old_pillow 共用; 部署时与处理函数一起打包 (或放进层)。
+"""
+from botocore.exceptions import ClientError
+
+# EXIF 只需要 JPEG 开头的 APP1 段: 先读这么多字节, APP1 更长时再扩大范围
+EXIF_HEADER_BYTES = 64 * 1024
+
+
+def read_exif_segment(s3, bucket, key, initial_bytes=EXIF_HEADER_BYTES):
+    """
+    只用 Range 请求读取原图开头的字节, 返回 APP1 Exif 段 (以 Exif 头开头), 没有时返回 None。
+    APP1 (或它前面的段) 超出已读范围时按需扩大范围, 全程不落盘。
+    """
+    data = b''
+    end = initial_bytes
+    while True:
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(data)}-{end - 1}")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':  # 文件比已读部分还短
+                return None
+            raise
+        data += response['Body'].read()
+        segment, needed = find_exif_segment(data)
+        total = int(response.get('ContentRange', '').rsplit('/', 1)[-1] or len(data))
+        if segment is not None or needed is None or len(data) >= total:
+            return segment
+        end = min(max(needed, len(data) * 2), total)
+
+
+def find_exif_segment(data):
+    """
+    遍历 JPEG 标记找到 APP1 Exif 段。
+    :return: (segment, needed): 找到时 segment 为段内容; 数据不够时 needed 为至少需要读到的字节位置;
+             不是 JPEG 或遇到图像数据 (SOS) 仍未找到时两者都为 None
+    """
+    if data[:2] != b'\xff\xd8':
+        return None, None
+    offset = 2
+    while True:
+        if offset + 4 > len(data):
+            return None, offset + 4
+        if data[offset] != 0xFF:
+            return None, None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # 填充字节
+            offset += 1
+            continue
+        if marker in (0xD9, 0xDA):
+            return None, None
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # 无长度的标记
+            offset += 2
+            continue
+        end = offset + 2 + int.from_bytes(data[offset + 2:offset + 4], 'big')
+        if marker == 0xE1:
+            if offset + 10 > len(data):
+                return None, offset + 10
+            if data[offset + 4:offset + 10] == b'Exif\x00\x00':
+                if end > len(data):
+                    return None, end
+                return data[offset + 4:end], None
+        offset = end
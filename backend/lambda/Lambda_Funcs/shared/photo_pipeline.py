@@ -0,0 +1,1582 @@
+"""public_middle 的 WebP 压缩与各处理函数共用的指标、性能分析、批量删除和派生缓存。
+Used by new_webp_middle (the public_middle Lambda), the unified pipeline of
+new_piexifV3 and backfill_public_middle. Deploy it with each function (next to the
+handler in the zip, or in a layer); run from the repo, they find it in ../shared.
+
+WebP algorithm steps (compress_to_webp / compress_image_to_webp):
+1) Read image, fix EXIF orientation.
+2) Classify the content on a small sample (NumPy): mostly flat graphics try
+   lossless WebP (near-lossless above a palette of colours), photos go straight
+   to lossy; keep a lossless result if <= target. Without NumPy (or with
+   CONTENT_CLASSIFIER=0) lossless is tried only when original <= target size.
+3) If >25MB: resize to max_dim before lossy steps (JPEG: DCT-scaled draft decode).
+4) Lossy WebP quality ladder (step/limit) until <= target or min_quality.
+5) If still > target: resize to max_dim (if larger), then repeat ladder.
+6) If resized result < target * min_target_ratio: raise quality back up.
+7) If already <= max_dim and still > target: continue down to fallback_min_quality.
+With quality_search="bisect" (default), steps 4-7 run as a bounded search instead:
+the byte target is bracketed over [min_quality, quality] with secant steps, every
+(quality, size) already encoded is reused, and at most max_search_encodes encodes
+are spent per phase; the highest quality under target wins. With predict_quality,
+each phase first encodes a small tile mosaic at 2-3 qualities, fits log(bytes per
+pixel) against quality and starts the search at the extrapolated quality.
+Search and ladder encodes run at a cheap WEBP_SEARCH_METHOD; only the chosen quality
+is encoded again at method 6 (finalize_webp), with one correction step if that
+final encode lands over target. How far the two efforts differ in size depends on
+the image and the quality, so for large images the mosaic is encoded at both and
+the searches aim at target divided by this image's ratio; when nothing fits at
+search effort, the closest candidate is checked at method 6 before the image is
+resized. The lossy
+search starts at the classifier's estimated quality when the mosaic prediction is
+off or the image is too small.
+
+Metrics: track_run (or bind_run) makes a RunMetrics the current run of a thread;
+metrics_stage/count/set record into it and are no-ops without one. Inside
+metrics_prefix(prefix) every name is prefixed, so a caller producing several
+derivatives in one run keeps the WebP names apart (new_piexifV3 uses "middle_").
+Finished runs are printed in CloudWatch embedded metric format (METRICS=0 turns it
+off) and passed to every object in METRICS_SINKS, e.g. a MetricsAggregator.
+
+PROFILE_EVERY=N runs 1 in N maybe_profile blocks under cProfile and tracemalloc and
+writes the stats, the top allocation sites and peak RSS to PROFILE_DIR, and to
+s3://<bucket>/PROFILE_S3_PREFIX/ when that is set (0, the default, is off). The
+stats cover the worker threads started inside the block, merged into one report.
+
+iter_s3_records yields the S3 records of an event, direct or wrapped in SNS; SQS
+batches are split per message by queue_message_event. coalesce_records (and
+coalesce_queue_messages, across the messages of a batch) reduces the records to
+the final intended state of each key before any work is done, so an upload removed
+again within the batch costs no encode and objects under a created folder are
+listed only once.
+
+fan_out calls a handler for every object under a folder prefix on a thread pool,
+listing page by page; when the Lambda runs low on time it stops starting keys and
+hands the rest back to an asynchronous re-invocation (hand_back_folder), which
+needs lambda:InvokeFunction on the function itself.
+
+download_object fetches large originals as parallel byte ranges into one buffer,
+every range pinned to the same version with IfMatch.
+
+BatchDeleter removes keys with delete_objects (up to 1000 keys per call,
+DELETE_WORKERS calls in flight). DERIVATIVE_CACHE=s3|local (build_derivative_cache)
+keeps derivatives under a key made of the source MD5 and the encoder params.
+"""
+import contextlib
+import cProfile
+import hashlib
+import io
+import json
+import math
+import os
+import pstats
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from urllib.parse import quote_plus, unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps, ImageSequence
+
+try:
+    import numpy as np
+except ImportError:  # without NumPy, lossless is tried by source size only
+    np = None
+
+s3 = boto3.client("s3")
+
+# Quality prediction: a PROXY_GRID x PROXY_GRID mosaic of PROXY_TILE_SIZE tiles,
+# aiming PROXY_MARGIN under target; skipped for images near the mosaic size.
+PROXY_TILE_SIZE = 128
+PROXY_GRID = 4
+PROXY_MARGIN = 0.95
+PROXY_MIN_AREA_RATIO = 4
+# The mosaic is also encoded at final effort (to measure the effort ratio) only for
+# images of at least this many mosaics, where a full final encode costs far more.
+PROXY_CALIBRATE_AREA_RATIO = 16
+
+RESIZE_REDUCING_GAP = 3.0
+
+# Two-tier effort: searches encode at WEBP_SEARCH_METHOD, then only the chosen quality
+# is encoded at WEBP_FINAL_METHOD. Searches aim at target / the final-to-search size
+# ratio measured on the image's mosaic; WEBP_EFFORT_RATIO is assumed for smaller
+# images (their final encode is cheap to correct).
+WEBP_SEARCH_METHOD = int(os.environ.get("WEBP_SEARCH_METHOD", "2"))
+WEBP_FINAL_METHOD = 6
+WEBP_EFFORT_RATIO = float(os.environ.get("WEBP_EFFORT_RATIO", "1.0"))
+
+# Content classifier (needs NumPy): a nearest-neighbour sample of at most
+# CLASSIFY_MAX_SIDE pixels a side picks the WebP mode before any encode. Mostly
+# flat images (graphics, screenshots) go lossless when their sampled colours fit
+# a palette (LOSSLESS_MAX_COLORS), near-lossless up to NEAR_LOSSLESS_MAX_COLORS;
+# the rest is lossy, starting from a quality estimated from edge density. The
+# bits-per-pixel bounds of that estimate were fitted on the benchmark corpus at q86.
+CONTENT_CLASSIFIER = os.environ.get("CONTENT_CLASSIFIER", "1") == "1"
+CLASSIFY_MAX_SIDE = 256
+CLASSIFY_EDGE_THRESHOLD = 32
+GRAPHIC_FLAT_RATIO = 0.5
+LOSSLESS_MAX_COLORS = 256
+NEAR_LOSSLESS_MAX_COLORS = 4096
+NEAR_LOSSLESS_BITS = 2
+CLASSIFY_FLAT_BPP = 0.3
+CLASSIFY_BUSY_BPP = 4.0
+QUALITY_HALVING_STEPS = 20
+
+# Bump to invalidate cached derivatives after an encoder change.
+DERIVATIVE_CACHE_VERSION = 3
+
+# Originals that get a public_middle WebP (new_webp_middle, the unified pipeline of
+# new_piexifV3, backfill_public_middle); the public_small path takes fewer formats.
+MIDDLE_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff"}
+
+# Parallel ranged GET for large originals (download_object); smaller objects use a
+# single GET.
+DOWNLOAD_PARALLEL_BYTES = int(float(os.environ.get("DOWNLOAD_PARALLEL_MB", "16")) * 1024 * 1024)
+DOWNLOAD_PART_BYTES = int(float(os.environ.get("DOWNLOAD_PART_MB", "8")) * 1024 * 1024)
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_READ_BYTES = 1024 * 1024
+
+# delete_objects accepts at most 1000 keys per request.
+DELETE_BATCH_SIZE = 1000
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", "4"))
+
+METRICS_ENABLED = os.environ.get("METRICS", "1") == "1"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "PhotographGarage")
+# Objects with add(run_dict); every finished run is passed to each of them.
+METRICS_SINKS = []
+
+_metrics_local = threading.local()
+
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_S3_PREFIX = os.environ.get("PROFILE_S3_PREFIX", "")
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "30"))
+PROFILE_TRACE_FRAMES = 8
+
+_lambda_client = None
+
+
+def compress_to_webp(
+    image_content,
+    target_size_kb,
+    quality,
+    min_quality,
+    max_dim,
+    min_target_ratio,
+    fallback_min_quality,
+    large_image_mb,
+    quality_step,
+    max_quality_steps,
+    quality_search="bisect",
+    max_search_encodes=4,
+    predict_quality=True,
+):
+    with metrics_stage("decode"):
+        image = Image.open(io.BytesIO(image_content))
+        metrics_set(source_size=list(image.size))
+        if len(image_content) > large_image_mb * 1024 * 1024:
+            # Large originals are cut to max_dim anyway: let the JPEG decoder do a
+            # DCT-scaled (1/2, 1/4, 1/8) decode that stays >= max_dim (no-op otherwise).
+            image.draft(None, scaled_size(image.size, max_dim))
+            metrics_set(draft_size=list(image.size))
+        image.load()
+    with metrics_stage("transpose"):
+        image = ImageOps.exif_transpose(image)
+
+    if getattr(image, "is_animated", False):
+        image = ImageSequence.Iterator(image).__next__()
+
+    return compress_image_to_webp(
+        image,
+        len(image_content),
+        target_size_kb=target_size_kb,
+        quality=quality,
+        min_quality=min_quality,
+        max_dim=max_dim,
+        min_target_ratio=min_target_ratio,
+        fallback_min_quality=fallback_min_quality,
+        large_image_mb=large_image_mb,
+        quality_step=quality_step,
+        max_quality_steps=max_quality_steps,
+        quality_search=quality_search,
+        max_search_encodes=max_search_encodes,
+        predict_quality=predict_quality,
+    )
+
+
+def compress_image_to_webp(
+    image,
+    source_size,
+    target_size_kb,
+    quality,
+    min_quality,
+    max_dim,
+    min_target_ratio,
+    fallback_min_quality,
+    large_image_mb,
+    quality_step,
+    max_quality_steps,
+    quality_search="bisect",
+    max_search_encodes=4,
+    predict_quality=True,
+):
+    """Steps 2-7 on an already decoded, orientation-fixed image.
+
+    source_size is the byte size of the original object, which drives the
+    lossless and large-image decisions.
+    """
+    with metrics_stage("normalize"):
+        image = normalize_mode(image)
+    if source_size > large_image_mb * 1024 * 1024:
+        image = ensure_max_dimension(image, max_dim)
+
+    content = classify_content(image, target_size_kb * 1024, quality, min_quality)
+    if content is None:
+        # Unclassified: lossless is only worth a try for originals already under target.
+        mode = "lossless" if source_size <= target_size_kb * 1024 else "lossy"
+        start = None
+    else:
+        mode, start = content
+    if mode != "lossy":
+        source = near_lossless_image(image, NEAR_LOSSLESS_BITS) if mode == "near_lossless" else image
+        lossless = encode_webp(source, quality, lossless=True)
+        if len(lossless) <= target_size_kb * 1024:
+            metrics_set(lossless=True, quality=quality)
+            return lossless
+
+    if quality_search == "bisect":
+        return bisect_to_webp(
+            image,
+            target_size_kb=target_size_kb,
+            quality=quality,
+            min_quality=min_quality,
+            max_dim=max_dim,
+            min_target_ratio=min_target_ratio,
+            fallback_min_quality=fallback_min_quality,
+            max_search_encodes=max_search_encodes,
+            predict_quality=predict_quality,
+            start_quality=start,
+        )
+
+    start_quality = quality
+    encoded_image = image
+    low = min_quality
+    compressed = encode_webp(image, quality, lossless=False)
+    steps = 0
+    while (
+        len(compressed) > target_size_kb * 1024
+        and quality > min_quality
+        and steps < max_quality_steps
+    ):
+        quality = max(min_quality, quality - quality_step)
+        compressed = encode_webp(image, quality, lossless=False)
+        steps += 1
+
+    finals = {}
+    if len(compressed) > target_size_kb * 1024 and fits_at_final_effort(
+        image, quality, compressed, finals, target_size_kb * 1024
+    ):
+        return finalize_webp(
+            image,
+            quality,
+            {quality: compressed},
+            target_size_kb * 1024,
+            min_target_ratio,
+            low,
+            max_quality_steps,
+            finals,
+        )
+
+    if len(compressed) > target_size_kb * 1024:
+        resized = ensure_max_dimension(image, max_dim)
+        if resized is not image:
+            finals = {}
+            quality = max(quality, min_quality)
+            encoded_image = resized
+            compressed = encode_webp(resized, quality, lossless=False)
+            steps = 0
+            while (
+                len(compressed) > target_size_kb * 1024
+                and quality > min_quality
+                and steps < max_quality_steps
+            ):
+                quality = max(min_quality, quality - quality_step)
+                compressed = encode_webp(resized, quality, lossless=False)
+                steps += 1
+
+            min_target_bytes = int(target_size_kb * 1024 * min_target_ratio)
+            steps = 0
+            while len(compressed) < min_target_bytes and quality < start_quality:
+                quality = min(start_quality, quality + quality_step)
+                compressed = encode_webp(resized, quality, lossless=False)
+                steps += 1
+                if steps >= max_quality_steps:
+                    break
+        else:
+            low = fallback_min_quality
+            steps = 0
+            while (
+                len(compressed) > target_size_kb * 1024
+                and quality > fallback_min_quality
+                and steps < max_quality_steps
+            ):
+                quality = max(fallback_min_quality, quality - quality_step)
+                compressed = encode_webp(image, quality, lossless=False)
+                steps += 1
+
+    return finalize_webp(
+        encoded_image,
+        quality,
+        {quality: compressed},
+        target_size_kb * 1024,
+        min_target_ratio,
+        low,
+        max_quality_steps,
+        finals,
+    )
+
+
+def bisect_to_webp(
+    image,
+    target_size_kb,
+    quality,
+    min_quality,
+    max_dim,
+    min_target_ratio,
+    fallback_min_quality,
+    max_search_encodes,
+    predict_quality,
+    start_quality=None,
+):
+    target_bytes = target_size_kb * 1024
+    tried = {}
+    finals = {}
+    found = search_for_target(
+        image,
+        target_bytes,
+        min_target_ratio,
+        min_quality,
+        quality,
+        max_search_encodes,
+        tried,
+        finals,
+        predict_quality,
+        start_quality,
+    )
+    if found is not None:
+        return finalize_webp(
+            image, found, tried, target_bytes, min_target_ratio, min_quality, max_search_encodes, finals
+        )
+
+    resized = ensure_max_dimension(image, max_dim)
+    if resized is not image:
+        low = min_quality
+        tried = {}
+        finals = {}
+    else:
+        low = fallback_min_quality
+
+    found = search_for_target(
+        resized,
+        target_bytes,
+        min_target_ratio,
+        low,
+        quality,
+        max_search_encodes,
+        tried,
+        finals,
+        predict_quality,
+    )
+    if found is None:
+        found = min(q for q in tried if low <= q <= quality)
+    return finalize_webp(
+        resized, found, tried, target_bytes, min_target_ratio, low, max_search_encodes, finals
+    )
+
+
+def search_for_target(
+    image,
+    target_bytes,
+    min_target_ratio,
+    low,
+    high,
+    max_encodes,
+    tried,
+    finals,
+    predict_quality,
+    start=None,
+):
+    """One search phase of bisect_to_webp at search effort, aimed at the final size.
+
+    tried and finals (quality -> search / final effort encodes of image) are
+    filled in place. Returns the quality to finalize, or None when even the
+    closest candidate is over target_bytes at final effort.
+    """
+    ratio = WEBP_EFFORT_RATIO
+    if predict_quality:
+        prediction = predict_webp_quality(image, target_bytes, low, high)
+        if prediction is not None:
+            start, ratio = prediction
+    # Searches measure search-effort sizes: aim where the final encode should land.
+    search_target_bytes = int(target_bytes / ratio)
+    found = search_webp_quality(
+        image,
+        search_target_bytes,
+        int(search_target_bytes * min_target_ratio),
+        low,
+        high,
+        max_encodes,
+        tried,
+        start,
+    )
+    if len(tried[found]) <= search_target_bytes:
+        return found
+    if not fits_at_final_effort(image, found, tried[found], finals, target_bytes):
+        return None
+
+    # The final encode fits where the search encode did not: search upwards with
+    # the ratio measured at this quality.
+    search_target_bytes = int(target_bytes * len(tried[found]) / len(finals[found]))
+    return search_webp_quality(
+        image,
+        search_target_bytes,
+        int(search_target_bytes * min_target_ratio),
+        found,
+        high,
+        max_encodes,
+        tried,
+    )
+
+
+def fits_at_final_effort(image, quality, encoded, finals, target_bytes):
+    """Whether the search-effort encode over target fits once encoded at final effort.
+
+    The final encode is kept in finals, so finalize_webp does not repeat it.
+    """
+    if WEBP_SEARCH_METHOD == WEBP_FINAL_METHOD:
+        return len(encoded) <= target_bytes
+    if quality not in finals:
+        finals[quality] = encode_webp(image, quality, lossless=False, final=True)
+    return len(finals[quality]) <= target_bytes
+
+
+def search_webp_quality(
+    image,
+    target_bytes,
+    min_target_bytes,
+    low,
+    high,
+    max_encodes,
+    tried,
+    start=None,
+):
+    """Bracket target_bytes over [low, high] and return the best fit.
+
+    tried maps quality -> encoded bytes for this image; it is filled in place so
+    a later search on the same image never re-encodes a quality it already saw.
+    start, when given, is encoded first (e.g. a predicted quality).
+    Returns the highest quality whose encode is <= target_bytes, otherwise the
+    lowest quality attempted.
+    """
+    max_encodes = max(1, max_encodes)
+    encodes = 0
+    while True:
+        fit_quality, over_quality = split_tried(tried, target_bytes, low, high)
+        candidate = next_search_quality(
+            tried,
+            fit_quality,
+            over_quality,
+            target_bytes,
+            min_target_bytes,
+            low,
+            high,
+            start,
+        )
+        if candidate is None or encodes >= max_encodes:
+            break
+        tried[candidate] = encode_webp(image, candidate, lossless=False)
+        encodes += 1
+
+    if fit_quality is not None:
+        return fit_quality
+    return min(q for q in tried if low <= q <= high)
+
+
+def finalize_webp(image, quality, tried, target_bytes, min_target_ratio, low, max_encodes, finals=None):
+    """Encode the quality a search picked once more at WEBP_FINAL_METHOD.
+
+    tried maps quality -> search-effort encode of image, finals quality -> final
+    encodes already made (reused, and filled in place). If the final encode lands
+    over target_bytes, one correction: the search runs again over [low, quality - 1],
+    aimed with the final/search size ratio measured here, and its pick is encoded at
+    final effort. If that misses too, the highest-quality encode under target is
+    kept (final effort first); if nothing fits, the smallest encode made.
+    """
+    if WEBP_SEARCH_METHOD == WEBP_FINAL_METHOD:
+        metrics_set(lossless=False, quality=quality)
+        return tried[quality]
+
+    finals = {} if finals is None else finals
+    if quality not in finals:
+        finals[quality] = encode_webp(image, quality, lossless=False, final=True)
+    final = finals[quality]
+    ratio = len(final) / len(tried[quality])
+    metrics_set(effort_ratio=round(ratio, 4))
+    if len(final) > target_bytes and quality > low:
+        corrected_bytes = int(target_bytes / ratio)
+        quality = search_webp_quality(
+            image,
+            corrected_bytes,
+            int(corrected_bytes * min_target_ratio),
+            low,
+            quality - 1,
+            max_encodes,
+            tried,
+        )
+        if quality not in finals:
+            finals[quality] = encode_webp(image, quality, lossless=False, final=True)
+        final = finals[quality]
+
+    if len(final) > target_bytes:
+        for encodes in (finals, tried):
+            fits = [q for q, data in encodes.items() if len(data) <= target_bytes]
+            if fits:
+                quality = max(fits)
+                final = encodes[quality]
+                break
+        else:
+            quality, final = min(
+                list(finals.items()) + list(tried.items()), key=lambda item: len(item[1])
+            )
+    metrics_set(lossless=False, quality=quality)
+    return final
+
+
+def split_tried(tried, target_bytes, low, high):
+    fit_quality = None
+    over_quality = None
+    for q, data in tried.items():
+        if not low <= q <= high:
+            continue
+        if len(data) <= target_bytes:
+            fit_quality = q if fit_quality is None else max(fit_quality, q)
+        else:
+            over_quality = q if over_quality is None else min(over_quality, q)
+    return fit_quality, over_quality
+
+
+def next_search_quality(
+    tried,
+    fit_quality,
+    over_quality,
+    target_bytes,
+    min_target_bytes,
+    low,
+    high,
+    start,
+):
+    lower = low - 1 if fit_quality is None else fit_quality
+    upper = high + 1 if over_quality is None else over_quality
+    if start is not None and start not in tried and lower < start < upper:
+        return start
+
+    if fit_quality is None:
+        if over_quality is None:
+            return high
+        return low if over_quality > low else None
+
+    if len(tried[fit_quality]) >= min_target_bytes:
+        return None
+    if over_quality is None:
+        return high if fit_quality < high else None
+    if over_quality - fit_quality <= 1:
+        return None
+
+    # Secant step between the bracket ends, kept strictly inside the bracket.
+    fit_size = len(tried[fit_quality])
+    over_size = len(tried[over_quality])
+    step = (target_bytes - fit_size) * (over_quality - fit_quality)
+    candidate = fit_quality + int(step / max(1, over_size - fit_size))
+    return min(over_quality - 1, max(fit_quality + 1, candidate))
+
+
+def predict_webp_quality(image, target_bytes, low, high):
+    """Estimate the quality whose final-effort full-size encode lands just under target_bytes.
+
+    A mosaic of tiles sampled across the image is encoded at a few qualities,
+    log(bytes per pixel) is fitted against quality and extrapolated to the full
+    pixel count. For images of PROXY_CALIBRATE_AREA_RATIO mosaics or more, the
+    mosaic is also encoded at final effort at both ends of the range and the
+    log final/search size ratio is interpolated in between; smaller images assume
+    WEBP_EFFORT_RATIO. Returns (quality, final/search size ratio at that quality),
+    or None when the image is too small for sampling to pay off.
+    """
+    proxy = build_proxy_mosaic(image, PROXY_TILE_SIZE, PROXY_GRID)
+    if proxy is None:
+        return None
+
+    proxy_pixels = proxy.width * proxy.height
+    sizes = {}
+    for q in sorted({low, (low + high) // 2, high}):
+        sizes[q] = len(encode_webp(proxy, q, lossless=False, proxy=True))
+
+    # log(final / search size), linear in quality between low and high.
+    log_ratio = math.log(WEBP_EFFORT_RATIO)
+    log_ratio_slope = 0.0
+    if (
+        WEBP_SEARCH_METHOD != WEBP_FINAL_METHOD
+        and image.width * image.height >= PROXY_CALIBRATE_AREA_RATIO * proxy_pixels
+    ):
+        log_ratio = math.log(len(encode_webp(proxy, low, lossless=False, proxy=True, final=True)) / sizes[low])
+        log_ratio_high = math.log(len(encode_webp(proxy, high, lossless=False, proxy=True, final=True)) / sizes[high])
+        log_ratio_slope = (log_ratio_high - log_ratio) / max(1, high - low)
+
+    samples = [
+        (q, math.log(size / proxy_pixels) + log_ratio + log_ratio_slope * (q - low))
+        for q, size in sizes.items()
+    ]
+    target_bpp = target_bytes * PROXY_MARGIN / (image.width * image.height)
+    predicted = solve_quality_curve(samples, target_bpp, low, high)
+    if predicted is None:
+        return None
+    ratio = math.exp(log_ratio + log_ratio_slope * (predicted - low))
+    metrics_set(predicted_quality=predicted, predicted_effort_ratio=round(ratio, 4))
+    return predicted, ratio
+
+
+def build_proxy_mosaic(image, tile_size, grid, align=1):
+    """grid x grid tiles spread evenly over the image, or None if it is too small.
+    Tile offsets are rounded down to multiples of align (8 keeps JPEG blocks intact).
+    """
+    width, height = image.size
+    mosaic_size = tile_size * grid
+    if width < mosaic_size or height < mosaic_size:
+        return None
+    if width * height < PROXY_MIN_AREA_RATIO * mosaic_size * mosaic_size:
+        return None
+
+    mosaic = Image.new(image.mode, (mosaic_size, mosaic_size))
+    for row in range(grid):
+        for col in range(grid):
+            left = (width - tile_size) * col // (grid - 1) // align * align
+            top = (height - tile_size) * row // (grid - 1) // align * align
+            tile = image.crop((left, top, left + tile_size, top + tile_size))
+            mosaic.paste(tile, (col * tile_size, row * tile_size))
+    return mosaic
+
+
+def solve_quality_curve(samples, target_bpp, low, high):
+    """Least-squares fit of log(bpp) = a + b * quality, solved for target_bpp."""
+    count = len(samples)
+    if count < 2:
+        return None
+    mean_q = sum(q for q, _ in samples) / count
+    mean_y = sum(y for _, y in samples) / count
+    var_q = sum((q - mean_q) ** 2 for q, _ in samples)
+    if var_q == 0:
+        return None
+    slope = sum((q - mean_q) * (y - mean_y) for q, y in samples) / var_q
+    if slope <= 0:
+        return None
+    intercept = mean_y - slope * mean_q
+    quality = int(math.floor((math.log(target_bpp) - intercept) / slope))
+    return min(high, max(low, quality))
+
+
+def ensure_max_dimension(image, max_dim):
+    if max(image.size) <= max_dim:
+        return image
+
+    # reducing_gap lets Pillow Image.reduce() by an integer factor first, so
+    # LANCZOS only runs over the last few multiples of the target size.
+    with metrics_stage("resize"):
+        resized = image.resize(
+            scaled_size(image.size, max_dim),
+            Image.LANCZOS,
+            reducing_gap=RESIZE_REDUCING_GAP,
+        )
+    metrics_set(resized_size=list(resized.size))
+    return resized
+
+
+def scaled_size(size, max_dim):
+    width, height = size
+    if max(width, height) <= max_dim:
+        return size
+
+    if width >= height:
+        new_width = max_dim
+        new_height = int(height * (max_dim / width))
+    else:
+        new_height = max_dim
+        new_width = int(width * (max_dim / height))
+    return new_width, new_height
+
+
+def normalize_mode(image):
+    if image.mode in {"RGBA", "LA"}:
+        return image.convert("RGBA")
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def classify_content(image, target_bytes, quality, min_quality):
+    """Pick lossless, near_lossless or lossy WebP for a normalized image.
+
+    Measured on a nearest-neighbour sample over its visible pixels: unique
+    colours, flat ratio (no change to the right or lower neighbour), edge density
+    (a channel changes by CLASSIFY_EDGE_THRESHOLD or more) and the share of
+    pixels that are not fully opaque. Returns (mode, start quality for the lossy
+    search), or None when the classifier is off or NumPy is missing.
+    """
+    if np is None or not CONTENT_CLASSIFIER:
+        return None
+    with metrics_stage("classify"):
+        pixel_count = image.width * image.height
+        scale = CLASSIFY_MAX_SIDE / max(image.size)
+        if scale < 1:
+            sample_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(sample_size, Image.NEAREST)
+        pixels = np.asarray(image)
+        rgb = pixels[..., :3].astype(np.int32)
+        if image.mode == "RGBA":
+            visible = pixels[..., 3] > 0
+            alpha_ratio = float(np.mean(pixels[..., 3] < 255))
+        else:
+            visible = np.ones(pixels.shape[:2], dtype=bool)
+            alpha_ratio = 0.0
+        gradient = pixel_gradient(rgb)[visible]
+        if gradient.size == 0:
+            metrics_set(content="lossless", alpha_ratio=alpha_ratio)
+            return "lossless", quality
+
+        colors = len(np.unique(((rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2])[visible]))
+        flat_ratio = float(np.mean(gradient == 0))
+        edge_density = float(np.mean(gradient >= CLASSIFY_EDGE_THRESHOLD))
+        if flat_ratio >= GRAPHIC_FLAT_RATIO and colors <= LOSSLESS_MAX_COLORS:
+            mode = "lossless"
+        elif flat_ratio >= GRAPHIC_FLAT_RATIO and colors <= NEAR_LOSSLESS_MAX_COLORS:
+            mode = "near_lossless"
+        else:
+            mode = "lossy"
+
+        # Rough lossy size at full quality; every QUALITY_HALVING_STEPS below roughly halves it.
+        bits_per_pixel = CLASSIFY_FLAT_BPP + (CLASSIFY_BUSY_BPP - CLASSIFY_FLAT_BPP) * edge_density ** 0.25
+        estimated_bytes = pixel_count * bits_per_pixel / 8
+        start = quality
+        if estimated_bytes > target_bytes:
+            steps = QUALITY_HALVING_STEPS * math.log2(estimated_bytes / target_bytes)
+            start = max(min_quality, quality - round(steps))
+        metrics_set(
+            content=mode,
+            colors=colors,
+            flat_ratio=round(flat_ratio, 4),
+            edge_density=round(edge_density, 4),
+            alpha_ratio=round(alpha_ratio, 4),
+            content_quality=start,
+        )
+    return mode, start
+
+
+def pixel_gradient(rgb):
+    """Largest channel difference of every pixel to its right and lower neighbour."""
+    gradient = np.zeros(rgb.shape[:2], dtype=rgb.dtype)
+    gradient[:, :-1] = np.abs(np.diff(rgb, axis=1)).max(axis=2)
+    gradient[:-1, :] = np.maximum(gradient[:-1, :], np.abs(np.diff(rgb, axis=0)).max(axis=2))
+    return gradient
+
+
+def near_lossless_image(image, bits):
+    """Round the low bits of every pixel that differs from a neighbour.
+
+    Pillow does not expose libwebp's near_lossless setting, so this does a similar
+    preprocessing: anti-aliasing and gradients cost fewer bits in the lossless
+    encode that follows, while flat areas keep their exact colours.
+    """
+    pixels = np.array(image)
+    rgb = pixels[..., :3].astype(np.int16)
+    step = 1 << bits
+    rounded = np.minimum((rgb + step // 2) // step * step, 255).astype(np.uint8)
+    changed = pixel_gradient(rgb) > 0
+    pixels[..., :3][changed] = rounded[changed]
+    return Image.fromarray(pixels)
+
+
+def encode_webp(image, quality, lossless, proxy=False, final=False):
+    """Search-effort encode unless final (lossless is never searched, so always final).
+
+    proxy marks quality-prediction mosaics; proxy, search and final encodes are
+    counted apart.
+    """
+    final = final or lossless
+    kind = "proxy_encode" if proxy else "final_encode" if final else "encode"
+    with metrics_stage(kind):
+        output = io.BytesIO()
+        image.save(
+            output,
+            format="WEBP",
+            quality=quality,
+            method=WEBP_FINAL_METHOD if final else WEBP_SEARCH_METHOD,
+            lossless=lossless,
+        )
+    metrics_count(f"{kind}s")
+    return output.getvalue()
+
+
+def is_middle_image_key(key):
+    return os.path.splitext(key)[1].lower() in MIDDLE_IMAGE_EXTENSIONS
+
+
+class BatchDeleter:
+    """Collect keys and remove them with delete_objects.
+
+    Every DELETE_BATCH_SIZE keys are sent as one request on a pool of `workers`
+    threads, so listing a large prefix overlaps with deleting it. Keys S3 reports
+    as failed are retried once; anything still failing raises on close().
+    """
+
+    def __init__(self, bucket, workers=None):
+        self.bucket = bucket
+        self.workers = max(1, DELETE_WORKERS if workers is None else workers)
+        self.pending = []
+        self.futures = []
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def add(self, key):
+        self.pending.append(key)
+        if len(self.pending) >= DELETE_BATCH_SIZE:
+            self.submit()
+
+    def add_prefix(self, prefix):
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                self.add(item["Key"])
+
+    def submit(self):
+        if not self.pending:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        batch, self.pending = self.pending, []
+        self.futures.append(self.executor.submit(self.delete_batch, batch))
+
+    def drain(self):
+        """Send what is queued and wait until every batch so far is done."""
+        self.submit()
+        futures, self.futures = self.futures, []
+        failed = []
+        for future in futures:
+            failed.extend(future.result())
+        if failed:
+            raise IOError(f"Could not delete {len(failed)} keys, e.g. {failed[:5]}")
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def delete_batch(self, keys):
+        """Delete one batch; returns [(key, error code)] of keys that failed twice."""
+        errors = []
+        for attempt in range(2):
+            response = s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+            )
+            errors = response.get("Errors", [])
+            if not errors:
+                return []
+            keys = [error["Key"] for error in errors]
+        return [(error["Key"], error.get("Code")) for error in errors]
+
+
+def build_derivative_cache(bucket):
+    """Derivative cache from DERIVATIVE_CACHE ("s3", "local" or unset = off)."""
+    mode = os.environ.get("DERIVATIVE_CACHE", "")
+    if mode == "s3":
+        return S3DerivativeCache(
+            bucket, os.environ.get("DERIVATIVE_CACHE_PREFIX", "derivative_cache")
+        )
+    if mode == "local":
+        return LocalDerivativeCache(
+            os.environ.get("DERIVATIVE_CACHE_DIR", "/tmp/derivative_cache"),
+            int(float(os.environ.get("DERIVATIVE_CACHE_MAX_MB", "256")) * 1024 * 1024),
+        )
+    return None
+
+
+def derivative_cache_key(source_hash, params, extension):
+    """Content address: MD5 of the source bytes plus a hash of the encoder params."""
+    encoded = json.dumps(
+        dict(params, cache_version=DERIVATIVE_CACHE_VERSION), sort_keys=True
+    )
+    params_hash = hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+    return f"{source_hash[:2]}/{source_hash}-{params_hash}{extension}"
+
+
+def etag_content_hash(etag):
+    """Single-part uploads have ETag == MD5(body); multipart ETags contain '-'."""
+    etag = etag.strip('"')
+    if len(etag) == 32 and "-" not in etag:
+        return etag
+    return None
+
+
+class ObjectChangedError(IOError):
+    """The object was overwritten while its byte ranges were being fetched."""
+
+
+def download_object(bucket, key, size=None, etag=None, parallel_bytes=None, part_bytes=None,
+                    workers=None, client=None):
+    """GET an object; at parallel_bytes and above (size known), as concurrent byte
+    ranges written in place into one presized buffer, so no part is concatenated or
+    copied again.
+
+    Every range is pinned to one version with IfMatch: on `etag` when the caller has
+    it from a HEAD, else on the ETag of the first range, fetched before the others.
+    Each ContentRange total must match `size`. If the object is overwritten while the
+    ranges run, they fail (412, or a changed total) instead of mixing two versions,
+    and the current version is fetched again with one plain GET.
+    """
+    client = s3 if client is None else client
+    parallel_bytes = DOWNLOAD_PARALLEL_BYTES if parallel_bytes is None else parallel_bytes
+    part_bytes = max(1, DOWNLOAD_PART_BYTES if part_bytes is None else part_bytes)
+    if size is None or size < max(parallel_bytes, part_bytes + 1):
+        return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    try:
+        return download_ranges(
+            client, bucket, key, size, etag, part_bytes, DOWNLOAD_WORKERS if workers is None else workers
+        )
+    except ObjectChangedError as e:
+        print(f"{e}; fetching it again with one GET")
+        return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+def download_ranges(client, bucket, key, size, etag, part_bytes, workers):
+    # Presize a BytesIO and fill its buffer through a memoryview; getvalue() then
+    # hands back the same allocation as bytes instead of copying it.
+    buffer = io.BytesIO()
+    buffer.seek(size - 1)
+    buffer.write(b"\0")
+    view = buffer.getbuffer()
+
+    def fetch(start, etag):
+        end = min(start + part_bytes, size)
+        extra = {"IfMatch": etag} if etag else {}
+        try:
+            response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", **extra)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "412", "InvalidRange", "416"):
+                raise ObjectChangedError(f"{key} changed during the download") from e
+            raise
+        total = response.get("ContentRange", "").rpartition("/")[2]
+        if total != str(size):
+            raise ObjectChangedError(f"{key} changed during the download: {total} bytes, expected {size}")
+        body = response["Body"]
+        offset = start
+        while offset < end:
+            chunk = body.read(min(DOWNLOAD_READ_BYTES, end - offset))
+            if not chunk:
+                raise IOError(f"Short read for {key} at byte {offset} of {size}")
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return response["ETag"]
+
+    try:
+        starts = range(0, size, part_bytes)
+        if not etag:
+            etag = fetch(0, None)
+            starts = starts[1:]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(partial(fetch, etag=etag), starts))
+    finally:
+        view.release()
+    return buffer.getvalue()
+
+
+class S3DerivativeCache:
+    """Derivatives kept under a prefix of the bucket; hits are server-side copies."""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+
+    def restore(self, cache_key, bucket, destination_key, content_type):
+        try:
+            s3.copy_object(
+                Bucket=bucket,
+                Key=destination_key,
+                CopySource={"Bucket": self.bucket, "Key": f"{self.prefix}/{cache_key}"},
+                ContentType=content_type,
+                MetadataDirective="REPLACE",
+            )
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in {"NoSuchKey", "404"}:
+                return False
+            raise
+        return True
+
+    def store(self, cache_key, data, content_type):
+        s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}/{cache_key}",
+            Body=data,
+            ContentType=content_type,
+        )
+
+
+class LocalDerivativeCache:
+    """Size-bounded LRU on local disk; /tmp survives warm Lambda starts.
+
+    Threads (and processes) share the directory: entries are written to a unique
+    temp file and renamed into place, and a file removed by another thread's
+    eviction in between is skipped.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, cache_key):
+        return os.path.join(self.directory, cache_key.replace("/", "_"))
+
+    def restore(self, cache_key, bucket, destination_key, content_type):
+        path = self.path(cache_key)
+        try:
+            with open(path, "rb") as handle:
+                data = handle.read()
+        except FileNotFoundError:
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        s3.put_object(
+            Bucket=bucket, Key=destination_key, Body=data, ContentType=content_type
+        )
+        return True
+
+    def store(self, cache_key, data, content_type):
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temp:
+                temp.write(data)
+            os.replace(temp_path, self.path(cache_key))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class RunMetrics:
+    """Stage durations, counters and decisions of one run (an object, an image).
+
+    Stages may nest (compress covers decode, encode, ...); a stage entered more
+    than once accumulates.
+    """
+
+    def __init__(self, function, key):
+        self.function = function
+        self.key = key
+        self.stages = {}
+        self.counts = {}
+        self.values = {}
+        self.started = time.perf_counter()
+        self.total_ms = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def merge(self, other):
+        """Fold in a run dict recorded elsewhere (e.g. in an encoder process)."""
+        for name, ms in other["stages"].items():
+            self.stages[name] = self.stages.get(name, 0.0) + ms
+        for name, count in other["counts"].items():
+            self.count(name, count)
+        self.values.update(other["values"])
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        return {
+            "function": self.function,
+            "key": self.key,
+            "total_ms": round(self.total_ms or 0.0, 2),
+            "stages": {name: round(ms, 2) for name, ms in self.stages.items()},
+            "counts": dict(self.counts),
+            "values": dict(self.values),
+        }
+
+    def to_emf(self):
+        """The run as a CloudWatch embedded metric format log object."""
+        record = {"Function": self.function, "key": self.key, "total_ms": round(self.total_ms or 0.0, 2)}
+        metrics = [{"Name": "total_ms", "Unit": "Milliseconds"}]
+        for name, ms in self.stages.items():
+            record[f"{name}_ms"] = round(ms, 2)
+            metrics.append({"Name": f"{name}_ms", "Unit": "Milliseconds"})
+        for name, count in self.counts.items():
+            record[name] = count
+            metrics.append({"Name": name, "Unit": "Count"})
+        for name, value in self.values.items():
+            record[name] = value
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics.append({"Name": name, "Unit": "Bytes" if name.endswith("_bytes") else "None"})
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {"Namespace": METRICS_NAMESPACE, "Dimensions": [["Function"]], "Metrics": metrics}
+            ],
+        }
+        return record
+
+
+@contextlib.contextmanager
+def bind_run(run):
+    """Make run the current run of this thread for metrics_stage/count/set."""
+    previous = getattr(_metrics_local, "run", None)
+    _metrics_local.run = run
+    try:
+        yield run
+    finally:
+        _metrics_local.run = previous
+
+
+@contextlib.contextmanager
+def track_run(function, key, emit=True):
+    """Collect metrics for the enclosed work on this thread; emit them when it ends (also on error)."""
+    run = RunMetrics(function, key)
+    try:
+        with bind_run(run):
+            yield run
+    except BaseException:
+        run.set(outcome="error")
+        raise
+    finally:
+        run.finish()
+        if emit:
+            emit_metrics(run)
+
+
+@contextlib.contextmanager
+def metrics_prefix(prefix):
+    """Prefix every metric name recorded on this thread inside the block."""
+    previous = getattr(_metrics_local, "prefix", "")
+    _metrics_local.prefix = previous + prefix
+    try:
+        yield
+    finally:
+        _metrics_local.prefix = previous
+
+
+def emit_metrics(run):
+    if METRICS_ENABLED:
+        print(json.dumps(run.to_emf(), separators=(",", ":")))
+    for sink in METRICS_SINKS:
+        sink.add(run.as_dict())
+
+
+def metrics_stage(name):
+    run = getattr(_metrics_local, "run", None)
+    if run is None:
+        return contextlib.nullcontext()
+    return run.stage(getattr(_metrics_local, "prefix", "") + name)
+
+
+def metrics_count(name, amount=1):
+    run = getattr(_metrics_local, "run", None)
+    if run is not None:
+        run.count(getattr(_metrics_local, "prefix", "") + name, amount)
+
+
+def metrics_set(**values):
+    run = getattr(_metrics_local, "run", None)
+    if run is not None:
+        prefix = getattr(_metrics_local, "prefix", "")
+        run.set(**{prefix + name: value for name, value in values.items()})
+
+
+class MetricsAggregator:
+    """In-process collector of run dicts (see RunMetrics.as_dict) for a summary table.
+
+    Subclasses name the values worth a column (SUMMARY_VALUES) and the value that
+    marks a resized image (RESIZED_VALUE).
+    """
+
+    SUMMARY_VALUES = ("quality", "input_bytes", "output_bytes")
+    RESIZED_VALUE = "resized_size"
+
+    def __init__(self):
+        self.runs = []
+        self.lock = threading.Lock()
+
+    def add(self, run):
+        with self.lock:
+            self.runs.append(run)
+
+    def summary(self):
+        """{column: [values]} over every run: total, per stage and per counter."""
+        columns = {"total_ms": [run["total_ms"] for run in self.runs]}
+        for run in self.runs:
+            for name, ms in run["stages"].items():
+                columns.setdefault(f"{name}_ms", []).append(ms)
+            for name, count in run["counts"].items():
+                columns.setdefault(name, []).append(count)
+            for name in self.SUMMARY_VALUES:
+                value = run["values"].get(name)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    columns.setdefault(name, []).append(value)
+        return columns
+
+    def print_summary(self):
+        outcomes = {}
+        for run in self.runs:
+            outcome = run["values"].get("outcome", "-")
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        resized = sum(1 for run in self.runs if self.RESIZED_VALUE in run["values"])
+        drafted = sum(1 for run in self.runs if "draft_size" in run["values"])
+        print(
+            f"{len(self.runs)} runs ({', '.join(f'{k} {v}' for k, v in sorted(outcomes.items()))}); "
+            f"{resized} resized, {drafted} draft-decoded"
+        )
+        columns = self.summary()
+        width = max([22] + [len(name) for name in columns])
+        print(f"{'metric':<{width}} {'runs':>6} {'total':>12} {'mean':>10} {'p50':>10} {'p95':>10} {'max':>10}")
+        for name, values in columns.items():
+            ordered = sorted(values)
+            print(
+                f"{name:<{width}} {len(values):>6} {sum(values):>12.1f} {sum(values) / len(values):>10.1f} "
+                f"{ordered[len(ordered) // 2]:>10.1f} {ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]:>10.1f} "
+                f"{ordered[-1]:>10.1f}"
+            )
+
+
+@contextlib.contextmanager
+def maybe_profile(label, bucket, every=None):
+    """Profile the enclosed block for 1 in `every` calls (PROFILE_EVERY; <= 0 = never)."""
+    every = PROFILE_EVERY if every is None else every
+    if every <= 0 or random.randrange(every) != 0:
+        yield
+        return
+    with profile_run(label, bucket):
+        yield
+
+
+@contextlib.contextmanager
+def profile_run(label, bucket, directory=None, s3_prefix=None):
+    """Run the enclosed block under cProfile and tracemalloc, then write the report.
+
+    Most of the work runs on worker threads (folder fan-out, ObjectPipeline,
+    BatchDeleter, ranged downloads). Before Python 3.12 a cProfile profiler only
+    sees the thread that enabled it, so every thread started inside the block
+    gets its own profiler (threading.setprofile) and the report merges them all.
+    From 3.12 cProfile hooks sys.monitoring, which already covers every thread.
+    Threads started before the block (none in these handlers) are not profiled.
+    """
+    tracemalloc.start(PROFILE_TRACE_FRAMES)
+    profiler = cProfile.Profile()
+    thread_profilers = []
+    per_thread = sys.version_info < (3, 12)
+    if per_thread:
+        threading.setprofile(partial(start_thread_profile, thread_profilers))
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if per_thread:
+            threading.setprofile(None)
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            stats = pstats.Stats(profiler)
+            for thread_profiler in list(thread_profilers):
+                stats.add(thread_profiler)
+            write_profile(
+                label, bucket, stats, snapshot, traced_peak, elapsed, directory, s3_prefix,
+                threads=1 + len(thread_profilers),
+            )
+        except Exception as e:  # a failed report must not fail the invocation
+            print(f"Could not write profile {label}: {e}")
+
+
+def start_thread_profile(profilers, frame, event, arg):
+    """threading.setprofile hook: the first event of a new thread enables a profiler
+    of its own (which replaces this hook for that thread).
+    """
+    profiler = cProfile.Profile()
+    profilers.append(profiler)
+    profiler.enable()
+
+
+def write_profile(label, bucket, stats, snapshot, traced_peak, elapsed, directory=None, s3_prefix=None,
+                  threads=1):
+    """Write <label>.prof (pstats) and <label>.txt to directory (PROFILE_DIR) and, when
+    s3_prefix (PROFILE_S3_PREFIX) is set, under it in bucket.
+    """
+    directory = PROFILE_DIR if directory is None else directory
+    s3_prefix = PROFILE_S3_PREFIX if s3_prefix is None else s3_prefix
+    os.makedirs(directory, exist_ok=True)
+    stats_path = os.path.join(directory, f"{label}.prof")
+    report_path = os.path.join(directory, f"{label}.txt")
+    stats.dump_stats(stats_path)
+
+    # tracemalloc sees Python allocations only; Pillow's pixel buffers show up
+    # in the RSS high-water mark instead.
+    report = io.StringIO()
+    report.write(
+        f"{label}: {elapsed:.3f}s, {threads} threads profiled, tracemalloc peak "
+        f"{traced_peak / 1024 / 1024:.1f} MB, max RSS {peak_rss_mb():.1f} MB\n\n"
+    )
+    stats.stream = report
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    report.write(f"Top {PROFILE_TOP} allocation sites (still allocated at the end):\n")
+    for stat in snapshot.statistics("traceback")[:PROFILE_TOP]:
+        report.write(f"{stat.size / 1024:10.1f} KB {stat.count:8d} blocks\n")
+        for line in stat.traceback.format(limit=PROFILE_TRACE_FRAMES):
+            report.write(f"    {line}\n")
+    with open(report_path, "w", encoding="utf-8") as handle:
+        handle.write(report.getvalue())
+
+    if s3_prefix:
+        prefix = s3_prefix.rstrip("/")
+        with open(stats_path, "rb") as handle:
+            s3.put_object(Bucket=bucket, Key=f"{prefix}/{label}.prof", Body=handle.read(),
+                          ContentType="application/octet-stream")
+        s3.put_object(Bucket=bucket, Key=f"{prefix}/{label}.txt", Body=report.getvalue(),
+                      ContentType="text/plain")
+    print(f"Profile written: {report_path}")
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux (the Lambda runtime), bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def iter_s3_records(event):
+    for record in event.get("Records", []):
+        if "s3" in record:
+            yield record
+            continue
+        sns = record.get("Sns")
+        if not sns:
+            continue
+        try:
+            message = json.loads(sns.get("Message", ""))
+        except json.JSONDecodeError:
+            continue
+        for inner in message.get("Records", []):
+            if "s3" in inner:
+                yield inner
+
+
+def is_queue_event(event):
+    records = event.get("Records", [])
+    return bool(records) and all(record.get("eventSource") == "aws:sqs" for record in records)
+
+
+def queue_message_event(message):
+    """The S3 event in an SQS message body: an S3 notification or an SNS envelope."""
+    try:
+        body = json.loads(message.get("body", ""))
+    except json.JSONDecodeError:
+        print(f"Skipping message {message.get('messageId')}: body is not JSON")
+        return {}
+    if not isinstance(body, dict):
+        return {}
+    if body.get("Type") == "Notification":
+        return {"Records": [{"Sns": body}]}
+    return body
+
+
+def coalesce_records(records):
+    """The records still needed once each key is reduced to its final intended state."""
+    records = list(records)
+    return [records[index] for index in coalesced_indexes(records)]
+
+
+def coalesced_indexes(records):
+    """Indexes of records to keep, in delivery order.
+
+    - Last writer wins: only the last create or remove of a key is kept, so a
+      create followed by a remove leaves just the remove (it still has to clear
+      derivatives from before the batch, and costs no encode).
+    - A folder create drops creates of keys under it: the folder is listed when
+      it is processed. Removes under it are kept.
+    - A folder remove drops every earlier record under it.
+    Other event types and folder continuations (startAfter) are kept as they are.
+    """
+    latest = {}
+    kept = []
+    for index, record in enumerate(records):
+        event_name = unquote_plus(record["eventName"])
+        created = event_name.startswith("ObjectCreated:")
+        if record.get("startAfter") or not (created or event_name.startswith("ObjectRemoved:")):
+            kept.append(index)
+            continue
+        latest[unquote_plus(record["s3"]["object"]["key"])] = (index, created)
+
+    folders = [(key, index, created) for key, (index, created) in latest.items() if key.endswith("/")]
+    for key, (index, created) in latest.items():
+        subsumed = any(
+            key != folder
+            and key.startswith(folder)
+            and (created if folder_created else index < folder_index)
+            for folder, folder_index, folder_created in folders
+        )
+        if not subsumed:
+            kept.append(index)
+    if len(kept) < len(records):
+        print(f"Coalesced {len(records)} records into {len(kept)}")
+    return sorted(kept)
+
+
+def coalesce_queue_messages(messages):
+    """[(message, S3 event)] with the records superseded by other messages removed."""
+    owners = []
+    records = []
+    for position, message in enumerate(messages):
+        for record in iter_s3_records(queue_message_event(message)):
+            owners.append(position)
+            records.append(record)
+    events = [(message, {"Records": []}) for message in messages]
+    for index in coalesced_indexes(records):
+        events[owners[index]][1]["Records"].append(records[index])
+    return events
+
+
+def fan_out(bucket, folder_key, handle_item, context=None, start_after=None, workers=1, reserve_seconds=0):
+    """Call handle_item(item) for every object under folder_key, `workers` at a time.
+
+    Listing is paginated and runs ahead of the workers by at most one batch.
+    Items start in listing order, so when less than reserve_seconds of the
+    invocation is left and the loop stops early, every key after the last one
+    started is left over; those are handed back with hand_back_folder. Returns
+    {key: handle_item result} for the keys handled; if any item raised, the first
+    error is re-raised once the others finish.
+    """
+    workers = max(1, workers)
+    params = {"Bucket": bucket, "Prefix": folder_key}
+    if start_after:
+        params["StartAfter"] = start_after
+
+    futures = {}
+    running = set()
+    last_started = None
+    stopped = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**params):
+            for item in page.get("Contents", []):
+                while len(running) >= workers:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+                # At least one key per invocation, so a continuation always progresses.
+                if last_started is not None and out_of_time(context, reserve_seconds):
+                    stopped = True
+                    break
+                future = executor.submit(handle_item, item)
+                futures[item["Key"]] = future
+                running.add(future)
+                last_started = item["Key"]
+            if stopped:
+                break
+
+    if stopped:
+        hand_back_folder(context, folder_key, last_started or start_after)
+    results = {}
+    errors = []
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            print(f"Failed to process {key}: {e}")
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def out_of_time(context, reserve_seconds):
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return False
+    return context.get_remaining_time_in_millis() < reserve_seconds * 1000
+
+
+def hand_back_folder(context, folder_key, start_after):
+    """Re-invoke the running function asynchronously for the keys of folder_key after start_after."""
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client("lambda")
+    record = {
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Continuation",
+        "s3": {"object": {"key": quote_plus(folder_key)}},
+    }
+    if start_after:
+        record["startAfter"] = start_after
+    _lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({"Records": [record]}).encode("utf-8"),
+    )
+    print(f"Out of time; handed back {folder_key} after {start_after}")
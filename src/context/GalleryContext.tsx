@@ -2,7 +2,7 @@ import { createContext, useCallback, useContext, useEffect, useMemo, useRef, use
 import { albumCoverImages } from "../data/albumCoverImages";
 import { defaultRootCovers } from "../data/defaultCoverImages";
 import { AlbumNode, ImageSizeKey } from "../lib/types";
-import { buildAlbumTree, getNodeByPath } from "../lib/treeBuilder";
+import { buildAlbumTree, expandCompactIndex, getNodeByPath, isCompactIndex } from "../lib/treeBuilder";
 import { useAuth } from "./AuthContext";
 
 interface GalleryContextValue {
@@ -121,9 +121,9 @@ export function GalleryProvider({ children }: { children: React.ReactNode }) {
         return;
       }
 
-      const payload = await response.json();
+      const body = await response.json();
 
-      if (payload?.statusCode && response.status === 200) {
+      if (body?.statusCode && response.status === 200) {
         setError("Authentication failed while loading albums.");
         if (!hasCache) {
           setRoot(null);
@@ -131,6 +131,8 @@ export function GalleryProvider({ children }: { children: React.ReactNode }) {
         return;
       }
 
+      const payload = isCompactIndex(body) ? expandCompactIndex(body) : body;
+
       if (!Array.isArray(payload)) {
         setError("Unexpected API response format.");
         if (!hasCache) {
@@ -3,8 +3,32 @@ import type { PhotoAsset } from "../lib/types";
 
 type PhotoMetadata = Record<string, Record<string, string> | null>;
 
+type MetadataBundle = {
+  photos?: Record<string, { exif?: Record<string, string> }>;
+};
+
+const BUNDLE_NAME = "_metadata.json";
+
+function bundleUrlFor(photo: PhotoAsset) {
+  return photo.infoUrl.replace(/[^/]+$/, BUNDLE_NAME);
+}
+
+// One request per folder: the bundle carries the EXIF of every photo in it.
+async function fetchBundle(url: string): Promise<MetadataBundle | null> {
+  try {
+    const response = await fetch(url);
+    if (!response.ok) {
+      return null;
+    }
+    return (await response.json()) as MetadataBundle;
+  } catch (error) {
+    return null;
+  }
+}
+
 export function usePhotoMetadata(photos: PhotoAsset[]) {
   const cacheRef = useRef<Map<string, Record<string, string>>>(new Map());
+  const bundlesRef = useRef<Map<string, Promise<MetadataBundle | null>>>(new Map());
   const [metadata, setMetadata] = useState<PhotoMetadata>({});
   const [isLoading, setIsLoading] = useState(false);
 
@@ -28,6 +52,16 @@ export function usePhotoMetadata(photos: PhotoAsset[]) {
 
     Promise.all(
       missing.map(async (photo) => {
+        const bundleUrl = bundleUrlFor(photo);
+        if (!bundlesRef.current.has(bundleUrl)) {
+          bundlesRef.current.set(bundleUrl, fetchBundle(bundleUrl));
+        }
+        const bundle = await bundlesRef.current.get(bundleUrl);
+        const bundled = bundle?.photos?.[photo.name]?.exif;
+        if (bundled) {
+          return { photo, info: bundled } as const;
+        }
+        // Folders without a bundle (or photos added before it was rebuilt) fall back to _info.json.
         try {
           const response = await fetch(photo.infoUrl);
           if (!response.ok) {
@@ -1,4 +1,4 @@
-import { AlbumNode, PhotoAsset } from "./types";
+import { AlbumNode, CompactIndex, CompactIndexNode, PhotoAsset } from "./types";
 
 const IMAGE_EXTENSIONS = /\.(jpe?g|png)$/i;
 
@@ -83,6 +83,25 @@ function createPhotoAsset(originalUrl: string, path: string[]): PhotoAsset {
   };
 }
 
+export function isCompactIndex(payload: unknown): payload is CompactIndex {
+  return (
+    typeof payload === "object" &&
+    payload !== null &&
+    (payload as CompactIndex).format === "compact-v1" &&
+    typeof (payload as CompactIndex).base_url === "string"
+  );
+}
+
+export function expandCompactIndex(index: CompactIndex): string[] {
+  const urls: string[] = [];
+  const walk = (node: CompactIndexNode, prefix: string) => {
+    Object.entries(node.d ?? {}).forEach(([folder, child]) => walk(child, `${prefix}${folder}/`));
+    (node.f ?? []).forEach((name) => urls.push(`${prefix}${name}`));
+  };
+  walk(index.tree, index.base_url);
+  return urls;
+}
+
 export function getNodeByPath(root: AlbumNode | null, path: string[]): AlbumNode | null {
   if (!root) {
     return null;
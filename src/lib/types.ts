@@ -19,3 +19,15 @@ export interface GalleryData {
   root: AlbumNode | null;
   flatList: string[];
 }
+
+export interface CompactIndexNode {
+  d?: Record<string, CompactIndexNode>;
+  f?: string[];
+}
+
+export interface CompactIndex {
+  format: "compact-v1";
+  base_url: string;
+  count: number;
+  tree: CompactIndexNode;
+}